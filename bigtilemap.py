@@ -123,7 +123,18 @@ import math
 import re
 import socket
 import threading
+import collections
+import csv,json
+import itertools
+import fnmatch
+import operator
+import pickle
+import xml.etree.ElementTree as ET
 import codecs					# gestion des encodages de fichier
+try:							# numpy (optionnal) : vectorized layers compositing
+	import numpy
+except ImportError:
+	numpy=None
 
 if sys.version_info.major==2:	# python 2.x
 	import ConfigParser as configparser		# gestion fichier.INI (paramètres et configuration)
@@ -136,32 +147,131 @@ else:							# python 3.x
 	import configparser						# gestion fichier.INI (paramètres et configuration)
 
 # required non-standard modules
-from PIL import Image,ImageDraw,PngImagePlugin		# Image manipulation library
+from PIL import Image,ImageDraw,ImageChops,PngImagePlugin		# Image manipulation library
 
 # local
 import config
 import bigtilemap_nominatim
 
+# quadkey digits for 4 bits of x and y (index y*16+x)
+quadkey_digits=["".join(["0123"[((x>>i)&1)|(((y>>i)&1)<<1)] for i in range(3,-1,-1)]) for y in range(16) for x in range(16)]
+
 def tilexy2quadkey(tx,ty,zoom):
 	""" convert standard tile coordinates and zoom into a quadkey (used by Bing Tile servers)
 		code from : http://www.web-maps.com/gisblog/?m=200903	
+		digits are interleaved 4 bits at a time (quadkey_digits table)
+	"""
+	n=(zoom+3)//4*4
+	quadkey="".join([quadkey_digits[((ty>>i)&15)*16+((tx>>i)&15)] for i in range(n-4,-1,-4)])
+	return quadkey[n-zoom:]
+
+# tile url tags (and aliases), see TileServer.getTileUrlFromXY
+url_tag_re=re.compile(r"\{(\w+)\}")
+url_tags={"x":"x","lon":"x","y":"y","lat":"y","z":"z","zoom":"z","s":"s","switch":"s","q":"q","w":"w","g":"g",
+		"apikey":"apikey","api":"apikey","appid":"appid","d":"d","date":"d","dt":"dt","t":"t"}
+
+def tileKeyServer(key,name):
+	""" return True if a tile key (see BigTileMap.build) use a tile file of the server name """
+	if type(key)==str:
+		return key.startswith(name+"_")
+	if type(key)==tuple:
+		for k in key:
+			if tileKeyServer(k,name):
+				return True
+	return False
+
+def tileKeyRank(key):
+	""" return how good a tile key (see BigTileMap.build) is, lower is better :
+			0 for a real tile, the zoom distance for a temporary tile, 99 for no data,
+			a tuple of ranks for a composited tile
+	"""
+	if type(key)==str:
+		return 0
+	if key==None:
+		return 99
+	if key[0]=="~":
+		return key[2]
+	return tuple(tileKeyRank(k if i==0 else k[0]) for (i,k) in enumerate(key))
+
+def tileKeyBetter(key,old):
+	""" return True if the tile key is better than the old one : 
+			a temporary tile replace no data, a closer zoom replace a farther one
 	"""
-	quadkey=""
-	for i in range(zoom,0,-1):
-		digit=0
-		mask=1<<(i-1)
-		if (tx&mask)!=0:
-			digit+=1
-		if (ty&mask)!=0:
-			digit+=2
-		quadkey+=str(digit)
-	return quadkey
+	(rank,old_rank)=(tileKeyRank(key),tileKeyRank(old))
+	if type(rank)!=tuple:
+		return rank<old_rank
+	return rank!=old_rank and all(r<=o for (r,o) in zip(rank,old_rank))
+
+def tileKeyUses(key,fnames):
+	""" return True if a tile key (see BigTileMap.build) use one of the tile files (fnames) """
+	if type(key)==str:
+		return key in fnames
+	if type(key)==tuple:
+		for k in key:
+			if tileKeyUses(k,fnames):
+				return True
+	return False
+
+blend_modes=("normal","multiply","screen","hillshade")
+luminance=(0.299,0.587,0.114)
+
+def blendTiles(base,layers):
+	""" composite layers over a base tile, layers is a list of (image,opacity,blend)
+		blend modes :
+			normal : layer over base (using layer transparency)
+			multiply : darken base with layer colors
+			screen : lighten base with layer colors
+			hillshade : layer luminance shade the base (mid-gray is neutral)
+		each layer transparency is multiplied by its opacity (0.0-1.0)
+		vectorized with numpy (whole tile buffers), or PIL operations if numpy is not available
+		return a new RGB image
+	"""
+	if numpy is None:
+		return blendTilesPIL(base,layers)
+	out=numpy.asarray(base.convert("RGB"),dtype=numpy.float32)*(1.0/255.0)
+	for (im,opacity,blend) in layers:
+		if im.size!=base.size:
+			im=im.resize(base.size)
+		a=numpy.asarray(im.convert("RGBA"),dtype=numpy.float32)*(1.0/255.0)
+		rgb=a[...,:3]
+		alpha=a[...,3:4]*opacity
+		if blend=="multiply":
+			rgb=out*rgb
+		elif blend=="screen":
+			rgb=1.0-(1.0-out)*(1.0-rgb)
+		elif blend=="hillshade":
+			shade=numpy.dot(rgb,numpy.array(luminance,dtype=numpy.float32))[...,None]
+			rgb=numpy.minimum(out*shade*2.0,1.0)
+		out+=(rgb-out)*alpha
+	return Image.fromarray((out*255.0+0.5).astype(numpy.uint8))
+
+def blendTilesPIL(base,layers):
+	""" blendTiles using only PIL (slower, used if numpy is not available) """
+	out=base.convert("RGB")
+	for (im,opacity,blend) in layers:
+		if im.size!=base.size:
+			im=im.resize(base.size)
+		layer=im.convert("RGBA")
+		rgb=layer.convert("RGB")
+		if blend=="multiply":
+			rgb=ImageChops.multiply(out,rgb)
+		elif blend=="screen":
+			rgb=ImageChops.screen(out,rgb)
+		elif blend=="hillshade":
+			shade=rgb.convert("L")
+			rgb=ImageChops.multiply(out,Image.merge("RGB",(shade,shade,shade)))
+			rgb=ImageChops.add(rgb,rgb)
+		mask=layer.getchannel("A")
+		if opacity<1.0:
+			mask=mask.point(lambda v:int(v*opacity))
+		out=Image.composite(rgb,out,mask)
+	return out
 
 """
 	Class/objects
 """
 
-class Coordinate():
+class Coordinate(tuple):
 	""" Coordinate : define a couple a value (longitude/latitude) to handle geographic coordinates
 		according to WGS84 standard
 		
@@ -169,28 +279,40 @@ class Coordinate():
 		latitude  : specify the north-south angular position (geographic coordinate) : -90° to +90°
 		coordinates are specified longitude first, latitude second.
 		
+		a Coordinate is immutable and compact : a (longitude,latitude) tuple without instance dict,
+		operations return a new Coordinate (see Points for arrays of locations)
+		
 		this class handle :
-			* algebric operation  : + - * /
+			* algebric operation  : + - * / (with a number or another coordinate)
 			* repr/str conversion
 			* distance calculation
 			* conversion to tile coordinate according to zoom
 	"""
-	def __init__(self,longitude=0.0,latitude=0.0):
-		self.longitude=longitude
-		self.latitude=latitude
+	__slots__=()
+	
+	def __new__(cls,longitude=0.0,latitude=0.0):
+		return tuple.__new__(cls,(longitude,latitude))
+	
+	def __getnewargs__(self):
+		return tuple(self)
+	
+	longitude=property(operator.itemgetter(0))
+	latitude=property(operator.itemgetter(1))
+	lon=longitude		# short names
+	lat=latitude
 		
 	def __repr__(self):
-		return "(%.4f,%.4f)" % (self.longitude,self.latitude)
+		return "(%.4f,%.4f)" % self
 		
 	def __str__(self):
-		if self.longitude<0.0:
-			slon="%.4fW" % -self.longitude
+		if self[0]<0.0:
+			slon="%.4fW" % -self[0]
 		else:
-			slon="%.4fE" % self.longitude
-		if self.latitude<0.0:
-			slat="%.4fN" % -self.latitude
+			slon="%.4fE" % self[0]
+		if self[1]<0.0:
+			slat="%.4fS" % -self[1]
 		else:
-			slat="%.4fS" % self.latitude
+			slat="%.4fN" % self[1]
 		return "(%s,%s)" % (slon,slat)
 		
 	def convert2Tile(self,zoom):
@@ -198,135 +320,586 @@ class Coordinate():
 			return a float coordinate
 			formula from : http://wiki.openstreetmap.org/wiki/Slippy_map_tilenames#Python
 		"""
-		lat_rad=math.radians(self.latitude)
+		lat_rad=math.radians(self[1])
 		n=2.0**zoom
-		x=(self.longitude+180.0)*n/360.0
+		x=(self[0]+180.0)*n/360.0
 		y=(1.0-math.log(math.tan(lat_rad)+(1.0/math.cos(lat_rad)))/math.pi)*n/2.0
 		return (x,y)
 	
-	def convertFromTile(self,coord,zoom):
-		""" convert standard (float) tile coordinates and zoom into a longitude,latitude
+	@classmethod
+	def fromTile(cls,coord,zoom):
+		""" convert standard (float) tile coordinates and zoom into a new Coordinate (longitude,latitude)
 			code from : http://wiki.openstreetmap.org/wiki/Slippy_map_tilenames
 		"""
 		(x,y)=coord
 		n=2.0**zoom
-		self.longitude=x*360.0/n-180.0
 		lat_rad=math.atan(math.sinh(math.pi*(1.0-2.0*y/n)))
-		self.latitude=math.degrees(lat_rad)
+		return tuple.__new__(cls,(x*360.0/n-180.0,math.degrees(lat_rad)))
 
 	def getResolution(self,server,zoom):
-		""" Get resolution (meters per tile)
+		""" Get resolution (meters per pixel)
 			formula from : http://wiki.openstreetmap.org/wiki/Slippy_map_tilenames#Resolution_and_Scale
 		"""
-		lat_rad=math.radians(self.latitude)
+		lat_rad=math.radians(self[1])
 		r=(6378137.0*2.0*math.pi/server.size_x)*math.cos(lat_rad)/(2.0**zoom)
 		return r
 	
 	def distance(self,B):
-		""" Compute distance of the box diagonal, return value in kilometers
+		""" Compute distance to B (a Coordinate or a (longitude,latitude) tuple), return value in kilometers
 			using the simple earth as a sphere method : https://fr.wikipedia.org/wiki/Orthodromie
 			assuming a nautic mile is 1/60 meridian arcand 1 nautic mile is 1852 meters
 		"""
-		lat_radA=math.radians(self.latitude)
-		lat_radB=math.radians(B.latitude)
-		lon_radA=math.radians(self.longitude)
-		lon_radB=math.radians(B.longitude)
-		a=math.sin(lon_radA)*math.sin(lon_radB)
-		b=math.cos(lon_radA)*math.cos(lon_radB)*math.cos(lat_radB-lat_radA)
-		d_rad=math.acos(a+b)
+		lat_radA=math.radians(self[1])
+		lat_radB=math.radians(B[1])
+		a=math.sin(lat_radA)*math.sin(lat_radB)
+		b=math.cos(lat_radA)*math.cos(lat_radB)*math.cos(math.radians(B[0]-self[0]))
+		d_rad=math.acos(max(-1.0,min(1.0,a+b)))
 		d=1.852*60.0*math.degrees(d_rad)
 		return d
-		
+	
+	# operations : other is a number or a (longitude,latitude) tuple (or Coordinate)
 	def __add__(self,other):
-		if (type(other)==int) or (type(other)==float):
-			return Coordinate(self.latitude+other,self.longitude+other)
-		else:
-			return Coordinate(self.latitude+other.latitude,self.longitude+other.longitude)
+		if isinstance(other,tuple):
+			return tuple.__new__(Coordinate,(self[0]+other[0],self[1]+other[1]))
+		return tuple.__new__(Coordinate,(self[0]+other,self[1]+other))
+	
+	__radd__=__add__
 		
 	def __sub__(self,other):
-		if (type(other)==int) or (type(other)==float):
-			return Coordinate(self.latitude-other,self.longitude-other)
-		else:
-			return Coordinate(self.latitude-other.latitude,self.longitude-other.longitude)
+		if isinstance(other,tuple):
+			return tuple.__new__(Coordinate,(self[0]-other[0],self[1]-other[1]))
+		return tuple.__new__(Coordinate,(self[0]-other,self[1]-other))
+	
+	def __neg__(self):
+		return tuple.__new__(Coordinate,(-self[0],-self[1]))
 		
 	def __mul__(self,other):
-		if (type(other)==int) or (type(other)==float):
-			return Coordinate(self.latitude*other,self.longitude*other)
-		else:
-			return Coordinate(self.latitude*other.latitude,self.longitude*other.longitude)
+		if isinstance(other,tuple):
+			return tuple.__new__(Coordinate,(self[0]*other[0],self[1]*other[1]))
+		return tuple.__new__(Coordinate,(self[0]*other,self[1]*other))
+	
+	__rmul__=__mul__
 		
-	def __div__(self,other):
-		if (type(other)==int) or (type(other)==float):
-			return Coordinate(self.latitude/other,self.longitude/other)
-		else:
-			return Coordinate(self.latitude/other.latitude,self.longitude/other.longitude)
+	def __truediv__(self,other):
+		if isinstance(other,tuple):
+			return tuple.__new__(Coordinate,(self[0]/other[0],self[1]/other[1]))
+		return tuple.__new__(Coordinate,(self[0]/other,self[1]/other))
+	
+	__div__=__truediv__
 		
 	def __floordiv__(self,other):
-		if (type(other)==int) or (type(other)==float):
-			return Coordinate(self.latitude/other,self.longitude/other)
-		else:
-			return Coordinate(self.latitude/other.latitude,self.longitude/other.lon)
-		
-	def __truediv__(self,other):
-		if (type(other)==int) or (type(other)==float):
-			return Coordinate(self.latitude/other,self.longitude/other)
-		else:
-			return Coordinate(self.latitude/other.latitude,self.longitude/other.longitude)
+		if isinstance(other,tuple):
+			return tuple.__new__(Coordinate,(self[0]//other[0],self[1]//other[1]))
+		return tuple.__new__(Coordinate,(self[0]//other,self[1]//other))
 
-class BoundingBox():
+class BoundingBox(tuple):
 	""" BoundingBox : handle a box define by geographical coordinates : up/left and bottom/right
 		All coordinates are longitude/latitude (see Coordinate object above)
-		Composed of 2 Coordinate objects
+		Composed of 2 Coordinate objects (immutable : a (leftup,rightdown) tuple)
 	"""
-	def __init__(self,loc0,loc1):
-		if loc0.latitude>loc1.latitude:
-			lat0=loc1.latitude
-			lat1=loc0.latitude
+	__slots__=()
+	
+	def __new__(cls,loc0,loc1):
+		if loc0[0]<=loc1[0]:
+			(lon0,lon1)=(loc0[0],loc1[0])
 		else:
-			lat0=loc0.latitude
-			lat1=loc1.latitude
-		if loc0.longitude>loc1.longitude:
-			lon0=loc1.longitude
-			lon1=loc0.longitude
+			(lon0,lon1)=(loc1[0],loc0[0])
+		if loc0[1]<=loc1[1]:
+			(lat0,lat1)=(loc0[1],loc1[1])
 		else:
-			lon0=loc0.longitude
-			lon1=loc1.longitude
-		self.leftup=Coordinate(lon0,lat0)
-		self.rightdown=Coordinate(lon1,lat1)
+			(lat0,lat1)=(loc1[1],loc0[1])
+		return tuple.__new__(cls,(Coordinate(lon0,lat0),Coordinate(lon1,lat1)))
+	
+	def __getnewargs__(self):
+		return tuple(self)
+	
+	leftup=property(operator.itemgetter(0))
+	rightdown=property(operator.itemgetter(1))
 	
 	def __repr__(self):	
-		return self.leftup+"-"+self.rightdown
+		return "%r-%r" % self
 		
 	def __str__(self):
-		return "%s-%s" % (self.leftup,self.rightdown)
+		return "%s-%s" % self
 		
 	def convert2Tile(self,zoom):
-		(lon0,lat0)=self.leftup.convert2Tile(zoom)
-		(lon1,lat1)=self.rightdown.convert2Tile(zoom)
+		(lon0,lat0)=self[0].convert2Tile(zoom)
+		(lon1,lat1)=self[1].convert2Tile(zoom)
 		return ((lon0,lat1),(lon1,lat0))
 	
 	def distance(self):
 		""" Compute distance of the box diagonal """
-		d=self.leftup.distance(self.rightdown)
-		return d
+		return self[0].distance(self[1])
 		
 	def size(self):
 		""" Compute size (length and height) of the box """
-		a2=Coordinate(self.leftup.longitude,self.rightdown.latitude)
-		b2=Coordinate(self.rightdown.longitude,self.leftup.latitude)
-		l=self.leftup.distance(a2)
-		h=self.leftup.distance(b2)
+		(lu,rd)=self
+		l=lu.distance((rd[0],lu[1]))
+		h=lu.distance((lu[0],rd[1]))
 		return(l,h)
+
+# vectorized conversions : arrays of N points at once (numpy), same formulas as Coordinate
+# sequences are accepted, without numpy the conversion is done point by point (lists)
+
+def lonlat2tile(lon,lat,zoom):
+	""" convert longitudes,latitudes arrays into (float) tile coordinates arrays (x,y) at zoom """
+	n=2.0**zoom
+	if numpy is None:
+		xy=[Coordinate(a,b).convert2Tile(zoom) for (a,b) in zip(lon,lat)]
+		return ([p[0] for p in xy],[p[1] for p in xy])
+	lat_rad=numpy.radians(numpy.asarray(lat,dtype=numpy.float64))
+	x=(numpy.asarray(lon,dtype=numpy.float64)+180.0)*n/360.0
+	y=(1.0-numpy.log(numpy.tan(lat_rad)+1.0/numpy.cos(lat_rad))/math.pi)*n/2.0
+	return (x,y)
+
+def tile2lonlat(x,y,zoom):
+	""" convert (float) tile coordinates arrays into longitudes,latitudes arrays at zoom """
+	n=2.0**zoom
+	if numpy is None:
+		ll=[Coordinate.fromTile(p,zoom) for p in zip(x,y)]
+		return ([p[0] for p in ll],[p[1] for p in ll])
+	lon=numpy.asarray(x,dtype=numpy.float64)*360.0/n-180.0
+	lat=numpy.degrees(numpy.arctan(numpy.sinh(math.pi*(1.0-2.0*numpy.asarray(y,dtype=numpy.float64)/n))))
+	return (lon,lat)
+
+def lonlat2pixel(lon,lat,zoom,origin,tile_size):
+	""" convert longitudes,latitudes arrays into pixels arrays (px,py) of a map starting at tile origin (x0,y0) 
+		with tile_size (width,height) pixels tiles
+	"""
+	(x,y)=lonlat2tile(lon,lat,zoom)
+	if numpy is None:
+		return ([(v-origin[0])*tile_size[0] for v in x],[(v-origin[1])*tile_size[1] for v in y])
+	return ((x-origin[0])*tile_size[0],(y-origin[1])*tile_size[1])
+
+def pixel2lonlat(px,py,zoom,origin,tile_size):
+	""" convert pixels arrays of a map (see lonlat2pixel) into longitudes,latitudes arrays """
+	if numpy is None:
+		return tile2lonlat([origin[0]+v/tile_size[0] for v in px],[origin[1]+v/tile_size[1] for v in py],zoom)
+	return tile2lonlat(origin[0]+numpy.asarray(px,dtype=numpy.float64)/tile_size[0],origin[1]+numpy.asarray(py,dtype=numpy.float64)/tile_size[1],zoom)
+
+def resolution(lat,zoom,tile_size=config.default_tile_size):
+	""" resolution (meters per pixel) array for latitudes array at zoom, see Coordinate.getResolution """
+	r=6378137.0*2.0*math.pi/tile_size/(2.0**zoom)
+	if numpy is None:
+		return [r*math.cos(math.radians(v)) for v in lat]
+	return r*numpy.cos(numpy.radians(numpy.asarray(lat,dtype=numpy.float64)))
+
+def tileRanges(lon0,lat0,lon1,lat1,zoom):
+	""" tile ranges of boxes arrays (corners longitude,latitude) at zoom or zooms array, 
+		return (x0,y0,x1,y1) integer arrays (inclusive, x0<=x1 and y0<=y1) 
+	"""
+	if numpy is None:
+		if not isinstance(zoom,(list,tuple)):
+			zoom=[zoom]*len(lon0)
+		r=[]
+		for (a,b,c,d,z) in zip(lon0,lat0,lon1,lat1,zoom):
+			((tx0,ty0),(tx1,ty1))=BoundingBox(Coordinate(a,b),Coordinate(c,d)).convert2Tile(z)
+			r.append((int(tx0),int(ty0),int(tx1),int(ty1)))
+		return tuple([[t[i] for t in r] for i in range(4)])
+	zoom=numpy.asarray(zoom,dtype=numpy.float64)
+	(xa,ya)=lonlat2tile(lon0,lat0,zoom)
+	(xb,yb)=lonlat2tile(lon1,lat1,zoom)
+	return (numpy.minimum(xa,xb).astype(numpy.int64),numpy.minimum(ya,yb).astype(numpy.int64),
+			numpy.maximum(xa,xb).astype(numpy.int64),numpy.maximum(ya,yb).astype(numpy.int64))
+
+def boxTiles(box,zoom):
+	""" all the tiles of a box at zoom : (x,y) integer arrays (row by row, same order as enumTiles) """
+	(x0,y0,x1,y1)=[int(v[0]) for v in tileRanges([box.leftup.longitude],[box.leftup.latitude],[box.rightdown.longitude],[box.rightdown.latitude],zoom)]
+	if numpy is None:
+		t=[(x,y) for y in range(y0,y1+1) for x in range(x0,x1+1)]
+		return ([p[0] for p in t],[p[1] for p in t])
+	(y,x)=numpy.mgrid[y0:y1+1,x0:x1+1]
+	return (x.ravel(),y.ravel())
+
+class Points():
+	""" Points : an array of N locations (longitude/latitude), companion of Coordinate for bulk operations
+		stored as 2 arrays (numpy, or lists without numpy), conversions are vectorized (see lonlat2tile)
+	"""
+	__slots__=("lon","lat")
+	
+	def __init__(self,lon=(),lat=()):
+		if numpy is None:
+			self.lon=[float(v) for v in lon]
+			self.lat=[float(v) for v in lat]
+		else:
+			self.lon=numpy.asarray(lon,dtype=numpy.float64)
+			self.lat=numpy.asarray(lat,dtype=numpy.float64)
+	
+	@classmethod
+	def fromCoordinates(cls,locations):
+		""" build from a list of Coordinate (or any (longitude,latitude,...) sequences) """
+		return cls([p[0] for p in locations],[p[1] for p in locations])
+	
+	def __repr__(self):
+		return "<Points %d>" % len(self)
+	
+	def __len__(self):
+		return len(self.lon)
+	
+	def __getitem__(self,i):
+		return Coordinate(float(self.lon[i]),float(self.lat[i]))
+	
+	def getBox(self):
+		return BoundingBox((min(self.lon),max(self.lat)),(max(self.lon),min(self.lat)))
+	
+	def convert2Tile(self,zoom):
+		""" tile coordinates arrays (x,y) at zoom """
+		return lonlat2tile(self.lon,self.lat,zoom)
+	
+	def convert2Pixel(self,zoom,origin,tile_size):
+		""" pixels arrays (px,py) of a map starting at tile origin, see lonlat2pixel """
+		return lonlat2pixel(self.lon,self.lat,zoom,origin,tile_size)
+	
+	def getResolution(self,server,zoom):
+		""" resolution (meters per pixel) array, see Coordinate.getResolution """
+		return resolution(self.lat,zoom,server.size_x)
+
+class Polygon():
+	""" Polygon : an area defined by rings of Coordinate (longitude/latitude), each ring is closed (last point linked to first)
+		several rings handle holes and multipolygons (even-odd rule : a point inside 2 rings is outside)
+		used to clip tiles to an area (see enumTiles) and to mask assembled maps (see BigTileMap.setClip)
+	"""
+	def __init__(self,points=None):
+		self.rings=[]
+		if points:
+			self.addRing(points)
+	
+	def __repr__(self):
+		return "<Polygon %d ring(s), %d points>" % (len(self.rings),sum([len(r) for r in self.rings]))
+	
+	def __len__(self):
+		return len(self.rings)
+	
+	def addRing(self,points):
+		""" add a ring (list of Coordinate) : an outer ring or a hole """
+		if len(points)>1 and points[0].longitude==points[-1].longitude and points[0].latitude==points[-1].latitude:
+			points=points[:-1]		# closed ring (GeoJSON)
+		if len(points)>=3:
+			self.rings.append(points)
+	
+	def getBox(self):
+		""" the bounding box of the polygon """
+		lon=[p.longitude for r in self.rings for p in r]
+		lat=[p.latitude for r in self.rings for p in r]
+		return BoundingBox(Coordinate(min(lon),max(lat)),Coordinate(max(lon),min(lat)))
+	
+	def convert2Tile(self,zoom):
+		""" return the rings as lists of (x,y) float tile coordinates """
+		return [[p.convert2Tile(zoom) for p in r] for r in self.rings]
+	
+	def tileSpans(self,zoom):
+		""" return the tiles intersecting the polygon at zoom : a dict tile row (y) : list of (xmin,xmax) ranges (may overlap)
+			computed by scanlines : tiles crossed by an edge + tiles inside (center line crossings, even-odd)
+			cost is proportional to the perimeter and the area (not to the bounding box)
+		"""
+		spans={}
+		crossings={}
+		for ring in self.convert2Tile(zoom):
+			n=len(ring)
+			for i in range(n):
+				(ax,ay)=ring[i-1]
+				(bx,by)=ring[i]
+				(ylo,yhi)=(min(ay,by),max(ay,by))
+				for r in range(int(math.floor(ylo)),int(math.floor(yhi))+1):
+					# part of the edge inside the row : tiles crossed
+					if ay==by:
+						(xa,xb)=(ax,bx)
+					else:
+						xa=ax+(max(r,ylo)-ay)*(bx-ax)/(by-ay)
+						xb=ax+(min(r+1,yhi)-ay)*(bx-ax)/(by-ay)
+					spans.setdefault(r,[]).append((int(math.floor(min(xa,xb))),int(math.floor(max(xa,xb)))))
+					# crossing with the row center line
+					yc=r+0.5
+					if (ay>yc)!=(by>yc):
+						crossings.setdefault(r,[]).append(ax+(yc-ay)*(bx-ax)/(by-ay))
+		for (r,xs) in crossings.items():
+			xs.sort()
+			for i in range(0,len(xs)-1,2):	# tiles whose center is inside
+				spans.setdefault(r,[]).append((int(math.ceil(xs[i]-0.5)),int(math.floor(xs[i+1]-0.5))))
+		return spans
+	
+	def getMask(self,size,zoom,origin,tile_size):
+		""" return a mask image ("1" mode, size in pixels) of the polygon, 
+			origin is the tile (x0,y0) at pixel (0,0), tile_size is (width,height) in pixels
+		"""
+		mask=Image.new("1",size,0)
+		for ring in self.convert2Tile(zoom):		# even-odd : holes and multipolygons
+			pts=[((x-origin[0])*tile_size[0],(y-origin[1])*tile_size[1]) for (x,y) in ring]
+			m=Image.new("1",size,0)
+			ImageDraw.Draw(m).polygon(pts,fill=1)
+			mask=ImageChops.logical_xor(mask,m)
+		return mask
+	
+	def toJSON(self):
+		""" rings as lists of [longitude,latitude] (json) """
+		return [[[p.longitude,p.latitude] for p in r] for r in self.rings]
+
+def geojsonPolygon(geojson,polygon=None):
+	""" build (or extend) a Polygon from GeoJSON data (dict) : 
+		FeatureCollection, Feature, Polygon, MultiPolygon or GeometryCollection, other geometries are ignored
+		return None if no polygon found
+	"""
+	if polygon==None:
+		polygon=Polygon()
+	t=geojson.get('type')
+	if t=='FeatureCollection':
+		for f in geojson.get('features',[]):
+			geojsonPolygon(f,polygon)
+	elif t=='Feature':
+		if geojson.get('geometry'):
+			geojsonPolygon(geojson['geometry'],polygon)
+	elif t=='GeometryCollection':
+		for g in geojson.get('geometries',[]):
+			geojsonPolygon(g,polygon)
+	elif t=='Polygon':
+		for ring in geojson['coordinates']:
+			polygon.addRing([Coordinate(p[0],p[1]) for p in ring])
+	elif t=='MultiPolygon':
+		for poly in geojson['coordinates']:
+			for ring in poly:
+				polygon.addRing([Coordinate(p[0],p[1]) for p in ring])
+	if len(polygon)==0:
+		return None
+	return polygon
+
+def LoadGeoJSON(filename):
+	""" load a polygon from a GeoJSON file, return None if no polygon """
+	try:
+		with codecs.open(filename,'r',encoding='utf-8') as f:
+			return geojsonPolygon(json.load(f))
+	except (IOError,ValueError,KeyError,IndexError,TypeError) as e:
+		print("loading",filename,"error:",e)
+		return None
+
+class Corridor():
+	""" Corridor : the area within a distance (buffer, in meters) of a track (lines of Coordinate)
+		same interface as Polygon (getBox, tileSpans, getMask, toJSON) to clip tiles and maps along a route
+	"""
+	def __init__(self,lines,buffer=None):
+		if buffer==None:
+			buffer=config.default_buffer
+		self.lines=[l for l in lines if len(l)>0]
+		self.buffer=buffer
+	
+	def __repr__(self):
+		return "<Corridor %d line(s), %d points, %d m>" % (len(self.lines),sum([len(l) for l in self.lines]),self.buffer)
+	
+	def __len__(self):
+		return len(self.lines)
+	
+	def getBox(self):
+		""" the bounding box of the corridor (track box + buffer) """
+		lon=[p.longitude for l in self.lines for p in l]
+		lat=[p.latitude for l in self.lines for p in l]
+		dlat=math.degrees(self.buffer/6378137.0)
+		dlon=dlat/max(0.01,math.cos(math.radians(max([abs(v) for v in lat]))))
+		return BoundingBox(Coordinate(min(lon)-dlon,max(lat)+dlat),Coordinate(max(lon)+dlon,min(lat)-dlat))
+	
+	def getBuffer(self,latitude,zoom):
+		""" buffer in tile units at a latitude and zoom """
+		return self.buffer*(2.0**zoom)/(2.0*math.pi*6378137.0*max(0.01,math.cos(math.radians(latitude))))
+	
+	def segments(self,zoom):
+		""" return the track as segments in tile coordinates : (a,b,buffer) """
+		segs=[]
+		for l in self.lines:
+			p=Points.fromCoordinates(l)
+			(x,y)=p.convert2Tile(zoom)
+			pts=[((float(x[i]),float(y[i])),float(p.lat[i])) for i in range(len(l))]
+			if len(pts)==1:
+				pts.append(pts[0])
+			for i in range(1,len(pts)):
+				((a,lata),(b,latb))=(pts[i-1],pts[i])
+				segs.append((a,b,self.getBuffer((lata+latb)/2.0,zoom)))
+		return segs
+	
+	def tileSpans(self,zoom):
+		""" return the tiles within the corridor at zoom : a dict tile row (y) : list of (xmin,xmax) ranges
+			only tiles near each segment are tested (cost is proportional to the corridor area)
+		"""
+		spans={}
+		for (a,b,d) in self.segments(zoom):
+			for y in range(int(math.floor(min(a[1],b[1])-d)),int(math.floor(max(a[1],b[1])+d))+1):
+				xs=[x for x in range(int(math.floor(min(a[0],b[0])-d)),int(math.floor(max(a[0],b[0])+d))+1) if rectSegmentDistance(x,y,x+1,y+1,a,b)<=d]
+				if xs:
+					spans.setdefault(y,[]).append((xs[0],xs[-1]))
+		return spans
+	
+	def getMask(self,size,zoom,origin,tile_size):
+		""" return a mask image ("1" mode, size in pixels) of the corridor, see Polygon.getMask """
+		mask=Image.new("1",size,0)
+		draw=ImageDraw.Draw(mask)
+		for (a,b,d) in self.segments(zoom):
+			pa=((a[0]-origin[0])*tile_size[0],(a[1]-origin[1])*tile_size[1])
+			pb=((b[0]-origin[0])*tile_size[0],(b[1]-origin[1])*tile_size[1])
+			r=d*tile_size[0]
+			draw.line((pa,pb),fill=1,width=int(2*r+0.5))
+			for (px,py) in (pa,pb):		# round joints
+				draw.ellipse((px-r,py-r,px+r,py+r),fill=1)
+		return mask
+	
+	def pages(self,zoom,page):
+		""" split the track into pages of page=(width,height) tiles, following the route
+			return a list of tile ranges ((x0,y0),(x1,y1))
+		"""
+		pages=[]
+		for l in self.lines:
+			# points in tile coordinates, long segments are divided (at most a quarter of page)
+			step=max(0.5,min(page)/4.0)
+			pts=[]
+			for p in l:
+				q=p.convert2Tile(zoom)
+				if pts:
+					(px,py)=pts[-1]
+					n=int(math.hypot(q[0]-px,q[1]-py)/step)
+					for k in range(1,n+1):
+						pts.append((px+(q[0]-px)*k/(n+1),py+(q[1]-py)*k/(n+1)))
+				pts.append(q)
+			d=self.getBuffer(l[0].latitude,zoom)
+			bounds=None
+			for (x,y) in pts:
+				if bounds:
+					b=(min(bounds[0],x),min(bounds[1],y),max(bounds[2],x),max(bounds[3],y))
+					if b[2]-b[0]+2*d>page[0]-1 or b[3]-b[1]+2*d>page[1]-1:		# page full : next page from the last point
+						pages.append(bounds)
+						b=(last[0],last[1],last[0],last[1])
+						b=(min(b[0],x),min(b[1],y),max(b[2],x),max(b[3],y))
+					bounds=b
+				else:
+					bounds=(x,y,x,y)
+				last=(x,y)
+			if bounds:
+				pages.append(bounds)
+		ranges=[]
+		for (bx0,by0,bx1,by1) in pages:	# center each page on its part of the track
+			x0=int(math.floor((bx0+bx1)/2.0-page[0]/2.0+0.5))
+			y0=int(math.floor((by0+by1)/2.0-page[1]/2.0+0.5))
+			ranges.append(((x0,y0),(x0+page[0]-1,y0+page[1]-1)))
+		return ranges
+	
+	def toJSON(self):
+		""" track and buffer (json) """
+		return {'track':[[[p.longitude,p.latitude] for p in l] for l in self.lines],'buffer':self.buffer}
+
+def rectSegmentDistance(x0,y0,x1,y1,a,b):
+	""" distance between rectangle (x0,y0)-(x1,y1) and segment [a,b] (0 if they intersect) """
+	(dx,dy)=(b[0]-a[0],b[1]-a[1])
+	# segment clipped by the rectangle (Liang-Barsky) : intersect
+	(t0,t1)=(0.0,1.0)
+	inside=True
+	for (p,q) in ((-dx,a[0]-x0),(dx,x1-a[0]),(-dy,a[1]-y0),(dy,y1-a[1])):
+		if p==0:
+			if q<0:
+				inside=False
+		else:
+			r=1.0*q/p
+			if p<0:
+				t0=max(t0,r)
+			else:
+				t1=min(t1,r)
+	if inside and t0<=t1:
+		return 0.0
+	# disjoint : closest points are a segment end or a rectangle corner
+	d=min([math.hypot(p[0]-max(x0,min(x1,p[0])),p[1]-max(y0,min(y1,p[1]))) for p in (a,b)])
+	l2=dx*dx+dy*dy
+	for (cx,cy) in ((x0,y0),(x1,y0),(x1,y1),(x0,y1)):
+		t=0.0
+		if l2>0:
+			t=max(0.0,min(1.0,((cx-a[0])*dx+(cy-a[1])*dy)/l2))
+		d=min(d,math.hypot(cx-a[0]-t*dx,cy-a[1]-t*dy))
+	return d
+
+def geojsonLines(geojson,lines=None):
+	""" extract lines (lists of Coordinate) from GeoJSON data (dict) : LineString and MultiLineString
+		(in FeatureCollection, Feature or GeometryCollection)
+	"""
+	if lines==None:
+		lines=[]
+	t=geojson.get('type')
+	if t=='FeatureCollection':
+		for f in geojson.get('features',[]):
+			geojsonLines(f,lines)
+	elif t=='Feature':
+		if geojson.get('geometry'):
+			geojsonLines(geojson['geometry'],lines)
+	elif t=='GeometryCollection':
+		for g in geojson.get('geometries',[]):
+			geojsonLines(g,lines)
+	elif t=='LineString':
+		lines.append([Coordinate(p[0],p[1]) for p in geojson['coordinates']])
+	elif t=='MultiLineString':
+		for l in geojson['coordinates']:
+			lines.append([Coordinate(p[0],p[1]) for p in l])
+	return lines
+
+def LoadTrack(filename):
+	""" load a track from a GPX (tracks segments and routes) or GeoJSON (lines) file
+		return a list of lines (lists of Coordinate), empty if none
+	"""
+	lines=[]
+	try:
+		if os.path.splitext(filename)[1].lower()==".gpx":
+			root=ET.parse(filename).getroot()
+			for e in root.iter():
+				tag=e.tag.split('}')[-1]		# without namespace
+				if tag in ('trkseg','rte'):
+					line=[Coordinate(float(p.attrib['lon']),float(p.attrib['lat'])) for p in e if p.tag.split('}')[-1] in ('trkpt','rtept')]
+					if line:
+						lines.append(line)
+		else:
+			with codecs.open(filename,'r',encoding='utf-8') as f:
+				lines=geojsonLines(json.load(f))
+	except (IOError,ValueError,KeyError,IndexError,TypeError,ET.ParseError) as e:
+		print("loading",filename,"error:",e)
+		lines=[]
+	return lines
+
+def mergeSpans(ranges,x0,x1):
+	""" merge (xmin,xmax) ranges, clipped to x0-x1, return sorted disjoint ranges """
+	merged=[]
+	for (a,b) in sorted(ranges):
+		(a,b)=(max(a,x0),min(b,x1))
+		if a>b:
+			continue
+		if merged and a<=merged[-1][1]+1:
+			if b>merged[-1][1]:
+				merged[-1]=(merged[-1][0],b)
+		else:
+			merged.append((a,b))
+	return merged
+
+def enumTiles(box,zoom,polygon=None):
+	""" enumerate lazily (generator) tiles (x,y) inside a box at zoom, 
+		and intersecting the polygon (if any)
+		the box tiles are enumerated at once (see boxTiles)
+	"""
+	if polygon:
+		(x0,y0,x1,y1)=[int(v[0]) for v in tileRanges([box.leftup.longitude],[box.leftup.latitude],[box.rightdown.longitude],[box.rightdown.latitude],zoom)]
+		spans=polygon.tileSpans(zoom)
+		for y in range(y0,y1+1):
+			for (a,b) in mergeSpans(spans.get(y,[]),x0,x1):
+				for x in range(a,b+1):
+					yield (x,y)
+	else:
+		(xs,ys)=boxTiles(box,zoom)
+		for (x,y) in zip(xs,ys):
+			yield (int(x),int(y))
 		
 class Cache():
 	"""	Cache : handle the local cache to avoid downloading many times the same tile image
 		cache has a maximum size (max_size in bytes) and images cached has a max delay (validity)
+		an index of cached files (name : (ctime,size)) is built on the first scan (see clear), 
+		then kept up to date by store : no more disk access to check tiles
 	"""
 	def __init__(self,folder,max_size,delay):
 		self.folder=folder
 		self.use_cache=True
 		self.max_size=max_size
 		self.delay=delay
+		self.listeners=[]		# functions called when a tile file is stored (with its file name)
+		self.index=None			# file name : (ctime,size), None until the folder is scanned
+		self.index_size=0		# total size of indexed files
+		self.lock=threading.Lock()
 
 		# Just check is cache folder exist, create it if not
 		if not os.path.exists(self.folder):
@@ -336,6 +909,34 @@ class Cache():
 		""" activate cache handling """
 		self.use_cache=use_cache
 		
+	def addListener(self,func):
+		""" func(fname) will be called (from loading threads) each time a tile file is stored """
+		if func not in self.listeners:
+			self.listeners.append(func)
+	
+	def removeListener(self,func):
+		if func in self.listeners:
+			self.listeners.remove(func)
+	
+	def store(self,fpath,data):
+		""" store a tile into the cache : data is raw file data or a PIL image, then notify listeners """
+		if isinstance(data,Image.Image):
+			data.save(fpath)
+		else:
+			f=open(fpath,"wb")
+			f.write(data)
+			f.close()
+		fname=os.path.basename(fpath)
+		with self.lock:
+			if self.index!=None:
+				if fname in self.index:
+					self.index_size-=self.index[fname][1]
+				s=os.path.getsize(fpath)
+				self.index[fname]=(time.time(),s)
+				self.index_size+=s
+		for func in self.listeners:
+			func(fname)
+	
 	def buildpath(self,fname):
 		""" return a valid path to cache image """
 		return os.path.join(self.folder,fname)
@@ -343,56 +944,112 @@ class Cache():
 	def incache(self,fpath):
 		""" return True is image is allready in cache and is valid """
 		if self.use_cache:
+			if self.index!=None:
+				entry=self.index.get(os.path.basename(fpath))
+				if entry:
+					return time.time()-entry[0]<=self.delay
+				return False
 			if os.path.isfile(fpath):
 				dt=time.time()-os.path.getctime(fpath)
 				if dt<=self.delay:	# reload tile if age exceeds cache delay
 					return True
 		return False
-		
-	def getSize(self):
-		""" return the current cache size """
+	
+	def scan(self):
+		""" build the index of cached files (one pass on the folder) """
+		index={}
 		tsize=0
 		for o in os.listdir(self.folder):
 			f=os.path.join(self.folder,o)
 			if os.path.isfile(f):
-				tsize+=os.path.getsize(f)
-		return tsize
+				s=os.path.getsize(f)
+				index[o]=(os.path.getctime(f),s)
+				tsize+=s
+		with self.lock:
+			self.index=index
+			self.index_size=tsize
+		
+	def getSize(self):
+		""" return the current cache size """
+		if self.index==None:
+			self.scan()
+		return self.index_size
+		
+	def remove(self,fname):
+		""" remove a file from the cache (and the index) """
+		os.remove(os.path.join(self.folder,fname))
+		with self.lock:
+			entry=self.index.pop(fname,None)
+			if entry:
+				self.index_size-=entry[1]
 		
 	def clear(self):
 		""" Clean the tile cache : remove old tiles 
 				- tiles older than delay
 				- tiles oldest when total cache size exceed limit
 		"""
+		self.scan()
 		# remove unvalid files (delay)
-		for o in os.listdir(self.folder):
-			f=os.path.join(self.folder,o)
-			if os.path.isfile(f):
-				s=os.path.getsize(f)
-				dt=time.time()-os.path.getctime(f)
-				if dt>self.delay:
-					os.remove(f)
+		now=time.time()
+		for (o,(d,s)) in list(self.index.items()):
+			if now-d>self.delay:
+				self.remove(o)
 		# if total size too large, remove older ones
-		sz=0
-		list=[]
-		for o in os.listdir(self.folder):
-			f=os.path.join(self.folder,o)
-			if os.path.isfile(f):
-				d=os.path.getctime(f)
-				s=os.path.getsize(f)
-				sz+=s
-				list.append((f,d,s))
-		if sz>self.max_size:	# if total size greatest than limit, sort by date and remove oldest
-			print("Cache too big, need cleaning :",ByteSize(sz))
-			list=sorted(list,key=lambda tup:tup[1])
+		if self.index_size>self.max_size:	# if total size greatest than limit, sort by date and remove oldest
+			print("Cache too big, need cleaning :",ByteSize(self.index_size))
+			list_files=sorted(self.index.items(),key=lambda tup:tup[1][0])
 			i=0
-			while sz>self.max_size:
-				e=list[i]
-				os.remove(e[0])
-				sz-=e[2]
+			while self.index_size>self.max_size:
+				self.remove(list_files[i][0])
 				i+=1
 	
 	def __repr__(self):
 		return  "%s / %s" % (ByteSize(self.getSize()),ByteSize(self.max_size))
+
+class TileMemCache():
+	""" memory cache of tile images (LRU) : file name : PIL image, thread-safe
+		can be shared by several BigTileMap (see BigTileMap.setMemCache)
+	"""
+	def __init__(self,size=None):
+		if size==None:
+			size=config.mem_cache
+		self.size=size
+		self.tiles=collections.OrderedDict()
+		self.lock=threading.Lock()
+	
+	def __len__(self):
+		return len(self.tiles)
+	
+	def get(self,fname):
+		with self.lock:
+			im=self.tiles.get(fname)
+			if im is not None:
+				self.tiles.move_to_end(fname)
+			return im
+	
+	def put(self,fname,im):
+		with self.lock:
+			self.tiles[fname]=im
+			self.tiles.move_to_end(fname)
+			while len(self.tiles)>self.size:
+				self.tiles.popitem(last=False)
+	
+	def discard(self,fnames):
+		""" forget tiles (file names set) """
+		with self.lock:
+			for fname in fnames:
+				self.tiles.pop(fname,None)
+	
+	def keys(self):
+		""" tiles file names, least recently used first """
+		with self.lock:
+			return [k for k in self.tiles.keys() if type(k)==str]
+	
+	def discardServer(self,name):
+		""" forget tiles of a server (and tiles composed with them) """
+		with self.lock:
+			for k in [k for k in self.tiles if tileKeyServer(k,name)]:
+				del self.tiles[k]
 		
 class ByteSize():
 	""" Convert byte size (integer) into a human readable size
@@ -446,6 +1103,8 @@ class TileServer():
 		self.render_size_y=config.default_tile_size		# rendering tile pixels height
 		self.tile_copyright=""		# tile copyright
 		self.data_copyright=""		# data copyright
+		self.opacity=1.0			# default opacity (for overlay)
+		self.blend="normal"			# default blend mode (for overlay), see blend_modes
 		self.handleDate=False		# can handle date (default is FALSE)
 		self.handleHour=False		# can handle date with hour (default is FALSE)
 		self.handleTimeShift=False		# can handle timeshift (default is FALSE)
@@ -454,15 +1113,14 @@ class TileServer():
 		self.timeshift_value=[]
 		self.timeshift_string=[]
 		self.server_list=None		
-		self.current=0	
+		self.retired=False			# the server was replaced or removed (see Catalog.reload)
+		self.compileUrl()
 		
 	def setServer(self,base_url,subdomain=None,delay=0):
 		self.base_url=base_url
 		self.server_list=subdomain
-		self.handleDate="{d}" in base_url
-		self.handleHour="{dt}" in base_url
-		self.handleTimeShift="{t}" in base_url
 		self.dateDelay=delay
+		self.compileUrl()
 		
 	def setZoom(self,min,max):
 		self.min_zoom=min
@@ -477,6 +1135,7 @@ class TileServer():
 		
 	def setAPI(self,key=""):
 		self.api_key=key
+		self.compileUrl()
 		
 	def setFormat(self,fmt="PNG",mode="RGB"):
 		self.format=fmt
@@ -487,6 +1146,11 @@ class TileServer():
 		elif fmt=="GIF":
 			self.extension="gif"
 		
+	def setBlend(self,opacity=1.0,blend="normal"):
+		""" default opacity and blend mode used when the map is an overlay """
+		self.opacity=opacity
+		self.blend=blend
+		
 	def setTimeShift(self,ts_val,ts_str):
 		self.timeshift_value=ts_val
 		self.timeshift_string=ts_str
@@ -546,7 +1210,7 @@ class TileServer():
 		""" return the tile url for this server according to parameters :
 				coord : tile coordinates : Coordinates object (x,y)
 				zoom : zoom value : integer
-				date (optionnal) : time.struct_time
+				date (optionnal) : time.struct_time (or YYYY-MM-DD string)
 				timeshift (optionnal), an index for multiple values : integer
 			and specific format for this server using special url-tags :
 				{x} {lon}				: longitude (in tile geometry, integer)
@@ -562,76 +1226,120 @@ class TileServer():
 				{dt} 	 				: date (YYYY-MM-DDTHH:MM)
 				{t}						: time step, value in time_step tag, passed as date
 			note: {x}, {y} and {z} (or {q}) are mandatory, other optional depending of server settings
+			the url is compiled once (see compileUrl), date and timeshift values are computed once per request (see urlParams)
 		"""
+		if self.url_format==None:
+			if not self.url_warned:
+				print("error, malformed server base url for %s\n%s\n%s" % (self.name,self.base_url,self.url_error))
+				self.url_warned=True
+			return self.base_url
 		(tx,ty)=coord
-		try:
-			coords=0
-			url=self.base_url
-			if url.find("{x}")>=0 or url.find("{lon}")>=0:
-				url=url.replace("{x}","%d" % tx)
-				url=url.replace("{lon}","%d" % tx)
-				coords+=1
-			if url.find("{y}")>=0 or url.find("{lat}")>=0:
-				url=url.replace("{y}","%d" % ty)
-				url=url.replace("{lat}","%d" % ty)
-				coords+=1
-			if url.find("{z}")>=0 or url.find("{zoom}")>=0:
-				url=url.replace("{z}","%d" % zoom)
-				url=url.replace("{zoom}","%d" % zoom)
-				coords+=1
-			if url.find("{d}")>=0 or url.find("{date}")>=0:
-				if date==None:		# no date, take current data-time
-					date=localtime(time.time()-config.default_day_offset)
-				t=time.mktime(date)
-				if self.dateDelay!=0:
-					if _debug: print("date/delay:",date,self.dateDelay)
-					t=t+24.0*self.dateDelay*3600.0
-				s=time.strftime("%Y-%m-%d",time.localtime(t))
-				if _debug: print("final date:",s)
-				url=url.replace("{date}","%s" % s)
-				url=url.replace("{d}","%s" % s)
-			if url.find("{dt}")>=0:
-				if date==None:		# no date, take current data-time
-					date=localtime(time.time()-config.default_day_offset)
-				t=time.mktime(date)
-				if self.dateDelay!=0:
-					if _debug: print("date/delay:",date,self.dateDelay)
-					t=t+24.0*self.dateDelay*3600.0
-				s=time.strftime("%Y-%m-%dT%H:%M",time.localtime(t))
-				url=url.replace("{dt}","%s" % s)
-			if url.find("{t}")>=0:
-				if timeshift==None:
-					timeshift=0
-				url=url.replace("{t}","%s" % self.timeshift_value[timeshift])
-			if url.find("{q}")>=0:	# compute bing quadkey
-				q=tilexy2quadkey(tx,ty,zoom)
-				url=url.replace("{q}",q)
-				coords+=3
-			if url.find("{s}")>=0:
-				if self.server_list:
-					url=url.replace("{s}",self.server_list[self.current])
-					self.current=self.current+1
-					if self.current>=len(self.server_list):
-						self.current=0
+		if self.url_quadkey:
+			q=tilexy2quadkey(tx,ty,zoom)
+		else:
+			q=""
+		if self.url_cycle:
+			s=next(self.url_cycle)
+		else:
+			s=""
+		return self.url_format(x=tx,y=ty,z=zoom,q=q,s=s,w=(tx%4)+4*(ty%4),g=(tx+ty)%4,**self.urlParams(date,timeshift))
+	
+	def compileUrl(self):
+		""" compile base_url into a format string (once, when the server is set) : 
+			tags aliases are normalized, constant tags (api key, app identifier) are substituted 
+			and the url is checked, if malformed url_error is set and url_format is None
+		"""
+		self.url_format=None
+		self.url_error=None
+		self.url_warned=False
+		self.url_params=None
+		self.url_cycle=None
+		parts=[]
+		tags=set()
+		pos=0
+		for m in url_tag_re.finditer(self.base_url):
+			parts.append(self.base_url[pos:m.start()].replace("{","{{").replace("}","}}"))
+			pos=m.end()
+			tag=url_tags.get(m.group(1))
+			if tag==None:
+				self.url_error="unknown tag %s" % m.group(0)
+			elif tag in ("apikey","appid"):
+				i=("apikey","appid").index(tag)
+				if not self.api_key or not self.api_key[i]:
+					self.url_error="%s tag without api key" % m.group(0)
 				else:
-					raise
-			if url.find("{w}")>=0:
-				n=(tx%4)+4*(ty%4)
-				url=url.replace('{w}','%d' % n)
-			if url.find("{g}")>=0:
-				n=(tx+ty)%4
-				url=url.replace('{g}','%d' % n)
-			if url.find("{apikey}")>=0 or url.find("{api}")>=0:
-				url=url.replace("{apikey}",self.api_key[0])
-				url=url.replace("{api}",self.api_key[0])
-			if url.find("{appid}")>=0:
-				url=url.replace("{appid}",self.api_key[1])
-			if coords<3:	# test we got 3 coordinates params (x,y and z)
-				raise
-		except:
-			print("error, malformed server base url for %s\n%s\n%s" % (self.name,self.base_url,sys.exc_info()))
-		return url
+					parts.append(self.api_key[i].replace("{","{{").replace("}","}}"))
+			else:
+				tags.add(tag)
+				parts.append("{%s}" % tag)
+		parts.append(self.base_url[pos:].replace("{","{{").replace("}","}}"))
+		if not ({"x","y","z"}<=tags or "q" in tags):	# test we got 3 coordinates params (x,y and z)
+			self.url_error="require {x}, {y} and {z} (or {q}) tags"
+		if "s" in tags:
+			if self.server_list:
+				self.url_cycle=itertools.cycle(self.server_list)
+			else:
+				self.url_error="{s} tag without subdomains"
+		self.url_tags=frozenset(tags)
+		self.url_quadkey="q" in tags
+		self.handleDate="d" in tags
+		self.handleHour="dt" in tags
+		self.handleTimeShift="t" in tags
+		if self.url_error==None:
+			self.url_format="".join(parts).format
+	
+	def urlParams(self,date=None,timeshift=None):
+		""" return the url values depending on the request : date and timeshift (a dict), 
+			computed once and cached for the request (the current date is refreshed every hour)
+		"""
+		if date==None:
+			key=(None,timeshift,int(time.time()/3600.0))
+		else:
+			key=(date,timeshift)
+		cached=self.url_params
+		if cached and cached[0]==key:
+			return cached[1]
+		params={}
+		if self.handleDate or self.handleHour:
+			if date==None:		# no date, take current data-time
+				date=time.localtime(time.time()-config.default_day_offset)
+			elif isinstance(date,str):
+				date=time.strptime(date,"%Y-%m-%d")
+			t=time.mktime(date)+24.0*self.dateDelay*3600.0
+			if _debug: print("date/delay:",date,self.dateDelay)
+			params["d"]=time.strftime("%Y-%m-%d",time.localtime(t))
+			params["dt"]=time.strftime("%Y-%m-%dT%H:%M",time.localtime(t))
+		if self.handleTimeShift:
+			if timeshift==None:
+				timeshift=0
+			if timeshift<len(self.timeshift_value):
+				params["t"]=self.timeshift_value[timeshift]
+			else:
+				print("error, no timeshift %d for %s" % (timeshift,self.name))
+				params["t"]=""
+		self.url_params=(key,params)
+		return params
 		
+	def retire(self):
+		""" the server was replaced or removed from the catalog : pending tiles will not be downloaded """
+		self.retired=True
+	
+	def getState(self):
+		""" plain data of the server read from the INI files (for Catalog snapshot and reload), 
+			compiled url and runtime values (timeshift, retired) excluded 
+		"""
+		return dict([(k,v) for (k,v) in self.__dict__.items() if not k.startswith("url_") and k not in ("timeshift","retired")])
+	
+	@classmethod
+	def fromState(cls,state):
+		""" rebuild a server from its plain data (see getState) """
+		server=cls.__new__(cls)
+		server.timeshift=0
+		server.retired=False
+		server.__dict__.update(state)
+		server.compileUrl()
+		return server
+	
 	def show_licence(self):
 		print("\tsource       : %s" % self.source)
 		print("\tmap licence  : %s" % self.tile_copyright)
@@ -651,6 +1359,32 @@ class TileServer():
 		str=str+"\n\tData Licence: %s" % self.data_copyright
 		return str
 
+class Layer():
+	""" Layer : an overlay server composited over a base map (see BigTileMap)
+		with an opacity (0.0-1.0) and a blend mode (see blend_modes)
+		default opacity and blend are defined by the server (servers.ini)
+	"""
+	def __init__(self,server,opacity=None,blend=None):
+		self.server=server
+		if opacity==None:
+			opacity=server.opacity
+		if blend==None:
+			blend=server.blend
+		if blend not in blend_modes:
+			print("error: unknown blend mode %s for %s (use normal)" % (blend,server.name))
+			blend="normal"
+		self.opacity=min(max(float(opacity),0.0),1.0)
+		self.blend=blend
+	
+	def __eq__(self,other):
+		return isinstance(other,Layer) and self.server==other.server and self.opacity==other.opacity and self.blend==other.blend
+	
+	def __hash__(self):
+		return hash((self.server.name,self.opacity,self.blend))
+	
+	def __repr__(self):
+		return "%s (%s, %d%%)" % (self.server.name,self.blend,int(100.0*self.opacity+0.5))
+
 class ThreadData():
 	""" data for asynchronous process (loading tiles) """
 	def __init__(self,x,y,z,server,date=None,cache=None):
@@ -661,84 +1395,391 @@ class ThreadData():
 		self.date=date
 		self.cache=cache
 		
+def downloadTile(tile_url,errorImage=None):
+	""" download a tile, return (data,error) : data is raw data, an error image or None """
+	data=None
+	error=0
+	headers={'User-Agent':"%s/%s" % (__application__,__version__),'connection':'keep-alive'}
+	request=urllib.request.Request(tile_url,None,headers)
+	try:
+		socket.setdefaulttimeout(config.k_server_timeout)
+		stream=urllib.request.urlopen(request)
+		header=stream.info()
+		content=header.get("Content-Type")
+		if len(content)==0 or "text/" in content[0]:
+			data=None
+			if _debug:
+				print("error for %s\n%s" % (tile_url,content))
+		else:
+			data=stream.read()
+		stream.close()
+	except urllib.error.URLError as e:
+		error=1
+		if errorImage:
+			for err in config.urlError:
+				if err in str(e):
+					print("\t",err)
+					data=errorImage[err]
+			if not data:
+				data=errorImage["default"]
+		print("*URLError:",e,"\n\t",tile_url)
+	except socket.timeout as e:
+		error=1
+		print("*TimeOut:",e,"\n\t",tile_url)
+	except Exception:
+		error=1
+		print("*Unknow error",sys.exc_info()[0],"\n\t",tile_url)
+	if not data:
+		error=1
+	return (data,error)
+
+def fetchTile(x,y,zoom,server,date,timeshift,cache,errorImage=None):
+	""" get a tile into the cache (download only if not allready cached)
+		return (error,nb bytes downloaded)
+	"""
+	if x<=0 or y<=0 or zoom<=0:
+		return (0,0)
+	if server.retired:		# server removed or changed (see Catalog.reload) : drop the tile
+		return (1,0)
+	# check if tile was in cache
+	fname=server.getCacheFName((x,y),zoom,date,timeshift)
+	if cache:
+		fpath=cache.buildpath(fname)
+		if cache.incache(fpath):
+			return (0,0)
+	tile_url=server.getTileUrlFromXY((x,y),zoom,date,timeshift)
+	t=time.perf_counter()
+	(data,error)=downloadTile(tile_url,errorImage)
+	if error==0 and isinstance(data,bytes):
+		server_stats.add(server.name,len(data),time.perf_counter()-t)
+		if cache:	# save the data into an image file (error images are never cached)
+			cache.store(fpath,data)
+	if isinstance(data,bytes):
+		return (error,len(data))
+	return (error,0)
+
 class LoadImagesFromURL(threading.Thread):
 	""" Thread for loading a tile from a tile server
 		Can be used as an asynchronous thread (using start) or synchronous (using run)
 		required :
 			queue : data to be processed as tuple : (x,y,zoom,server,date,timeshift,cache)
-			result : return 0 if no error, 1 if error occured during loading
+			result : return 0 if no error, 1 if error occured during loading (one result per tile)
+		optionnal :
+			notify : function called (from the thread) each time a result is available
+			progress : function called (from the thread) for each tile with (error,nb bytes downloaded)
+			cancel : threading.Event, when set remaining tiles are dropped (no result)
+			failed : function called (from the thread) with the cache filename of each tile not loaded
 	"""
-	def __init__(self,work,result,errorImage=None):
+	def __init__(self,work,result,errorImage=None,notify=None,progress=None,cancel=None,failed=None):
 		threading.Thread.__init__(self)
 		self.work=work
 		self.result=result
 		self.errorImage=errorImage
-		self.user_agent="%s/%s" % (__application__,__version__)
+		self.notify=notify
+		self.progress=progress
+		self.cancel=cancel
+		self.failed=failed
+	
+	def done(self,error,size=0):
+		""" store the result for a tile and notify it """
+		self.result.put(error)
+		if self.progress:
+			self.progress(error,size)
+		if self.notify:
+			self.notify()
 			
 	def run(self):
 		while not self.work.empty():
-			(x,y,zoom,server,date,timeshift,cache)=self.work.get()
+			try:
+				(x,y,zoom,server,date,timeshift,cache)=self.work.get_nowait()
+			except queue.Empty:
+				break
+			if self.cancel and self.cancel.is_set():	# drop the tile
+				self.work.task_done()
+				continue
 			if _debug_thread:
 				print("Thread, handle:",server.name,x,y,zoom)
-			if x>0 and y>0 and zoom>0:
-				# check if tile was in cache
-				fname=server.getCacheFName((x,y),zoom,date,timeshift)
-				if cache:
-					fpath=cache.buildpath(fname)
-					if cache:
-						load=not cache.incache(fpath)
-					else:
-						load=True
-				else:
-					load=True
-				if load:	# load if not in cache
-					data=None
-					tile_url=server.getTileUrlFromXY((x,y),zoom,date,timeshift)
-					headers={'User-Agent':self.user_agent,'connection':'keep-alive'}
-					request=urllib.request.Request(tile_url,None,headers)
-					try:
-						socket.setdefaulttimeout(config.k_server_timeout)
-						stream=urllib.request.urlopen(request)
-						header=stream.info()
-						content=header.get("Content-Type")
-						if len(content)==0 or "text/" in content[0]:
-							data=None
-							if _debug:
-								print("error for %s\n%s" % (tile_url,content))
-						else:
-							data=stream.read()
-						stream.close()
-					except urllib.error.URLError as e:
-						if self.errorImage:
-							for err in config.urlError:
-								if err in str(e):
-									print("\t",err)
-									data=self.errorImage[err]
-							if not data:
-								data=self.errorImage["default"]
-						print("*URLError:",e,"\n\t",tile_url)
-					except urllib.error.HTTPError as e:
-						print("*HTTPError:",e,"\n\t",tile_url)
-					except socket.timeout as e:
-						print("*TimeOut:",e,"\n\t",tile_url)
-					except:
-						print("*Unknow error",sys.exc_info()[0],"\n\t",tile_url)
-					else:
-						if data and cache:	# save the data into an image file
-							if data.__class__==PngImagePlugin.PngImageFile:
-								data.save(fpath)
-								self.result.put(1)
-							else:
-								f=open(fpath,"wb")
-								f.write(data)
-								f.close()
-								self.result.put(0)
-						else:
-							self.result.put(1)
-				else:
-					self.result.put(0)
+			try:
+				(error,size)=fetchTile(x,y,zoom,server,date,timeshift,cache,self.errorImage)
+			except Exception:		# one result per tile, whatever happens
+				print("*Tile error",server.name,(x,y,zoom),sys.exc_info()[1])
+				(error,size)=(1,0)
+			if error and self.failed:
+				self.failed(server.getCacheFName((x,y),zoom,date,timeshift))
+			self.done(error,size)
 			self.work.task_done()
 
+class FetchJob():
+	""" a set of tiles to fetch for one server (see FetchPool)
+		data : user data (to assemble the map when the job is finished)
+	"""
+	def __init__(self,server,tiles,zoom,date=None,timeshift=None,cache=None,data=None):
+		self.server=server
+		self.tiles=tiles		# list of (x,y)
+		self.zoom=zoom
+		self.date=date
+		self.timeshift=timeshift
+		self.cache=cache
+		self.data=data
+		self.total=len(tiles)
+		self.left=self.total
+		self.errors=0
+		self.size=0
+	
+	def __repr__(self):
+		return "<FetchJob %s z=%d: %d/%d>" % (self.server.name,self.zoom,self.total-self.left,self.total)
+
+class FetchPool():
+	""" a pool of threads fetching tiles for several servers at once
+		tiles are scheduled round-robin between servers, each server is limited to 
+		config.k_server_connections simultaneous downloads and config.k_server_rate requests per second
+		finished jobs are put into the finished queue (can be assembled while other jobs are loading)
+		a low priority pool waits while its priority function returns True (ie. another loading is running)
+	"""
+	def __init__(self,nb_thread=None,errorImage=None,priority=None):
+		if nb_thread==None:
+			nb_thread=config.k_pool_thread
+		self.nb_thread=max(1,nb_thread)
+		self.errorImage=errorImage
+		self.finished=queue.Queue()
+		self.lock=threading.Condition()
+		self.pending=collections.OrderedDict()		# server name : deque of (job,(x,y))
+		self.active={}			# server name : downloads running
+		self.next_time={}		# server name : next request allowed (perf_counter)
+		self.jobs=0				# jobs not finished
+		self.threads=[]
+		self.stop=False
+		self.priority=priority
+		
+	def add(self,job):
+		""" add a job (FetchJob) to the pool """
+		with self.lock:
+			name=job.server.name
+			if name not in self.pending:
+				self.pending[name]=collections.deque()
+				self.active.setdefault(name,0)
+				self.next_time.setdefault(name,0.0)
+			for t in job.tiles:
+				self.pending[name].append((job,t))
+			self.jobs=self.jobs+1
+			if job.total==0:
+				self.jobs=self.jobs-1
+				self.finished.put(job)
+			self.lock.notify_all()
+		
+	def start(self):
+		""" launch the threads """
+		for i in range(self.nb_thread):
+			task=threading.Thread(target=self.run)
+			task.daemon=True
+			task.start()
+			self.threads.append(task)
+	
+	def clear(self):
+		""" forget the tiles not yet started, their jobs are finished """
+		with self.lock:
+			for tiles in self.pending.values():
+				for (job,tile) in tiles:
+					job.left=job.left-1
+					if job.left==0:
+						self.jobs=self.jobs-1
+						self.finished.put(job)
+				tiles.clear()
+			self.lock.notify_all()
+	
+	def close(self):
+		""" stop the threads (as soon as they are idle) """
+		with self.lock:
+			self.stop=True
+			self.lock.notify_all()
+	
+	def get(self,timeout=None):
+		""" return the next finished job (block until a job is finished), None if no more jobs """
+		with self.lock:
+			if self.jobs==0 and self.finished.empty():
+				return None
+		return self.finished.get(timeout=timeout)
+	
+	def pick(self):
+		""" choose the next tile to fetch (with lock), return (name,job,tile) or wait delay """
+		now=time.perf_counter()
+		wait=None
+		if self.priority and any(self.pending.values()) and self.priority():		# low priority : check again later (only with tiles to fetch)
+			return (None,None,None,0.1)
+		for name in list(self.pending.keys()):
+			tiles=self.pending[name]
+			if not tiles or self.active[name]>=config.k_server_connections:
+				continue
+			if self.next_time[name]>now:
+				delay=self.next_time[name]-now
+				if wait==None or delay<wait:
+					wait=delay
+				continue
+			(job,tile)=tiles.popleft()
+			self.pending.move_to_end(name)		# round-robin between servers
+			self.active[name]=self.active[name]+1
+			if config.k_server_rate>0:
+				self.next_time[name]=now+1.0/config.k_server_rate
+			return (name,job,tile,None)
+		return (None,None,None,wait)
+			
+	def run(self):
+		while True:
+			with self.lock:
+				while True:
+					(name,job,tile,wait)=self.pick()
+					if job:
+						break
+					if self.stop:
+						return
+					self.lock.wait(wait)
+			if _debug_thread:
+				print("Pool, handle:",name,tile,job.zoom)
+			(error,size)=(1,0)
+			try:
+				(error,size)=fetchTile(tile[0],tile[1],job.zoom,job.server,job.date,job.timeshift,job.cache,self.errorImage)
+			except Exception:		# counted as an error, the job still finishes
+				print("*Tile error",name,tile,job.zoom,sys.exc_info()[1])
+			finally:
+				with self.lock:
+					self.active[name]=self.active[name]-1
+					job.errors=job.errors+error
+					job.size=job.size+size
+					job.left=job.left-1
+					if job.left==0:
+						self.jobs=self.jobs-1
+						self.finished.put(job)
+					self.lock.notify_all()
+
+class ServerStats():
+	""" historical download statistics per server (tiles, bytes, seconds), stored in a json file
+		used to estimate requests (see planRequest), loaded on first use, thread-safe
+	"""
+	def __init__(self,filename):
+		self.filename=filename
+		self.stats=None		# server name : [tiles,bytes,seconds]
+		self.lock=threading.Lock()
+		self.changed=False
+	
+	def load(self):
+		if self.stats==None:
+			self.stats={}
+			try:
+				with codecs.open(self.filename,'r',encoding='utf-8') as f:
+					self.stats=json.load(f)
+			except (IOError,ValueError):
+				pass
+		
+	def add(self,name,size,seconds):
+		""" record a tile download """
+		with self.lock:
+			self.load()
+			s=self.stats.setdefault(name,[0,0,0.0])
+			s[0]=s[0]+1
+			s[1]=s[1]+size
+			s[2]=s[2]+seconds
+			self.changed=True
+	
+	def get(self,name):
+		""" return (average bytes,average seconds) per tile for a server, or None if unknown """
+		with self.lock:
+			self.load()
+			s=self.stats.get(name)
+			if s and s[0]>0:
+				return (1.0*s[1]/s[0],1.0*s[2]/s[0])
+			return None
+	
+	def save(self):
+		with self.lock:
+			if self.changed:
+				try:
+					with codecs.open(self.filename,'w',encoding='utf-8') as f:
+						json.dump(self.stats,f,indent=1)
+					self.changed=False
+				except IOError as e:
+					print("saving",self.filename,"error:",e)
+
+class Plan():
+	""" a request estimation (see planRequest) """
+	def __init__(self,server,zooms):
+		self.server=server
+		self.zooms=zooms
+		self.tiles=0			# tiles requested
+		self.cached=0			# tiles allready valid in cache
+		self.tile_bytes=0.0		# average tile size (bytes)
+		self.tile_seconds=0.0	# average download time per tile (seconds)
+		self.history=False		# averages come from download statistics
+		self.bytes=0			# expected download size
+		self.memory=0			# peak memory for assembly (bytes)
+		self.seconds=0.0		# expected wall time
+		self.advice=[]			# chunking/streaming suggestions
+	
+	def __str__(self):
+		if self.zooms[0]==self.zooms[1]:
+			z="z=%d" % self.zooms[0]
+		else:
+			z="z=%d-%d" % self.zooms
+		s="%s (%s) : %d tile(s), %d cached, %d to download" % (self.server.name,z,self.tiles,self.cached,self.tiles-self.cached)
+		if self.history:
+			s=s+"\n\tdownload : %s (%s/tile, measured)" % (ByteSize(int(self.bytes)),ByteSize(int(self.tile_bytes)))
+		else:
+			s=s+"\n\tdownload : %s (%s/tile, estimated)" % (ByteSize(int(self.bytes)),ByteSize(int(self.tile_bytes)))
+		if self.memory>0:
+			s=s+"\n\tassembly memory : %s" % ByteSize(int(self.memory))
+		s=s+"\n\ttime : %.1f seconds" % self.seconds
+		for a in self.advice:
+			s=s+"\n\t* %s" % a
+		return s
+
+def planRequest(server,box,zooms,cache=None,polygon=None,date=None,timeshift=None,assemble=True):
+	""" estimate a request without downloading : tiles inside the box (or polygon) for a zoom range,
+		tiles allready cached, expected download (bytes and time, from ServerStats then cache then defaults),
+		peak memory for assembly (if assemble) and chunking/streaming suggestion
+		return a Plan
+	"""
+	plan=Plan(server,zooms)
+	prefix="%s_" % server.name
+	for (zoom,x,y) in seedTiles(server,box,zooms,polygon):
+		plan.tiles=plan.tiles+1
+		if cache and cache.incache(cache.buildpath(server.getCacheFName((x,y),zoom,date,timeshift))):
+			plan.cached=plan.cached+1
+	# average tile size and download time
+	avg=server_stats.get(server.name)
+	if avg:
+		(plan.tile_bytes,plan.tile_seconds)=avg
+		plan.history=True
+	else:
+		plan.tile_bytes=config.default_tile_bytes
+		plan.tile_seconds=config.default_tile_seconds
+		if cache and cache.index:	# average size of the server tiles in cache
+			sizes=[s for (n,(d,s)) in list(cache.index.items()) if n.startswith(prefix)]
+			if sizes:
+				plan.tile_bytes=1.0*sum(sizes)/len(sizes)
+	n=plan.tiles-plan.cached
+	plan.bytes=n*plan.tile_bytes
+	# wall time : limited by simultaneous downloads and rate per server
+	plan.seconds=n*plan.tile_seconds/max(1,min(config.k_server_connections,config.k_pool_thread))
+	if config.k_server_rate>0:
+		plan.seconds=max(plan.seconds,n/config.k_server_rate)
+	# memory : the big image (RGBA) + ram cache of tiles, for the largest zoom
+	if assemble:
+		(tile0,tile1)=box.convert2Tile(zooms[1])
+		(wx,wy)=(int(tile1[0])-int(tile0[0])+1,int(tile1[1])-int(tile0[1])+1)
+		plan.memory=4*wx*wy*server.render_size_x*server.render_size_y+4*config.mem_cache*server.size_x*server.size_y
+		if plan.tiles>config.max_tiles:
+			rows=max(1,config.max_tiles//wx)
+			plan.advice.append("too many tiles (max %d) : split into %d strip(s) of %d tile row(s)" % (config.max_tiles,(wy+rows-1)//rows,rows))
+		if plan.memory>config.max_plan_memory:
+			plan.advice.append("image too large for memory (max %s) : assemble strips and stream them to disk" % ByteSize(config.max_plan_memory))
+	else:
+		if plan.tiles>config.max_seed_tiles:
+			plan.advice.append("too many tiles to seed (max %d) : reduce the zoom range or the area" % config.max_seed_tiles)
+	if n==0 and plan.tiles>0:
+		plan.advice.append("all tiles are cached : no download")
+	elif plan.seconds>3600:
+		plan.advice.append("long download : use --seed (resumable) then render from cache")
+	return plan
+
 class BigTileMap():
 	""" Assemble tile images into a big image 
 	"""
@@ -751,10 +1792,22 @@ class BigTileMap():
 		self.filename=None
 		self.setSize((0,0),(0,0))
 		self.markers=[]
+		self.clip=None			# polygon : mask (and crop) the saved map (see setClip)
 		self.noData=None
 		self.errorImage=None
-		self.tile_cache=[]
+		self.tile_cache=TileMemCache()	# ram cache (tiles images), can be shared (see setMemCache)
+		self.own_cache=True
+		self.composite_cache=collections.OrderedDict()	# composited tiles (base+layers), LRU
+		self.layers=[]			# overlay layers (see Layer) composited over the base map
+		self.invalid=set()		# tiles changed on disk (see invalidate)
+		self.failed=set()		# tiles not loaded (see fail)
+		self.invalid_lock=threading.Lock()
+		self.tile_state={}		# key of the tile actually pasted at each (x,y) position
+		self.placeholder=set()	# (x,y) positions showing a previous image until their tile is loaded (see paintSnapshot)
+		self.fallback=0			# zoom levels searched for temporary tiles (0 : none)
+		self.dirty=[]			# rectangles (pixels) modified by the last build
 		self.overlay=overlay
+		self.fallback_tiles={}	# temporary tiles allready searched (see getLayerTile)
 		self._debug_build=False
 		
 	def __repr__(self):
@@ -767,19 +1820,39 @@ class BigTileMap():
 		s=s+"\nTile cache: %d\n" % len(self.tile_cache)
 		return s
 	
-	def setServer(self,server,zoom,date=None):
+	def setServer(self,server,zoom,date=None,timeshift=None,layers=None):
+		""" define server, zoom, date and timeshift, and optionnal overlay layers (composited per tile)
+			layers is a list of Layer (or TileServer for default opacity and blend)
+			the big image is kept if nothing changed
+		"""
+		if layers==None:
+			layers=[]
+		layers=[l if isinstance(l,Layer) else Layer(l) for l in layers]
+		if server==self.server and zoom==self.zoom and date==self.date and timeshift==self.timeshift and layers==self.layers and self.noData:
+			return
 		self.server=server
 		self.zoom=zoom
 		self.date=date
+		self.timeshift=timeshift
+		self.layers=layers
+		if self.own_cache:		# room for the tiles of each layer
+			self.tile_cache.size=config.mem_cache*(1+len(self.layers))
 		if self.overlay:
 			self.noData=Image.new("RGBA",(self.server.size_x,self.server.size_y),(242,228,214,128))
 		else:
 			self.noData=Image.new("RGBA",(self.server.size_x,self.server.size_y),(242,228,214,255))
+		self.bigImage=None		# force a new image (and a complete build)
 		
 	def setSize(self,coord0,coord1):
+		""" define the tiles area, the big image is kept (with its tiles) if nothing changed """
+		if self.bigImage and (self.x0,self.y0)==coord0 and (self.x1,self.y1)==coord1:
+			return
 		(self.x0,self.y0)=coord0
 		(self.x1,self.y1)=coord1
 		(self.wx,self.wy)=(self.x1-self.x0+1,self.y1-self.y0+1)
+		self.tile_state={}
+		self.placeholder=set()
+		self.fallback_tiles={}
 		if self.wx*self.wy!=0 and self.server:
 			self.bigImage=Image.new("RGBA",(self.server.render_size_x*self.wx,self.server.render_size_y*self.wy))
 	
@@ -791,45 +1864,258 @@ class BigTileMap():
 	
 	def setMarker(self,list):
 		self.markers=list
+	
+	def setClip(self,polygon):
+		""" mask the saved map outside the polygon (or Corridor) (transparent) and crop it to the area """
+		self.clip=polygon
+	
+	def getClipImg(self):
+		""" return the big image masked and cropped to the clip area (Polygon or Corridor) """
+		mask=self.clip.getMask(self.bigImage.size,self.zoom,(self.x0,self.y0),(self.server.render_size_x,self.server.render_size_y))
+		img=self.bigImage.copy()
+		img.putalpha(ImageChops.multiply(img.getchannel("A"),mask.convert("L")))
+		box=mask.getbbox()
+		if box:
+			img=img.crop(box)
+		return img
 		
 	def setErrorImage(self,imgDict):
 		self.errorImage=imgDict
+	
+	def setMemCache(self,memcache):
+		""" use a shared ram cache (TileMemCache) """
+		self.tile_cache=memcache
+		self.own_cache=False
+		
+	def paintSnapshot(self,img,coord):
+		""" paint a previous image of the map (its top left tile is coord) into the big image,
+			tiles not yet available keep it (instead of no data) until they are loaded (see build)
+		"""
+		if not self.bigImage:
+			return
+		(sx,sy)=(self.server.render_size_x,self.server.render_size_y)
+		(cx0,cy0)=coord
+		(cx1,cy1)=(cx0+img.size[0]//sx-1,cy0+img.size[1]//sy-1)
+		self.bigImage.paste(img.convert("RGBA"),((cx0-self.x0)*sx,(cy0-self.y0)*sy))
+		for x in range(max(self.x0,cx0),min(self.x1,cx1)+1):
+			for y in range(max(self.y0,cy0),min(self.y1,cy1)+1):
+				self.placeholder.add((x,y))
+				self.tile_state.pop((x,y),None)
+		self.dirty=[(0,0)+self.bigImage.size]
+	
+	def prewarm(self,fnames):
+		""" load (and decode) tiles files from the disk cache into the ram cache, can be run by a thread """
+		n=0
+		for fname in fnames:
+			if self.tile_cache.get(fname) is not None:
+				continue
+			try:
+				im=Image.open(os.path.join(config.cachePath,fname))
+				im.load()
+			except (IOError,OSError,ValueError):
+				continue
+			self.tile_cache.put(fname,im)
+			n=n+1
+		if self._debug_build:
+			print("prewarm : %d tile(s)" % n)
+		return n
+		
+	def setFallback(self,levels=2):
+		""" define how many zoom levels (up) are searched for a temporary tile when a tile is missing 
+			(and one level down), 0 disable fallback tiles
+		"""
+		self.fallback=levels
+	
+	def invalidate(self,fname):
+		""" a tile file changed (new download) : forget it from ram caches and redraw it on next build
+			can be called from any thread (see Cache.addListener)
+		"""
+		with self.invalid_lock:
+			self.invalid.add(fname)
+	
+	def fail(self,fname):
+		""" a tile can't be loaded (download error) : its position stop showing the previous image 
+			(see paintSnapshot), no data or a temporary tile is shown instead on next build
+			can be called from any thread (see LoadImagesFromURL)
+		"""
+		with self.invalid_lock:
+			self.failed.add(fname)
+	
+	def handleInvalid(self):
+		""" remove invalidated tiles (see invalidate) from ram cache, composited tiles and pasted tiles,
+			and the placeholders of tiles not loaded (see fail)
+		"""
+		with self.invalid_lock:
+			invalid=self.invalid
+			self.invalid=set()
+			failed=self.failed
+			self.failed=set()
+		if len(failed)>0:
+			for (x,y) in list(self.placeholder):
+				if self.server.getCacheFName((x,y),self.zoom,self.date,self.timeshift) in failed:
+					self.placeholder.discard((x,y))
+		if len(invalid)==0:
+			return
+		self.tile_cache.discard(invalid)
+		for key in list(self.composite_cache.keys()):
+			if tileKeyUses(key,invalid):
+				del self.composite_cache[key]
+		for (coord,key) in list(self.tile_state.items()):
+			if tileKeyUses(key,invalid):
+				del self.tile_state[coord]
+		for (key,(im,d,waiting)) in list(self.fallback_tiles.items()):	# a closer tile arrived : search again
+			if not waiting.isdisjoint(invalid):
+				del self.fallback_tiles[key]
+		
+	def getTile(self,coord,zoom,server=None):
+		""" return a tile image from the ram cache, then from the disk cache, or None """
+		if server==None:
+			server=self.server
+		fname=server.getCacheFName(coord,zoom,self.date,self.timeshift)
+		im=self.tile_cache.get(fname)
+		if im:
+			if self._debug_build:
+				print(coord,zoom,"tile in ram cache")
+			return im
+		fpath=os.path.join(config.cachePath,fname)
+		try:	# get tile from cache
+			im=Image.open(fpath)
+		except:
+			if self._debug_build:
+				print(coord,zoom,"no tile",sys.exc_info())
+			return None
+		self.tile_cache.put(fname,im)
+		if self._debug_build:
+			print(coord,zoom,"tile in disk cache")
+		return im
+	
+	def getFallback(self,coord,server=None):
+		""" build a temporary tile for a missing tile, from cached tiles of other zoom levels :
+				a parent tile (lower zoom) cropped and scaled up
+				or the 4 children tiles (zoom+1) scaled down
+			return (image,zoom distance,waiting) : image is None if nothing is available,
+			waiting is the set of missing closer tiles filenames (see handleInvalid)
+		"""
+		if server==None:
+			server=self.server
+		(x,y)=coord
+		size=(server.size_x,server.size_y)
+		waiting=set()
+		for d in range(1,self.fallback+1):
+			zoom=self.zoom-d
+			if zoom<server.min_zoom:
+				break
+			im=self.getTile((x>>d,y>>d),zoom,server)
+			if im:
+				n=1<<d
+				(sx,sy)=(im.size[0]/n,im.size[1]/n)
+				(ox,oy)=((x%n)*sx,(y%n)*sy)
+				return (im.crop((int(ox),int(oy),int(ox+sx),int(oy+sy))).resize(size,Image.BILINEAR),d,waiting)
+			waiting.add(server.getCacheFName((x>>d,y>>d),zoom,self.date,self.timeshift))
+		if self.zoom+1<=server.max_zoom:
+			children=[]
+			for (i,j) in ((0,0),(1,0),(0,1),(1,1)):
+				im=self.getTile((2*x+i,2*y+j),self.zoom+1,server)
+				if im:
+					children.append(((i,j),im))
+				else:
+					waiting.add(server.getCacheFName((2*x+i,2*y+j),self.zoom+1,self.date,self.timeshift))
+			if len(children)==4:
+				(hx,hy)=(size[0]//2,size[1]//2)
+				tile=Image.new("RGBA",size)
+				for ((i,j),im) in children:
+					tile.paste(im.resize((hx,hy),Image.BILINEAR),(i*hx,j*hy))
+				return (tile,self.fallback+1,waiting)
+		return (None,None,waiting)
+	
+	def getLayerTile(self,server,coord):
+		""" return (image,key) for a tile of a server : 
+				the real tile (key is the cache filename), 
+				a temporary tile (key is ("~",filename,zoom distance)) see getFallback,
+				or (None,None) if not available
+		"""
+		fname=server.getCacheFName(coord,self.zoom,self.date,self.timeshift)
+		im=self.getTile(coord,self.zoom,server)
+		if im:
+			return (im,fname)
+		if self.fallback>0:
+			key=("~",fname)
+			if key not in self.fallback_tiles:		# search again only when a closer tile arrives
+				self.fallback_tiles[key]=self.getFallback(coord,server)
+			(im,d,waiting)=self.fallback_tiles[key]
+			if im:
+				return (im,("~",fname,d))
+		return (None,None)
+	
+	def composite(self,base,layers,key):
+		""" return the base tile with the layers tiles over it (see blendTiles),
+			layers is a list of (image,opacity,blend)
+			composited tiles from real tiles are kept into a ram cache, 
+			key is (base,(layer,opacity,blend),...) using cache filenames
+		"""
+		cached=type(key[0])==str
+		for k in key[1:]:
+			cached=cached and type(k[0])==str
+		if cached and key in self.composite_cache:
+			self.composite_cache.move_to_end(key)
+			return self.composite_cache[key]
+		tile=blendTiles(base,layers)
+		if cached:
+			self.composite_cache[key]=tile
+			if len(self.composite_cache)>config.mem_cache:
+				self.composite_cache.popitem(last=False)
+		return tile
 		
 	def build(self,background=None):
 		""" create a large white image to fit the required size
 			paste each individual tile image into it
 			add markers if any
 			use a ram cache then a disk cache
+			only tiles that changed since the last build are pasted, 
+			their rectangles (pixels) are listed into dirty
+			missing tiles can be temporary replaced by other zoom tiles (see setFallback)
+			with overlay layers, base and layers tiles are composited per tile (and cached)
 		"""
 		if _chrono: 
-			t=time.clock()
+			t=time.perf_counter()
 			self.chrono=0.0
+		self.dirty=[]
+		self.handleInvalid()
 		if self.bigImage:
 			for x in range(self.x0,self.x1+1):		# go through the matrix of tiles to build a bigger image (X,Y)
 				for y in range(self.y0,self.y1+1):
 					im=None
+					key=None
 					if x>=0 and y>=0:
 						fname=self.server.getCacheFName((x,y),self.zoom,self.date,self.timeshift)
-						for (tname,timg) in self.tile_cache:
-							if tname==fname:
-								im=timg
-								if self._debug_build:
-									print(x,y,"tile in ram cache")
-								break
-						if not im:
-							fpath=os.path.join(config.cachePath,fname)
-							try:	# get tile from cache
-								im=Image.open(fpath)
-								self.tile_cache.append((fname,im))
-								if len(self.tile_cache)>config.mem_cache:
-									del self.tile_cache[0]
-								if self._debug_build:
-									print(x,y,"tile in disk cache")
-							except:		
-								# no data, build an empty image (orange)
-								if not self.overlay: im=self.noData
-								if self._debug_build:
-									print(x,y,"no tile",sys.exc_info())
+						if self.layers:
+							done=(fname,)
+							for l in self.layers:
+								done=done+((l.server.getCacheFName((x,y),self.zoom,self.date,self.timeshift),l.opacity,l.blend),)
+						else:
+							done=fname
+						if self.tile_state.get((x,y))==done:	# allready pasted
+							continue
+						(im,key)=self.getLayerTile(self.server,(x,y))
+						if type(key)!=str and (x,y) in self.placeholder:	# keep the previous image until the tile is loaded
+							continue
+						if not im and not self.overlay:		# no data, build an empty image (orange)
+							im=self.noData
+						if self.layers:
+							key=(key,)
+							tiles=[]
+							for l in self.layers:
+								(layer,lkey)=self.getLayerTile(l.server,(x,y))
+								key=key+((lkey,l.opacity,l.blend),)
+								if layer:
+									tiles.append((layer,l.opacity,l.blend))
+							if im and len(tiles)>0:
+								im=self.composite(im,tiles,key)
+					if (x,y) in self.tile_state:	# no data or temporary tile allready pasted : keep it unless better
+						old=self.tile_state[(x,y)]
+						if old==key or (type(key)!=str and not tileKeyBetter(key,old)):
+							continue
+					self.tile_state[(x,y)]=key
 					if im:
 #						dest_pos=(self.server.tile_size*(x-self.x0),self.server.tile_size*(y-self.y0))
 						dest_pos=(self.server.render_size_x*(x-self.x0),self.server.render_size_y*(y-self.y0))
@@ -837,12 +2123,14 @@ class BigTileMap():
 							self.bigImage.paste(im.resize((self.server.render_size_x,self.server.render_size_y)),dest_pos)
 						else:
 							self.bigImage.paste(im,dest_pos)
+						self.placeholder.discard((x,y))
+						self.dirty.append((dest_pos[0],dest_pos[1],dest_pos[0]+self.server.render_size_x,dest_pos[1]+self.server.render_size_y))
 			# add markers (if any)
-			if len(self.markers)>0:
+			if len(self.markers)>0 and len(self.dirty)>0:
 				imd=ImageDraw.Draw(self.bigImage)
 				for (mx,my,color,size) in self.markers:
-					imd.ellipse([my-size,mx-size,my+size,mx+size],fill=color)
-		if _chrono: self.chrono=time.clock()-t
+					imd.ellipse([mx-size,my-size,mx+size,my+size],fill=color)
+		if _chrono: self.chrono=time.perf_counter()-t
 	
 	def save(self,filename=None):
 		if self.bigImage:
@@ -856,14 +2144,18 @@ class BigTileMap():
 					fname="z%d_%dx%d_%s_%s.%s" % (self.zoom,self.wx,self.wy,self.server.name,self.date,self.server.extension)
 				else:
 					fname="z%d_%dx%d_%s.%s" % (self.zoom,self.wx,self.wy,self.server.name,self.server.extension)
+			if self.clip:
+				img=self.getClipImg()
+			else:
+				img=self.bigImage
 			# set image data
-			self.bigImage.info['source']=self.server.name
-			self.bigImage.info['location']=''
-			self.bigImage.info['data']=self.server.data_copyright
-			self.bigImage.info['map']=self.server.tile_copyright
-			self.bigImage.info['build']="%s/%s" % (__file__,__version__)
+			img.info['source']=self.server.name
+			img.info['location']=''
+			img.info['data']=self.server.data_copyright
+			img.info['map']=self.server.tile_copyright
+			img.info['build']="%s/%s" % (__file__,__version__)
 			# save
-			self.bigImage.save(fname)
+			img.save(fname)
 			return fname
 		else:
 			return None
@@ -976,20 +2268,20 @@ def LoadLocation(filename):
 		print("loading Loc",filename)
 	dict={}
 	try:
-		config=configparser.RawConfigParser()
+		parser=configparser.RawConfigParser()
 		with codecs.open(filename,'r',encoding='utf-8') as f:
 			if sys.version_info.major==2:
-				config.readfp(f)
+				parser.readfp(f)
 			else:
-				config.read_file(f)
+				parser.read_file(f)
 				
-		for k in config.sections():
+		for k in parser.sections():
 			try:
-				name=config.get(k,'name')
+				name=parser.get(k,'name').strip("'\"")
 			except:
 				name=k
 			try:
-				l=config.get(k,'box').split(',')
+				l=parser.get(k,'box').split(',')
 				a=Coordinate(float(l[0]),float(l[1]))
 				b=Coordinate(float(l[2]),float(l[3]))
 			except:
@@ -997,11 +2289,11 @@ def LoadLocation(filename):
 				print(sys.exc_info())
 				break
 			try:
-				zoom=int(config.get(k,'zoom'))
+				zoom=int(parser.get(k,'zoom'))
 			except:
 				zoom=16
 			try:
-				server=config.get(k,'server')
+				server=parser.get(k,'server').strip("'\"")
 			except:
 				server=config.default_server
 				
@@ -1034,6 +2326,8 @@ def LoadServers(filename,api_dict=None):
 			time_step (string list) : value for alternative subfolder in url (replace in {t})
 			time_step_str (string list) : human readable value for time_step list
 			cache (integer) : define a cache duration (hours)
+			opacity (float) : default opacity for an overlay (0.0-1.0, default is 1.0)
+			blend (string) : default blend mode for an overlay (normal, multiply, screen or hillshade)
 
 		base url, contain several keys, see : TileServer.getTileUrlFromXY() for details
 	"""
@@ -1080,6 +2374,8 @@ def LoadServers(filename,api_dict=None):
 			mode=item.get('mode',fallback="RGB")
 			size=getListInt(item.get('size',fallback="%d,%d" % (config.default_tile_size,config.default_tile_size)))
 			render=getListInt(item.get('render',fallback="%d,%d" % (config.default_tile_size,config.default_tile_size)))
+			opacity=float(item.get('opacity',fallback="1.0"))
+			blend=item.get('blend',fallback="normal")
 			# create the server and put data into
 			server=TileServer(section,desc,familly,tp)
 			server.setServer(url,sub_domain,delay)
@@ -1089,6 +2385,7 @@ def LoadServers(filename,api_dict=None):
 			server.setFormat(fmt,mode)
 			server.setTileSize(size[0],size[1],render[0],render[1])
 			server.setTimeShift(ts_value,ts_string)
+			server.setBlend(opacity,blend)
 			servers_list.append(server)
 	except:
 		print("loading",filename,"error")
@@ -1099,6 +2396,252 @@ def LoadServers(filename,api_dict=None):
 	servers_list.sort(key=lambda x : x.name)
 	return servers_list
 	
+class ServerRegistry():
+	""" tile servers indexed by name, provider, familly, type (base/overlay), format and zoom 
+		for O(1) lookups and capability queries, name patterns (glob or regex) are compiled once
+	"""
+	def __init__(self,servers):
+		self.servers=list(servers)
+		self.names={}
+		self.indexes={'provider':{},'familly':{},'type':{},'format':{},'zoom':{}}
+		for s in self.servers:
+			self.names[s.name]=s
+			for attr in ('provider','familly','type','format'):
+				self.indexes[attr].setdefault(getattr(s,attr),[]).append(s)
+			for z in range(s.min_zoom,s.max_zoom+1):
+				self.indexes['zoom'].setdefault(z,[]).append(s)
+		self.patterns={}
+		self.lock=threading.Lock()
+	
+	def __repr__(self):
+		return "<ServerRegistry %d servers>" % len(self.servers)
+	
+	def __len__(self):
+		return len(self.servers)
+	
+	def __iter__(self):
+		return iter(self.servers)
+	
+	def __contains__(self,name):
+		return name in self.names
+	
+	def get(self,name,default=None):
+		""" the server named name (or default) """
+		return self.names.get(name,default)
+	
+	def compile(self,pattern):
+		""" compile (and cache) a name pattern : glob if it contains * ? or [ ('*name' search a partial name), 
+			else regular expression, return a match function (or None if the pattern is invalid)
+		"""
+		with self.lock:
+			f=self.patterns.get(pattern,False)
+			if f!=False:
+				return f
+			try:
+				if "*" in pattern or "?" in pattern or "[" in pattern:
+					glob=pattern
+					if glob.startswith("*") and not ("*" in glob[1:] or "?" in glob or "[" in glob):
+						glob=glob+"*"
+					f=re.compile(fnmatch.translate(glob)).match
+				else:
+					f=re.compile(pattern).search
+			except re.error as e:
+				print("error in server name %s : %s" % (pattern,e))
+				f=None
+			self.patterns[pattern]=f
+			return f
+	
+	def match(self,pattern):
+		""" servers matching a name : exact name, glob or regular expression (see compile) """
+		s=self.names.get(pattern)
+		if s:
+			return [s]
+		f=self.compile(pattern)
+		if f==None:
+			return []
+		return [s for s in self.servers if f(s.name)]
+	
+	def query(self,provider=None,familly=None,type=None,format=None,zoom=None):
+		""" servers with all the given capabilities (None for any), zoom is an integer or a (min,max) range """
+		result=None
+		for (attr,value) in (('provider',provider),('familly',familly),('type',type),('format',format)):
+			if value!=None:
+				l=self.indexes[attr].get(value,[])
+				if result==None:
+					result=l
+				else:
+					keep=set(l)
+					result=[s for s in result if s in keep]
+		if zoom!=None:
+			if isinstance(zoom,tuple):
+				result=[s for s in (result if result!=None else self.servers) if s.min_zoom<=zoom[0] and s.max_zoom>=zoom[1]]
+			else:
+				l=self.indexes['zoom'].get(zoom,[])
+				if result==None:
+					result=l
+				else:
+					keep=set(l)
+					result=[s for s in result if s in keep]
+		if result==None:
+			result=self.servers
+		return list(result)
+
+class Catalog():
+	""" the servers catalog : api keys, tile servers and locations, loaded lazily at first access (thread-safe)
+		tile servers are stored into a snapshot (pickle of plain data, config.catalogPath) 
+		keyed by INI files modification times : next starts skip parsing servers.ini
+	"""
+	version=3		# snapshot format
+	
+	def __init__(self,servers_path=None,api_path=None,locations_path=None,snapshot_path=None):
+		self.servers_path=servers_path or config.tile_servers_path
+		self.api_path=api_path or config.api_keys_path
+		self.locations_path=locations_path or config.locations_path
+		self.snapshot_path=snapshot_path or config.catalogPath
+		self.lock=threading.RLock()
+		self.api_keys=None
+		self.servers=None
+		self.registry=None
+		self.locations=None
+		self.key=None
+		self.listeners=[]
+	
+	def __repr__(self):
+		return "<Catalog %s>" % self.servers_path
+	
+	def getKey(self):
+		""" snapshot key : version and INI files (path, modification time, size) """
+		key=[__version__,self.version]
+		for p in (self.servers_path,self.api_path):
+			try:
+				st=os.stat(p)
+				key.append((p,st.st_mtime,st.st_size))
+			except OSError:
+				key.append((p,None,None))
+		return tuple(key)
+	
+	def getAPIKeys(self):
+		with self.lock:
+			if self.api_keys==None:
+				self.api_keys=LoadAPIKey(self.api_path)
+			return self.api_keys
+	
+	def getServers(self):
+		with self.lock:
+			if self.servers==None:
+				self.key=self.getKey()
+				self.servers=self.loadSnapshot(self.key)
+				if self.servers==None:
+					self.servers=LoadServers(self.servers_path,self.getAPIKeys())
+					self.saveSnapshot(self.key)
+			return self.servers
+	
+	def addListener(self,func):
+		""" func(added,changed,removed) will be called with servers names after each reload (see reload) """
+		if func not in self.listeners:
+			self.listeners.append(func)
+	
+	def removeListener(self,func):
+		if func in self.listeners:
+			self.listeners.remove(func)
+	
+	def reload(self):
+		""" reload the INI files if they were modified (cheap if not, can be polled) :
+			unchanged servers keep their TileServer (and warm caches), changed and removed servers are retired 
+			(their pending tiles are dropped), then servers list and registry are swapped at once
+			return (added,changed,removed) servers names, None if nothing was reloaded
+		"""
+		key=self.getKey()
+		with self.lock:
+			if self.servers==None or key==self.key:
+				return None
+			self.key=key
+			api_keys=LoadAPIKey(self.api_path)
+			loaded=LoadServers(self.servers_path,api_keys)
+			if len(loaded)==0:		# unreadable file (being edited ?) : keep the current servers
+				print("no server in",self.servers_path,": servers not reloaded")
+				return None
+			current=dict([(s.name,s) for s in self.servers])
+			(servers,added,changed)=([],[],[])
+			for s in loaded:
+				old=current.pop(s.name,None)
+				if old==None:
+					added.append(s.name)
+					servers.append(s)
+				elif old.getState()==s.getState():
+					servers.append(old)
+				else:
+					changed.append(s.name)
+					old.retire()
+					servers.append(s)
+			removed=sorted(current.keys())
+			for old in current.values():
+				old.retire()
+			# swap
+			self.api_keys=api_keys
+			self.servers=servers
+			if self.registry!=None:
+				self.registry=ServerRegistry(servers)
+			self.saveSnapshot(key)
+			listeners=list(self.listeners)
+		if _debug_config: print("servers reloaded :",added,changed,removed)
+		if added or changed or removed:
+			for func in listeners:
+				func(added,changed,removed)
+		return (added,changed,removed)
+	
+	def getRegistry(self):
+		""" the servers indexed (see ServerRegistry) """
+		with self.lock:
+			if self.registry==None:
+				self.registry=ServerRegistry(self.getServers())
+			return self.registry
+	
+	def getLocations(self):
+		with self.lock:
+			if self.locations==None:
+				self.locations=LoadLocation(self.locations_path)
+			return self.locations
+	
+	def loadSnapshot(self,key):
+		""" return the servers list from the snapshot if it is still valid (same key), else None """
+		try:
+			with open(self.snapshot_path,'rb') as f:
+				(k,states)=pickle.load(f)
+		except (IOError,OSError,EOFError,ValueError,pickle.UnpicklingError):
+			return None
+		if k!=key:
+			if _debug_config: print("servers snapshot outdated")
+			return None
+		if _debug_config: print("servers from snapshot",self.snapshot_path)
+		return [TileServer.fromState(s) for s in states]
+	
+	def saveSnapshot(self,key):
+		""" store the servers into the snapshot (atomic write) """
+		if len(self.servers)==0:
+			return
+		tmp=self.snapshot_path+".tmp"
+		try:
+			if not os.path.exists(os.path.dirname(self.snapshot_path)):
+				os.makedirs(os.path.dirname(self.snapshot_path))
+			with open(tmp,'wb') as f:
+				pickle.dump((key,[s.getState() for s in self.servers]),f,pickle.HIGHEST_PROTOCOL)
+			os.replace(tmp,self.snapshot_path)
+		except (IOError,OSError,pickle.PicklingError) as e:
+			print("can't save servers snapshot :",e)
+
+def __getattr__(name):
+	""" module data loaded lazily at first access (see Catalog) : tile_servers, registry, api_keys, locations """
+	if name=="tile_servers":
+		return catalog.getServers()
+	if name=="registry":
+		return catalog.getRegistry()
+	if name=="api_keys":
+		return catalog.getAPIKeys()
+	if name=="locations":
+		return catalog.getLocations()
+	raise AttributeError("module %r has no attribute %r" % (__name__,name))
+
 def Usage():
 	""" Display usage for the command (syntax and minimum help)
 	"""
@@ -1107,7 +2650,7 @@ def Usage():
 	print("\t-h (--help) : help")
 	print("\t-d (--display) : show complete list of available servers")
 	print("\t-o (--output) : specify output file name")
-	print("\t-s (--server) : select servers from names (add '*' as first character to search a partial name)")
+	print("\t-s (--server) : select servers from names : exact name, glob (add '*' as first character to search a partial name) or regular expression")
 	print("\t-z (--zoom) : set zoom")
 	print("\t-b (--box) : setbounding box (left,top,right,bottom)")
 	print("\t-l (--location) : set location (longitude,latitude)")
@@ -1117,10 +2660,21 @@ def Usage():
 	print("\t-n (--name) : specify a location by its name (see locations.ini file)")
 	print("\t-c (--cache) : override local tile cache")
 	print("\t--date=date (YYYY-MM-DD) for EarthData realtime data")
+	print("\t--batch=file : render all jobs of a file in one pass (locations .ini, .csv or .json jobs list)")
+	print("\t--seed=zmin-zmax : download all tiles of the box (or polygon) for a zoom range into the cache")
+	print("\t--polygon=lon,lat,lon,lat,... or file.geojson : clip the area to a polygon (map is masked and cropped)")
+	print("\t--clip : with -f, clip the area to the polygon found (if any)")
+	print("\t--track=file.gpx or file.geojson : render (or seed) only tiles along a track (corridor)")
+	print("\t--buffer=meters : corridor half width for --track (default %d m)" % config.default_buffer)
+	print("\t--pages=WxH : with --track, render pages of WxH tiles following the route instead of a strip")
+	print("\t-z zmin-zmax : with --track, render each zoom of the range")
+	print("\t--manifest=file : seed progress file (json), default is seed.json in data dir")
+	print("\t--resume=file : resume an interrupted seed from its manifest")
+	print("\t--plan : dry run, estimate tiles, cached tiles, download, memory and time (with -z or --seed)")
 	print("\t--test : test servers")
 	print("Servers list : ",)
 	prefix=""
-	for s in tile_servers:
+	for s in catalog.getServers():
 		print(prefix,s.name,)
 		prefix=","
 	print
@@ -1128,37 +2682,76 @@ def Usage():
 def ShowServers():
 	""" Display a complete list of tile servers handled	"""
 	print("%s tile servers list" % __file__)
-	for s in tile_servers:
+	for s in catalog.getServers():
 		print(s)
 
-def Do(server,box,zoom,cache,mlist=[],date=None,timeshift=None,filename=None):
-	""" Execute the request :
-		load map tiles asynchronously from a map servers inside the box at zoom, 
-		using or not the cache. then assemble tiles into a big image
+def tileRange(server,box,zoom,polygon=None):
+	""" return the tiles range ((x0,y0),(x1,y1)) for a request inside the box at zoom,
+		None if the request can't be done (too many tiles, zoom not available)
+		with a polygon only tiles intersecting it are counted
 	"""
 	# compute coordinates and tiles number
 	(tile0,tile1)=box.convert2Tile(zoom)
 	(x0,y0)=(int(tile0[0]),int(tile0[1]))
 	(x1,y1)=(int(tile1[0]),int(tile1[1]))
-	nt=(x1-x0+1)*(y1-y0+1)
+	if polygon:
+		nt=sum(1 for t in enumTiles(box,zoom,polygon))
+	else:
+		nt=(x1-x0+1)*(y1-y0+1)
 	if nt>config.max_tiles:
 		print("** too many tiles : maximum request is %d tile(s)" % config.max_tiles)
 		print("\tyour request :",nt)
-		return
+		print("\tuse --plan for an estimation and a chunking suggestion")
+		return None
 	if nt<=0:
 		print("** ZERO tiles requested : (%d,%d) - (%d,%d)" % (x0,y0,x1,y1))
-		return
+		return None
 	if zoom<server.min_zoom or zoom>server.max_zoom:
 		print("** %s : zoom %d is not available (zoom: %d-%d)" % (server.name,zoom,server.min_zoom,server.max_zoom))
+		return None
+	return ((x0,y0),(x1,y1))
+
+def Assemble(server,tiles,zoom,nt,error,mlist=[],date=None,timeshift=None,filename=None,memcache=None,polygon=None):
+	""" assemble loaded tiles (tiles range) into a big image (if not too many errors),
+		memcache is an optionnal shared ram cache (TileMemCache), 
+		polygon (optionnal) masks and crops the image
+	"""
+	((x0,y0),(x1,y1))=tiles
+	if error/nt<=config.max_errors:
+		if error>0:
+			print("%d errors, force map assembly" % error)
+		img=BigTileMap(server,zoom,date,timeshift)
+		if memcache!=None:
+			img.setMemCache(memcache)
+		img.setSize((x0,y0),(x1,y1))
+		img.setMarker(mlist)
+		img.setClip(polygon)
+		img.build()
+		try:
+			fname=img.save(filename)
+			print("\tFile:",fname)
+		except (IOError,ValueError) as e:
+			print("** %s : can't save map :" % server.name,e)
+	else:
+		print("%d errors, too many errors : no map generated" % error)
+
+def Do(server,box,zoom,cache,mlist=[],date=None,timeshift=None,filename=None,polygon=None):
+	""" Execute the request :
+		load map tiles asynchronously from a map servers inside the box (clipped to polygon if any) at zoom, 
+		using or not the cache. then assemble tiles into a big image
+	"""
+	tiles=tileRange(server,box,zoom,polygon)
+	if not tiles:
 		return
-	print("processing %s : recovering %d tile(s)" % (server.name,nt))
+	nt=0
 				
 	# create a task queue
 	inputQueue=queue.Queue()
 	resultQueue=queue.Queue()
-	for x in range(x0,x1+1):
-		for y in range(y0,y1+1) :
-			inputQueue.put((x,y,zoom,server,date,timeshift,cache))
+	for (x,y) in enumTiles(box,zoom,polygon):
+		inputQueue.put((x,y,zoom,server,date,timeshift,cache))
+		nt=nt+1
+	print("processing %s : recovering %d tile(s)" % (server.name,nt))
 		
 	# handle the task queue
 	if (config.k_nb_thread>1):		# for asyncrhonous : launch process to handle the queue
@@ -1176,22 +2769,309 @@ def Do(server,box,zoom,cache,mlist=[],date=None,timeshift=None,filename=None):
 		e=resultQueue.get()
 		error+=e
 		resultQueue.task_done()
-	if error/nt<=config.max_errors:
-		if error>0:
-			print("%d errors, force map assembly" % error)
-		img=BigTileMap(server,zoom,date)
-		img.setSize((x0,y0),(x1,y1))
-		img.setMarker(mlist)
-		img.build()
-		fname=img.save(filename)
-		#fname=BuildBigTileMap(server,zoom,(x0,y0),(x1,y1),mlist,date,filename)
-		print("\tFile:",fname)
-	else:
-		print("%d errors, too many errors : no map generated" % error)
+	Assemble(server,tiles,zoom,nt,error,mlist,date,timeshift,filename,None,polygon)
 		
 	# always show credits and licences
 	server.show_licence()
 
+def DoAll(requests,cache,date=None,timeshift=None,polygon=None):
+	""" Execute several requests at once :
+		requests is a list of (server,box,zoom,mlist,filename), all clipped to polygon (if any)
+		all tiles are loaded through a shared pool (FetchPool, limited per server),
+		each map is assembled as soon as its tiles are loaded (while other maps are loading),
+		maps share a ram cache of tiles (TileMemCache)
+	"""
+	pool=FetchPool()
+	memcache=TileMemCache()
+	for (server,box,zoom,mlist,filename) in requests:
+		tiles=tileRange(server,box,zoom,polygon)
+		if not tiles:
+			continue
+		xy=list(enumTiles(box,zoom,polygon))
+		print("processing %s : recovering %d tile(s)" % (server.name,len(xy)))
+		pool.add(FetchJob(server,xy,zoom,date,timeshift,cache,(tiles,mlist,filename)))
+	pool.start()
+	while True:
+		job=pool.get()
+		if job==None:
+			break
+		(tiles,mlist,filename)=job.data
+		print("%s : %d tile(s), %d error(s), %d bytes" % (job.server.name,job.total,job.errors,job.size))
+		Assemble(job.server,tiles,job.zoom,job.total,job.errors,mlist,date,timeshift,filename,memcache,polygon)
+	pool.close()
+	
+	# always show credits and licences (once per server)
+	servers=[]
+	for (server,box,zoom,mlist,filename) in requests:
+		if server not in servers:
+			servers.append(server)
+			server.show_licence()
+
+def suffixFileName(filename,suffix):
+	""" add a suffix to a file name (before extension) """
+	(root,ext)=os.path.splitext(filename)
+	return "%s%s%s" % (root,suffix,ext)
+
+def DoCorridor(servers,corridor,zooms,cache,date=None,timeshift=None,filename=None,page=None):
+	""" Execute a request along a track : load only the tiles within the corridor (see Corridor) 
+		for each server and zoom (zooms is a range), through a shared pool (FetchPool),
+		then assemble a strip map (masked and cropped to the corridor) 
+		or pages of page=(width,height) tiles following the route
+	"""
+	box=corridor.getBox()
+	pool=FetchPool()
+	memcache=TileMemCache()
+	for server in servers:
+		for zoom in range(max(zooms[0],server.min_zoom),min(zooms[1],server.max_zoom)+1):
+			if not tileRange(server,box,zoom,corridor):
+				continue
+			xy=list(enumTiles(box,zoom,corridor))
+			print("processing %s z=%d : recovering %d tile(s) (box : %d tile(s))" % (server.name,zoom,len(xy),countTiles(server,box,(zoom,zoom))))
+			if not filename:
+				fname="z%d_%s_corridor.png" % (zoom,server.name)
+			else:
+				fname=filename
+				if len(servers)>1:
+					fname=serverFileName(server,fname)
+				if zooms[0]!=zooms[1]:
+					fname=suffixFileName(fname,"-z%d" % zoom)
+			pool.add(FetchJob(server,xy,zoom,date,timeshift,cache,fname))
+	pool.start()
+	while True:
+		job=pool.get()
+		if job==None:
+			break
+		print("%s z=%d : %d tile(s), %d error(s), %d bytes" % (job.server.name,job.zoom,job.total,job.errors,job.size))
+		if page:
+			ranges=corridor.pages(job.zoom,page)
+			for (i,tiles) in enumerate(ranges):
+				Assemble(job.server,tiles,job.zoom,job.total,job.errors,[],date,timeshift,suffixFileName(job.data,"-%02d" % (i+1)),memcache,corridor)
+		elif job.total>0:
+			x=[t[0] for t in job.tiles]
+			y=[t[1] for t in job.tiles]
+			Assemble(job.server,((min(x),min(y)),(max(x),max(y))),job.zoom,job.total,job.errors,[],date,timeshift,job.data,memcache,corridor)
+	pool.close()
+	for server in servers:
+		server.show_licence()
+
+def serverFileName(server,filename):
+	""" output file name for a server when several servers are rendered : server name as prefix """
+	(path,name)=os.path.split(filename)
+	return os.path.join(path,"%s-%s" % (server.name,name))
+
+def matchServers(server_names):
+	""" return the servers matching a list of names (exact name, glob or regular expression, see ServerRegistry.match) """
+	match_servers=[]
+	registry=catalog.getRegistry()
+	for n in server_names:
+		match_servers.extend(registry.match(n))
+	return match_servers
+
+def LoadJobs(filename):
+	""" Load a jobs list for batch mode, return a list of (output,box,zoom,server names)
+		file format (from extension) :
+			.ini : locations file (see LoadLocation), output is the location name
+			.csv : header line then one job per line, columns : output,left,top,right,bottom,zoom,servers
+			.json : list of objects : {"output":..,"box":[left,top,right,bottom],"zoom":..,"servers":[..]}
+		servers are names or regular expressions (a list or a comma separated string)
+	"""
+	jobs=[]
+	ext=os.path.splitext(filename)[1].lower()
+	try:
+		if ext==".ini":
+			for (k,(name,a,b,zoom,server)) in LoadLocation(filename).items():
+				jobs.append(("%s.png" % k,BoundingBox(a,b),zoom,(server,)))
+		elif ext==".csv":
+			with codecs.open(filename,'r',encoding='utf-8') as f:
+				for row in csv.DictReader(f):
+					a=Coordinate(float(row['left']),float(row['top']))
+					b=Coordinate(float(row['right']),float(row['bottom']))
+					servers=row.get('servers') or config.default_server
+					jobs.append((row.get('output') or None,BoundingBox(a,b),int(row.get('zoom') or config.default_zoom),servers.split(',')))
+		elif ext==".json":
+			with codecs.open(filename,'r',encoding='utf-8') as f:
+				for item in json.load(f):
+					l=item['box']
+					servers=item.get('servers',config.default_server)
+					if not isinstance(servers,list):
+						servers=servers.split(',')
+					jobs.append((item.get('output'),BoundingBox(Coordinate(l[0],l[1]),Coordinate(l[2],l[3])),int(item.get('zoom',config.default_zoom)),servers))
+		else:
+			print("unknown jobs file format:",filename)
+	except (IOError,ValueError,KeyError,IndexError) as e:
+		print("loading",filename,"error:",e)
+		jobs=[]
+	return jobs
+
+def DoBatch(jobs,cache,date=None,timeshift=None):
+	""" Execute a jobs list (see LoadJobs) in one pass : all maps share the fetch pool, 
+		the ram tiles cache and the cache index
+	"""
+	requests=[]
+	for (output,box,zoom,server_names) in jobs:
+		match_servers=matchServers(server_names)
+		if len(match_servers)==0:
+			print("no server matching for:",server_names)
+		for s in match_servers:
+			if output and len(match_servers)>1:
+				filename=serverFileName(s,output)
+			else:
+				filename=output
+			requests.append((s,box,zoom,[],filename))
+	print("batch : %d job(s), %d map(s)" % (len(jobs),len(requests)))
+	DoAll(requests,cache,date,timeshift)
+
+def parseZoomRange(arg):
+	""" parse a zoom range : 'z' or 'zmin-zmax', return (zmin,zmax) """
+	l=arg.split('-')
+	if len(l)==1:
+		return (int(l[0]),int(l[0]))
+	return (int(l[0]),int(l[1]))
+
+def seedTiles(server,box,zooms,polygon=None):
+	""" enumerate lazily the tiles (zoom,x,y) to seed for a server (zoom range limited to the server zoom) """
+	for zoom in range(max(zooms[0],server.min_zoom),min(zooms[1],server.max_zoom)+1):
+		for (x,y) in enumTiles(box,zoom,polygon):
+			yield (zoom,x,y)
+
+def countTiles(server,box,zooms,polygon=None):
+	""" count tiles to seed (without storing them) """
+	n=0
+	if polygon:
+		for t in seedTiles(server,box,zooms,polygon):
+			n=n+1
+		return n
+	z=list(range(max(zooms[0],server.min_zoom),min(zooms[1],server.max_zoom)+1))
+	if len(z)==0:
+		return 0
+	k=len(z)
+	(x0,y0,x1,y1)=tileRanges([box.leftup.longitude]*k,[box.leftup.latitude]*k,[box.rightdown.longitude]*k,[box.rightdown.latitude]*k,z)
+	for i in range(k):		# all zoom levels converted at once
+		n=n+(int(x1[i])-int(x0[i])+1)*(int(y1[i])-int(y0[i])+1)
+	return n
+
+def saveManifest(manifest,filename):
+	""" write the seed manifest (json), atomic (temp file then rename) """
+	tmp=filename+".tmp"
+	with codecs.open(tmp,'w',encoding='utf-8') as f:
+		json.dump(manifest,f,indent=1)
+	os.replace(tmp,filename)
+
+def loadManifest(filename):
+	""" read a seed manifest, return (manifest,servers,box,zooms,polygon,date,timeshift) or None """
+	try:
+		with codecs.open(filename,'r',encoding='utf-8') as f:
+			manifest=json.load(f)
+		registry=catalog.getRegistry()
+		servers=[registry.get(n) for n in manifest['servers'] if n in registry]
+		l=manifest['box']
+		box=BoundingBox(Coordinate(l[0],l[1]),Coordinate(l[2],l[3]))
+		polygon=None
+		if isinstance(manifest.get('polygon'),dict):		# corridor
+			c=manifest['polygon']
+			polygon=Corridor([[Coordinate(p[0],p[1]) for p in l] for l in c['track']],c['buffer'])
+		elif manifest.get('polygon'):
+			polygon=Polygon()
+			for ring in manifest['polygon']:
+				polygon.addRing([Coordinate(p[0],p[1]) for p in ring])
+		return (manifest,servers,box,tuple(manifest['zoom']),polygon,manifest.get('date'),manifest.get('timeshift'))
+	except (IOError,ValueError,KeyError,IndexError) as e:
+		print("loading",filename,"error:",e)
+		return None
+
+def Seed(servers,box,zooms,cache,filename,polygon=None,date=None,timeshift=None,manifest=None):
+	""" Seed the cache : download all tiles of servers inside the box (or polygon) for a zoom range
+		tiles allready valid in cache are skipped, downloads use a shared pool (FetchPool, limited per server)
+		progress is saved into a manifest (filename, json) to resume later (manifest is a loaded manifest)
+	"""
+	if manifest==None:
+		manifest={'servers':[s.name for s in servers],
+			'box':[box.leftup.longitude,box.leftup.latitude,box.rightdown.longitude,box.rightdown.latitude],
+			'polygon':polygon.toJSON() if polygon else None,
+			'zoom':list(zooms),'date':date,'timeshift':timeshift,'progress':{}}
+	progress=manifest['progress']
+	seeds={}		# server name : (server,tiles generator,chunks running,chunks completed (start:counts))
+	for s in servers:
+		total=countTiles(s,box,zooms,polygon)
+		if total>config.max_seed_tiles:
+			print("** %s : too many tiles : maximum seed is %d tile(s), your request : %d" % (s.name,config.max_seed_tiles,total))
+			continue
+		state=progress.setdefault(s.name,{'next':0,'total':total,'done':0,'skipped':0,'errors':0,'bytes':0})
+		state['total']=total
+		tiles=enumerate(itertools.islice(seedTiles(s,box,zooms,polygon),state['next'],None),state['next'])
+		seeds[s.name]=(s,tiles,[],{})
+		print("seeding %s : %d tile(s), %d allready done" % (s.name,total,state['next']))
+	
+	def feed(name):
+		""" add the next chunk of tiles (same zoom) to the pool, return False if no more tiles """
+		(server,tiles,running,completed)=seeds[name]
+		chunk=[]
+		skipped=0
+		start=None
+		pending=None
+		for (i,(z,x,y)) in tiles:
+			if start==None:
+				(start,zoom)=(i,z)
+			elif z!=zoom:		# a chunk is for a single zoom : keep the tile for the next chunk
+				pending=(i,(z,x,y))
+				break
+			if cache.incache(cache.buildpath(server.getCacheFName((x,y),z,date,timeshift))):
+				skipped=skipped+1
+			else:
+				chunk.append((x,y))
+			end=i+1
+			if len(chunk)>=config.k_seed_chunk:
+				break
+		if pending:
+			seeds[name]=(server,itertools.chain([pending],tiles),running,completed)
+		if start==None:
+			return False
+		job=FetchJob(server,chunk,zoom,date,timeshift,cache,(name,start,end,skipped))
+		running.append(job)
+		pool.add(job)
+		return True
+	
+	def show():
+		for (n,st) in progress.items():
+			print("%s : %d/%d tile(s), %d skipped, %d error(s), %s" % (n,st['next'],st['total'],st['skipped'],st['errors'],ByteSize(st['bytes'])))
+	
+	pool=FetchPool()
+	pool.start()
+	clock=time.perf_counter()
+	try:
+		while True:
+			# keep 2 chunks per server in the pool
+			for name in list(seeds.keys()):
+				while len(seeds[name][2])<2 and feed(name):
+					pass
+			if sum([len(seeds[name][2]) for name in seeds])==0:
+				break
+			job=pool.get()
+			(name,start,end,skipped)=job.data
+			(server,tiles,running,completed)=seeds[name]
+			running.remove(job)
+			completed[start]=(end,job.total,skipped,job.errors,job.size)
+			# checkpoint : chunks are counted only when all tiles before them are done (exact totals on resume)
+			state=progress[name]
+			while state['next'] in completed:
+				(end,done,skipped,errors,size)=completed.pop(state['next'])
+				state['next']=end
+				state['done']=state['done']+done
+				state['skipped']=state['skipped']+skipped
+				state['errors']=state['errors']+errors
+				state['bytes']=state['bytes']+size
+			if time.perf_counter()-clock>config.k_seed_checkpoint:
+				saveManifest(manifest,filename)
+				clock=time.perf_counter()
+				show()
+	except KeyboardInterrupt:
+		print("seed interrupted, resume with --resume=%s" % filename)
+	pool.close()
+	saveManifest(manifest,filename)
+	show()
+	for s in servers:
+		s.show_licence()
+
 def do_test(servers_list):
 	(x,y)=(16357,11699)
 	zoom=15
@@ -1224,7 +3104,7 @@ def main(argv):
 		
 	# 1/ extract and parse command line arguments to determine parameters
 	try:
-		opts,args=getopt.getopt(argv,"hdo:cb:l:s:z:n:f:m:",["help","display","output=","cache","box=","location=","server=","zoom=","tile=","date=","name=","find=","marker=","test"])
+		opts,args=getopt.getopt(argv,"hdo:cb:l:s:z:n:f:m:",["help","display","output=","cache","box=","location=","server=","zoom=","tile=","date=","name=","find=","marker=","test","batch=","seed=","polygon=","manifest=","resume=","plan","clip","track=","buffer=","pages="])
 	except:
 		Usage()
 		sys.exit(2)
@@ -1244,6 +3124,16 @@ def main(argv):
 	testmode=0
 	markerfile=None
 	nominatim=None
+	batchfile=None
+	seed=None
+	polygon=None
+	manifest_file=os.path.join(config.wrkdir,"seed.json")
+	resume=False
+	plan=False
+	track=None
+	buffer=config.default_buffer
+	page=None
+	zooms=None
 	err=0
 	
 	# handle arguments
@@ -1261,7 +3151,8 @@ def main(argv):
 		elif opt in ("-s","--server"):
 			server_names=arg.split(',')
 		elif opt in ("-z","--zoom"):
-			zoom=int(arg)
+			zooms=parseZoomRange(arg)
+			zoom=zooms[0]
 		elif opt in ("-b","--box"):
 			try:
 				list=arg.split(',')
@@ -1282,11 +3173,12 @@ def main(argv):
 				err+=1
 		elif opt in ("-n","--name"):
 			try:
-				output_filename="%s.png" % locations[arg][0]
-				upleft=locations[arg][1]
-				downright=locations[arg][2]
-				zoom=locations[arg][3]
-				server_names=(locations[arg][4],)
+				loc=catalog.getLocations()[arg]
+				output_filename="%s.png" % loc[0]
+				upleft=loc[1]
+				downright=loc[2]
+				zoom=loc[3]
+				server_names=(loc[4],)
 				centered=False
 			except:
 				print("error location %s not defined" % arg)
@@ -1294,12 +3186,16 @@ def main(argv):
 				err+=1
 		elif opt in ("-f","--find"):
 			try:
+				if ("--clip","") in opts:	# ask for the polygon (geojson)
+					bigtilemap_nominatim.default_polygon="1"
 				url=bigtilemap_nominatim.query_url((arg,))
 				if url.download()==0:
-					results=url.xml_parse()
+					results=url.parse()
 					if len(results)>0:
 						r=results[0]
 						print("RESULT: %s/%s\n\t%s"% (r.familly,r.type,r.fullname))
+						if r.polygon and ("--clip","") in opts:
+							polygon=r.polygon
 						if r.box:
 							upleft=r.box.leftup
 							downright=r.box.rightdown
@@ -1319,18 +3215,147 @@ def main(argv):
 		elif opt in ("-o","--output"):
 			output_filename=arg
 		elif opt=="--date":
-			date=time.strptime("%Y-%m-%d",arg)
+			try:
+				time.strptime(arg,"%Y-%m-%d")
+				date=arg
+			except ValueError:
+				print("error date must be set as YYYY-MM-DD")
+				err+=1
 		elif opt in ("-m","--marker"):
 			markerfile=arg
 		elif opt in ("--test",):
 			print("test option activated")
 			testmode=1
+		elif opt=="--batch":
+			batchfile=arg
+		elif opt=="--seed":
+			try:
+				seed=parseZoomRange(arg)
+			except ValueError:
+				print("error seed zoom range must be set as zmin-zmax")
+				err+=1
+		elif opt=="--polygon":
+			if os.path.isfile(arg):		# GeoJSON file
+				polygon=LoadGeoJSON(arg)
+				if polygon==None:
+					print("error no polygon in",arg)
+					err+=1
+			else:
+				try:
+					list=[float(v) for v in arg.split(',')]
+					polygon=Polygon([Coordinate(list[i],list[i+1]) for i in range(0,len(list)-1,2)])
+					if len(polygon)==0:
+						raise ValueError("3 points required")
+				except ValueError as e:
+					print("error polygon must be set as longitude,latitude pairs or a GeoJSON file",e)
+					err+=1
+		elif opt=="--clip":
+			pass		# see -f
+		elif opt=="--manifest":
+			manifest_file=arg
+		elif opt=="--resume":
+			manifest_file=arg
+			resume=True
+		elif opt=="--plan":
+			plan=True
+		elif opt=="--track":
+			track=LoadTrack(arg)
+			if len(track)==0:
+				print("error no track in",arg)
+				err+=1
+		elif opt=="--buffer":
+			try:
+				buffer=float(arg)
+			except ValueError:
+				print("error buffer must be a distance in meters")
+				err+=1
+		elif opt=="--pages":
+			try:
+				page=tuple([int(v) for v in arg.lower().split('x')])[:2]
+				if len(page)==1:
+					page=(page[0],page[0])
+			except ValueError:
+				print("error pages must be set as WxH (tiles)")
+				err+=1
 		else:
 			Usage()
 			sys.exit()
+	if track:
+		polygon=Corridor(track,buffer)
 	
 	if testmode>0:
-		do_test(tile_servers)
+		do_test(catalog.getServers())
+	elif plan and err==0:
+		cache=Cache(config.cachePath,config.k_cache_max_size,config.k_cache_delay)
+		cache.setactive(use_cache)
+		cache.scan()
+		if polygon:
+			box=polygon.getBox()
+		elif centered:
+			print("plan requires a box (-b, -n or --polygon)")
+			return
+		else:
+			box=BoundingBox(upleft,downright)
+		if seed:
+			zooms=seed
+		elif not zooms:
+			zooms=(zoom,zoom)
+		(nbytes,seconds)=(0,0.0)
+		for s in matchServers(server_names):
+			p=planRequest(s,box,zooms,cache,polygon,date,timeshift,seed==None)
+			print(p)
+			nbytes=nbytes+p.bytes
+			seconds=max(seconds,p.seconds)		# servers are downloaded at once (shared pool)
+		print("total : %s, %.1f seconds" % (ByteSize(int(nbytes)),seconds))
+	elif (seed or resume) and err==0:
+		manifest=None
+		if resume:
+			r=loadManifest(manifest_file)
+			if r==None:
+				return
+			(manifest,match_servers,box,seed,polygon,date,timeshift)=r		# same tiles as the interrupted seed
+			print("resume seed :",manifest_file)
+		else:
+			match_servers=matchServers(server_names)
+			if polygon:
+				box=polygon.getBox()
+			else:
+				box=BoundingBox(upleft,downright)
+		cache=Cache(config.cachePath,config.k_cache_max_size,config.k_cache_delay)
+		cache.setactive(use_cache)
+		cache.clear()
+		print(cache)
+		if config.k_chrono:
+			t0 = time.time()
+		Seed(match_servers,box,seed,cache,manifest_file,polygon,date,timeshift,manifest)
+		if config.k_chrono:
+			print("processing : %.1f seconds" % (time.time()-t0))
+	elif track and err==0:
+		cache=Cache(config.cachePath,config.k_cache_max_size,config.k_cache_delay)
+		cache.setactive(use_cache)
+		cache.clear()
+		print(cache)
+		if not zooms:
+			zooms=(zoom,zoom)
+		if config.k_chrono:
+			t0 = time.time()
+		DoCorridor(matchServers(server_names),polygon,zooms,cache,date,timeshift,output_filename,page)
+		if config.k_chrono:
+			print("processing : %.1f seconds" % (time.time()-t0))
+	elif batchfile:
+		jobs=LoadJobs(batchfile)
+		if len(jobs)==0:
+			print("no job in:",batchfile)
+		else:
+			cache=Cache(config.cachePath,config.k_cache_max_size,config.k_cache_delay)
+			cache.setactive(use_cache)
+			cache.clear()
+			print(cache)
+			if config.k_chrono:
+				t0 = time.time()
+			DoBatch(jobs,cache,date,timeshift)
+			if config.k_chrono:
+				print("processing : %.1f seconds" % (time.time()-t0))
 	else:
 		# read marker file (text) if any
 		mlist=[]
@@ -1342,13 +3367,7 @@ def main(argv):
 			f.close()
 		
 		# define the match server(s) list : using a list of name (server_names) comparing with server.name
-		match_servers=[]
-		for n in server_names:
-			for s in tile_servers:
-				if s.name==n:
-					match_servers.append(s)
-				elif re.search(n,s.name):
-					match_servers.append(s)
+		match_servers=matchServers(server_names)
 		if len(match_servers)==0:
 			print("no server matching for:",server_names)
 			Usage()	
@@ -1372,6 +3391,7 @@ def main(argv):
 			# 2.2/ lets go
 			if config.k_chrono:
 				t0 = time.time()		
+			requests=[]
 			for s in match_servers:
 				if (centered):
 					r=location.getResolution(s,zoom)
@@ -1381,7 +3401,7 @@ def main(argv):
 					dy=360.0*ty/(2.0**zoom)			
 					downright=Coordinate(location.lon+dx,location.lat+dy)
 					upleft=Coordinate(location.lon-dx,location.lat-dy)
-					l=tilexy2ll((tx,ty),zoom)
+					l=[v[0] for v in tile2lonlat([tx],[ty],zoom)]
 					if _compute:	
 						print("location       : %.5f, %.5f, zoom: %d" % (location.lon,location.lat,zoom))
 						print("resolution     : %.5f m/pixel" % location.getResolution(s,zoom))
@@ -1398,6 +3418,8 @@ def main(argv):
 						print("center : %.5f, %.5f, zoom: %d" % (location.lon,location.lat,zoom))
 						print("size   : %.5f, %.5f" % (2*dx,2*dy))
 				box=BoundingBox(upleft,downright)
+				if polygon:
+					box=polygon.getBox()
 				print("Box size (km): %.2f, %.2f" % box.size())
 				if _compute:	
 					(tile0,tile1)=box.convert2Tile(zoom)	
@@ -1405,42 +3427,36 @@ def main(argv):
 				marks=[]
 				if len(mlist)>0:	# handle markers
 					colors=["red","blue","green","orange","black","cyan","magenta","yellow","white"]
-					index=0
-					r=location.getResolution(s,zoom)
 					(tile0,tile1)=box.convert2Tile(zoom)
 					(x0,y0)=(int(tile0[0]),int(tile0[1]))
-					origin=convertFromTile(x0,y0,zoom)
-					for marker in mlist:
-						loc=Coordinate(marker[0],marker[1])
-						dloc=loc-origin
-						px=s.size_x*(2.0**zoom)*dloc.lat/360.0
-						py=-s.size_y*(2.0**zoom)*dloc.lon/360.0
-						marks.append((px,py,colors[index],12))
-						index=index+1
-						if index>=len(colors):
-							index=0
-						if _compute:
-							print("Marker (loc)    : (%.5f,%.5f : %.5f" % (loc.lon,loc.lat,r))
-							print("upleft (loc)    : (%.5f,%.5f)" % (upleft.lon,upleft.lat))
-							print("upleft (tile)   : (%.2f,%.2f) > (%d,%d)" % (tile0[0],tile1[1],x0,y0))
-							print("origin (loc)    : (%.5f,%.5f)" % (origin.lon,origin.lat))
-							print("Marker (dloc)   : (%.5f,%.5f)" % (dloc.lon,dloc.lat))
-							print("Marker (pixels) : (%.1f,%.1f)" % (px,py))
+					# all markers converted at once (vectorized) into map pixels
+					(px,py)=Points.fromCoordinates(mlist).convert2Pixel(zoom,(x0,y0),(s.render_size_x,s.render_size_y))
+					for i in range(len(mlist)):
+						marks.append((float(px[i]),float(py[i]),colors[i%len(colors)],12))
+					if _compute:
+						print("upleft (tile)   : (%.2f,%.2f) > (%d,%d)" % (tile0[0],tile0[1],x0,y0))
+						print("Markers (pixels) :",["(%.1f,%.1f)" % (m[0],m[1]) for m in marks])
 				if output_filename and len(match_servers)>1:
-					filename="%s-%s" % (s.name,output_filename)
+					filename=serverFileName(s,output_filename)
 				else:
 					filename=output_filename
-				Do(s,box,zoom,cache,marks,date,timeshift,filename)
+				requests.append((s,box,zoom,marks,filename))
+			if len(requests)>1:		# several servers : shared download pool
+				DoAll(requests,cache,date,timeshift,polygon)
+			else:
+				for (s,box,zoom,marks,filename) in requests:
+					Do(s,box,zoom,cache,marks,date,timeshift,filename,polygon)
 			if config.k_chrono:
 				t1 = time.time() - t0
 				if config.k_chrono:
 					print("processing : %.1f seconds" % (t1))
 				t0 = time.time()
 
-# main (load essential config file (as global data) then run
-api_keys=LoadAPIKey(config.api_keys_path)
-tile_servers=LoadServers(config.tile_servers_path,api_keys)
-locations=LoadLocation(config.locations_path)
+# essential config files (as global data) are loaded at first access, see Catalog
+catalog=Catalog()
+server_stats=ServerStats(config.statsPath)
 
 if __name__ == '__main__' :
+	config.setup()
 	main(sys.argv[1:])
+	server_stats.save()
@@ -24,17 +24,33 @@
 			adding a result list handler
 			remove for 'format' option, only support XML
 	0.5 : go to python 3
+	0.6 : persistent cache of results (see GeocodeCache)
+			requests limited per host (see HostLimiter)
+			batch geocoding with resume, csv or json output (see Geocode)
+			jsonv2 format (default), results parsed while loading (see query_url.stream)
+			offline search of places allready found (see PlaceIndex)
 """
 
 __author__="Pierre-Alain Dorange"
 __contact__="pdorange@mac.com"
 __copyright__="Copyright 2018-2022, Pierre-Alain Dorange"
 __license__="BSD"
-__version__="0.5"
+__version__="0.6"
 
 # standard modules
 import os.path, sys, getopt
 import socket
+import io
+import codecs
+import json
+import csv
+import time
+import threading,queue
+import itertools,collections
+import re
+import bisect
+import unicodedata
+import sqlite3
 import xml.etree.ElementTree as ET
 if sys.version_info.major==2:			# python 2.x
 	import urllib2
@@ -43,6 +59,7 @@ else:									# python 3.x
 	import urllib.request,urllib.error,urllib.parse
 
 # local modules
+import config
 import bigtilemap
 
 # trick to made utf-8 default encoder/decoder (python 2.x)
@@ -57,18 +74,23 @@ _debug_raw=False
 base_url="http://nominatim.openstreetmap.org/search?"
 query_tag="q="
 format_tag="format="
-format_list=("xml","html","json")
-polygon_tag="polygon="
+format_list=("xml","json","jsonv2")		# parsed formats (see query_url.iterparse)
+polygon_tag="polygon_geojson="
 address_tag="addressdetails="
 country_tag="countrycodes="
 lang_tag="accept-language="
 
-default_format="xml"
+default_format="jsonv2"
 default_country=None
 default_polygon=None
 default_address=None
 default_input=None
 default_output=None
+default_output_format=None
+output_formats=("csv","json")
+
+address_fields={'house_number':'house','road':'road','postcode':'postcode',
+	'city':'city','town':'city','village':'city','state':'state','country':'country'}		# address tag : osm_object field
 
 class osm_object():
 	""" OSM object retrieved from Nominatim
@@ -84,6 +106,7 @@ class osm_object():
 			importance : the Nominatim importance
 			lon, lat : geographic coordinates
 			box : bounding box geo coordinates (lon,lat)-(lon,lat) (if available)
+			polygon : area as a bigtilemap.Polygon (if requested with polygon option and available)
 			house : house number (if available)
 			road : road name (if available)
 			city : city name (if available)
@@ -96,6 +119,7 @@ class osm_object():
 		self.osm_type=""
 		self.location=bigtilemap.Coordinate(0.0,0.0)
 		self.box=None
+		self.polygon=None
 		self.place_id=-1
 		self.rank=-1
 		self.importance=0.0
@@ -125,57 +149,60 @@ class osm_object():
 		self.type=place["type"]
 		self.osm_type=place["osm_type"]
 		self.location=bigtilemap.Coordinate(float(place["lon"]),float(place["lat"]))
+		self.setBox(place.get("boundingbox","").split(','))
+		if "geojson" in place:		# area (polygon option), lines and points are ignored
+			try:
+				self.polygon=bigtilemap.geojsonPolygon(json.loads(place["geojson"]))
+			except (ValueError,KeyError,IndexError,TypeError):
+				self.polygon=None
+		self.setAddress([(item.tag,item.text) for item in raw_place])
+		
+	def parse_json(self,place,map=None):
+		""" parse a json or jsonv2 result (one dict per place), see parse_nominatim """
+		self.id=int(place.get('osm_id',-1))
+		self.place_id=int(place['place_id'])
+		self.rank=int(place.get('place_rank',-1))
+		self.importance=float(place.get('importance',0.0))
+		self.name=place["display_name"]
+		self.familly=place.get("category",place.get("class",""))	# jsonv2 : category, json : class
+		self.type=place["type"]
+		self.osm_type=place.get("osm_type","")
+		self.location=bigtilemap.Coordinate(float(place["lon"]),float(place["lat"]))
+		self.setBox(place.get("boundingbox"))
+		if "geojson" in place:		# area (polygon option), lines and points are ignored
+			try:
+				self.polygon=bigtilemap.geojsonPolygon(place["geojson"])
+			except (ValueError,KeyError,IndexError,TypeError):
+				self.polygon=None
+		self.setAddress(place.get("address",{}).items())
+	
+	def setBox(self,box):
+		""" set the bounding box from the Nominatim one : min lat, max lat, min lon, max lon """
 		try:
-			box=place["boundingbox"].split(',')
 			if box[0]==box[1] and box[2]==box[3]:
 				self.box=None
 			else:
 				up=bigtilemap.Coordinate(float(box[2]),float(box[0]))
 				down=bigtilemap.Coordinate(float(box[3]),float(box[1]))
 				self.box=bigtilemap.BoundingBox(up,down)
-		except:
+		except (ValueError,IndexError,TypeError):
 			self.box=None
-		# try building a simpler-better name (than display_name)
-		name=u""
-		prefix=u""
-		i=0
-		for item in raw_place:		# try to extract as many address information as possible
-			if item.tag==self.type:
-				name=name+prefix+item.text
-				i=i+1
-				prefix=u", "
-			elif item.tag==u'house_number':
-				self.house=item.text
-				name=name+prefix+item.text
-				i=i+1
-				prefix=u", "
-			elif item.tag==u'road':
-				self.road=item.text
-				name=name+prefix+item.text
-				i=i+1
-				prefix=u", "
-			elif item.tag==u'postcode':
-				self.postcode=item.text
-				name=name+prefix+item.text
-				i=i+1
-				prefix=u", "
-			elif item.tag==u'city' or item.tag==u'town' or item.tag==u'village':
-				self.city=item.text
-				name=name+prefix+item.text
-				i=i+1
-				prefix=u", "
-			elif item.tag==u'state':
-				self.state=item.text
-				name=name+prefix+item.text
-				i=i+1
-				prefix=u", "
-			elif item.tag==u'country':
-				self.country=item.text
-				name=name+prefix+item.text
-				i=i+1
-				prefix=u", "
-		if i>=2:
-			self.fullname=name
+	
+	def setAddress(self,items):
+		""" set address details from (tag,text) items (in the result order)
+			and try building a simpler-better name (than display_name)
+		"""
+		names=[]
+		for (tag,text) in items:		# try to extract as many address information as possible
+			if tag==self.type:
+				names.append(text)
+				continue
+			field=address_fields.get(tag)
+			if field:
+				setattr(self,field,text)
+				names.append(text)
+		if len(names)>=2:
+			self.fullname=u", ".join(names)
 		else:
 			self.fullname=self.name
 		if _debug: print(self)
@@ -222,18 +249,247 @@ class osm_list():
 			str=str+u"\n"+r.__str__()
 		return str
 
+def normalizeQuery(query):
+	""" normalized form of a query (for the cache) : unicode NFKC, lower case, single spaces """
+	query=unicodedata.normalize("NFKC",query).lower()
+	return " ".join(query.replace('"',' ').split())
+
+class GeocodeCache():
+	""" persistent cache of Nominatim raw results (sqlite), thread-safe
+		key is the normalized query with its options (language, country, polygon, address, format)
+		results older than delay are ignored, the oldest ones are removed when size exceeds max_size
+		the database is opened at first use
+	"""
+	def __init__(self,path=None,delay=None,max_size=None):
+		if path==None:
+			path=config.geocodePath
+		if delay==None:
+			delay=config.k_geocode_delay
+		if max_size==None:
+			max_size=config.k_geocode_max_size
+		self.path=path
+		self.delay=delay
+		self.max_size=max_size
+		self.db=None
+		self.size=0
+		self.lock=threading.Lock()
+		self.hits=0
+		self.miss=0
+	
+	def open(self):
+		""" open (and create) the database, return False if not possible """
+		if self.db==None:
+			try:
+				self.db=sqlite3.connect(self.path,check_same_thread=False)
+				self.db.execute("PRAGMA journal_mode=WAL")
+				self.db.execute("PRAGMA synchronous=NORMAL")
+				self.db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, date REAL, size INTEGER, data BLOB)")
+				self.db.execute("CREATE INDEX IF NOT EXISTS results_date ON results (date)")
+				self.size=self.db.execute("SELECT COALESCE(SUM(size),0) FROM results").fetchone()[0]
+			except sqlite3.Error as e:
+				print("** error geocoding cache %s : %s" % (self.path,e))
+				self.db=None
+				return False
+		return True
+	
+	def get(self,key):
+		""" return the cached raw result for key, None if unknown, too old or not readable """
+		with self.lock:
+			if not self.open():
+				return None
+			try:
+				row=self.db.execute("SELECT date,data FROM results WHERE key=?",(key,)).fetchone()
+			except sqlite3.Error as e:
+				print("** error geocoding cache :",e)
+				return None
+			if row and time.time()-row[0]<=self.delay:
+				self.hits=self.hits+1
+				return row[1]
+			self.miss=self.miss+1
+			return None
+	
+	def put(self,key,data):
+		""" store a raw result, remove the oldest ones if the cache is too big """
+		with self.lock:
+			if not self.open():
+				return
+			try:
+				with self.db:
+					row=self.db.execute("SELECT size FROM results WHERE key=?",(key,)).fetchone()
+					if row:
+						self.size=self.size-row[0]
+					self.db.execute("INSERT OR REPLACE INTO results (key,date,size,data) VALUES (?,?,?,?)",(key,time.time(),len(data),data))
+					self.size=self.size+len(data)
+					if self.size>self.max_size:
+						self.evict()
+			except sqlite3.Error as e:
+				print("** error geocoding cache :",e)
+	
+	def evict(self):
+		""" remove results too old, then the oldest ones until size fits max_size (lock held) """
+		self.db.execute("DELETE FROM results WHERE date<?",(time.time()-self.delay,))
+		self.size=self.db.execute("SELECT COALESCE(SUM(size),0) FROM results").fetchone()[0]
+		if self.size>self.max_size:
+			remove=[]
+			for (key,size) in self.db.execute("SELECT key,size FROM results ORDER BY date"):
+				if self.size<=self.max_size:
+					break
+				remove.append((key,))
+				self.size=self.size-size
+			self.db.executemany("DELETE FROM results WHERE key=?",remove)
+		if _debug: print("geocoding cache : %d bytes" % self.size)
+	
+	def items(self):
+		""" return all cached (key,raw result), old ones too """
+		with self.lock:
+			if not self.open():
+				return []
+			try:
+				return self.db.execute("SELECT key,data FROM results").fetchall()
+			except sqlite3.Error as e:
+				print("** error geocoding cache :",e)
+				return []
+	
+	def clear(self):
+		""" remove all results """
+		with self.lock:
+			if self.open():
+				with self.db:
+					self.db.execute("DELETE FROM results")
+				self.size=0
+	
+	def close(self):
+		with self.lock:
+			if self.db:
+				self.db.close()
+				self.db=None
+	
+	def __len__(self):
+		with self.lock:
+			if not self.open():
+				return 0
+			return self.db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+	
+	def __repr__(self):
+		return "%d result(s), %d bytes / %d (hits:%d, miss:%d)" % (len(self),self.size,self.max_size,self.hits,self.miss)
+
+geocode_cache=GeocodeCache()		# shared by queries (see query_url.download)
+
+def iterJSONArray(stream,size=16384):
+	""" generator : items of a json array read from a stream (bytes), as soon as they are complete """
+	decoder=json.JSONDecoder()
+	utf8=codecs.getincrementaldecoder("utf-8")()
+	buffer=u""
+	pos=0
+	state=0		# 0 : before the array, 1 : an item is expected, 2 : a separator is expected
+	eof=False
+	chunk=size
+	while True:
+		while pos<len(buffer) and buffer[pos] in u" \t\r\n":
+			pos=pos+1
+		if pos<len(buffer):
+			c=buffer[pos]
+			if state==0:
+				if c!=u"[":
+					raise ValueError("not a json array")
+				(pos,state)=(pos+1,1)
+				continue
+			if c==u"]":
+				return
+			if state==2:
+				if c!=u",":
+					raise ValueError("json separator expected at %d" % pos)
+				(pos,state)=(pos+1,1)
+				continue
+			try:
+				(item,pos)=decoder.raw_decode(buffer,pos)
+				(state,chunk)=(2,size)
+				yield item
+				continue
+			except ValueError:		# incomplete item : read more (larger chunks for large items)
+				if eof:
+					raise
+				chunk=chunk*2
+		if eof:
+			raise ValueError("incomplete json array")
+		data=stream.read(chunk)
+		if not data:
+			eof=True
+		buffer=buffer[pos:]+utf8.decode(data or b"",final=eof)
+		pos=0
+
+class RecordReader():
+	""" read a stream (bytes) and keep a copy of the data read (to cache a streamed response),
+		reads return the data allready received (read1) instead of waiting for size bytes
+	"""
+	def __init__(self,stream):
+		self.stream=stream
+		self.chunks=[]
+	
+	def read(self,size=-1):
+		if size>0 and hasattr(self.stream,"read1"):
+			data=self.stream.read1(size)
+		else:
+			data=self.stream.read(size)
+		self.chunks.append(data)
+		return data
+	
+	def getvalue(self):
+		return b"".join(self.chunks)
+
+class HostLimiter():
+	""" limit the requests per host (usage policy), thread-safe :
+			connections : simultaneous requests
+			rate : requests per second (0 is unlimited)
+	"""
+	def __init__(self,rate=None,connections=None):
+		if rate==None:
+			rate=config.k_nominatim_rate
+		if connections==None:
+			connections=config.k_nominatim_connections
+		self.rate=rate
+		self.connections=max(1,connections)
+		self.lock=threading.Condition()
+		self.active={}			# host : requests running
+		self.next_time={}		# host : next request allowed (perf_counter)
+	
+	def acquire(self,host):
+		""" wait until a request to host is allowed """
+		with self.lock:
+			while True:
+				now=time.perf_counter()
+				active=self.active.get(host,0)
+				wait=self.next_time.get(host,0.0)-now
+				if active<self.connections and wait<=0:
+					break
+				self.lock.wait(wait if wait>0 else None)
+			self.active[host]=active+1
+			if self.rate>0:
+				self.next_time[host]=now+1.0/self.rate
+	
+	def release(self,host,delay=0.0):
+		""" a request to host is finished, delay (seconds) postpones the next one (server asked to retry later) """
+		with self.lock:
+			self.active[host]=self.active[host]-1
+			if delay>0:
+				self.next_time[host]=max(self.next_time.get(host,0.0),time.perf_counter()+delay)
+			self.lock.notify_all()
+
+limiter=HostLimiter()		# shared by queries (see query_url.download)
+
 class query_url():
 	""" Query class : query Nominatim for a geographical list of results
 		see : http://wiki.openstreetmap.org/wiki/Nominatim
 		tags :
 			q : 				the query (text with + separator)
-			format :			result format (xml, html or json)
-			polygon :			1 for boundingbox and polygon coordinates
+			format :			result format (xml, json or jsonv2)
+			polygon_geojson :	1 for polygon coordinates (geojson)
 			addressdetails :	1 for postal address details
 			country :			specify the country
 		init : create the query
-		doawnload : launch the query to Nominatim and doawnload the raw result (xml)
-		xmlparse : analyze the raw result and build a list of osm_objects result
+		doawnload : launch the query to Nominatim and doawnload the raw result, or take it from the cache (see GeocodeCache)
+		parse : analyze the raw result and build a list of osm_objects result
+		stream : download and yield osm_objects results while loading
 	"""
 	def __init__(self,args,lang=None):
 		""" Create a Nominatim query usign args as a list of element to build the query
@@ -241,6 +497,12 @@ class query_url():
 		"""
 		self.url=None
 		self.data=None
+		self.cached=False
+		self.fresh=False		# downloaded data to cache once parsed (see parse)
+		self.tries=0			# downloads tried
+		self.retry=False		# the last download failed but can be tried again (too many requests, network)
+		self.format=default_format or "xml"
+		self.attrib=u""
 		query=""
 		prefix=""
 		for a in args:
@@ -248,6 +510,7 @@ class query_url():
 			query=query+prefix+a
 			prefix="+"
 		self.url='%s%s"%s"' % (base_url,query_tag,query)
+		self.key="%s|%s|%s|%s|%s|%s" % (normalizeQuery(" ".join(args)),lang or "",(default_country or "").lower(),default_polygon or "",default_address or "",default_format)
 		if default_format:
 			self.url=self.url+"&%s%s" % (format_tag,default_format)
 		if default_polygon:
@@ -263,9 +526,24 @@ class query_url():
 	def __str__(self):
 		return self.url
 		
-	def download(self):
-		""" Download the XML results : send query and download raw result"""
+	def download(self,cache=True):
+		""" Download the results : send query and download raw result
+			the result is taken from the cache (if any), else the downloaded one is cached by parse (if valid)
+		"""
+		if cache:
+			self.data=geocode_cache.get(self.key)
+			if self.data!=None:
+				self.cached=True
+				if _debug: print("CACHED:",self.key)
+				return 0
+		if config.k_offline:
+			return 1
 		err=1
+		delay=0.0
+		self.tries=self.tries+1
+		self.retry=False
+		host=urllib.parse.urlsplit(self.url).netloc
+		limiter.acquire(host)
 		try:
 			headers={'User-Agent':self.user_agent}
 			request=urllib.request.Request(self.url,None,headers)
@@ -277,6 +555,7 @@ class query_url():
 				if _debug_raw: print("RESPONSE:",self.data)
 				print("----")
 				err=0
+				self.fresh=cache
 			else:
 				print("** No Stream")
 		except urllib.error.HTTPError as e:
@@ -284,65 +563,507 @@ class query_url():
 			print("HEADER:",headers)
 			print("QUERY:",self.url)
 			print(e.read())
+			if e.code in (429,503):		# too many requests : wait before the next one
+				self.retry=True
+				try:
+					delay=float(e.headers.get('Retry-After',60))
+				except ValueError:
+					delay=60.0
 		except:
+			self.retry=True
 			print("** error can't load over internet : ",sys.exc_info())
 			print("HEADER:",headers)
 			print("QUERY:",self.url)
+		finally:
+			limiter.release(host,delay)
 		return err
 
-	def xml_parse(self,map=None):
-		""" Parse the Nominatim XML results to build a simple osm_object list with interpreted results
-			using ElementTree library
+	def iterparse(self,stream,map=None):
+		""" generator : parse the Nominatim results from a stream (bytes) and yield osm_object as soon as they are complete
+			xml is parsed with ElementTree.iterparse, json/jsonv2 with iterJSONArray
+			the attribution (copyright) is stored into attrib (at the end for xml)
+		"""
+		if self.format=="xml":
+			events=ET.iterparse(stream)		# end events only (the root is known at the end)
+			for (event,elem) in events:
+				if elem.tag=='place':
+					r=osm_object()
+					r.parse_nominatim(elem,map)
+					elem.clear()
+					yield r
+			self.attrib=events.root.attrib.get('attribution',u"")
+		else:
+			for place in iterJSONArray(stream):
+				self.attrib=place.get('licence',self.attrib)
+				r=osm_object()
+				r.parse_json(place,map)
+				yield r
+	
+	def parse(self,map=None):
+		""" Parse the Nominatim results (downloaded data) to build a simple osm_object list with interpreted results 
+			a valid downloaded result is cached (see download)
 		"""
 		results=osm_list()
-		try:
-			root=ET.fromstring(self.data)
-			results.attrib=root.attrib['attribution']
-			if len(root)>0:
-				for raw_result in root:	# parse each individual result and retrieve "place"
-					if raw_result.tag=='place':
-						r=osm_object()
-						r.parse_nominatim(raw_result,map)
-						results.append(r)
-		except:
-			print("error can't parse XML : ",sys.exc_info())
+		try:		# complete data : parsed at once (faster than iterparse)
+			if self.format=="xml":
+				root=ET.fromstring(self.data)
+				self.attrib=root.attrib.get('attribution',u"")
+				for place in root.findall('place'):
+					r=osm_object()
+					r.parse_nominatim(place,map)
+					results.append(r)
+			else:
+				places=json.loads(self.data)
+				if not isinstance(places,list):
+					raise ValueError("not a json array")
+				for place in places:
+					self.attrib=place.get('licence',self.attrib)
+					r=osm_object()
+					r.parse_json(place,map)
+					results.append(r)
+			results.attrib=self.attrib
+			if self.fresh:		# only valid results are cached
+				geocode_cache.put(self.key,self.data)
+				self.fresh=False
+		except Exception:
+			print("error can't parse %s : " % self.format,sys.exc_info())
 			result=osm_object()
 			result.name=sys.exc_info()
 			result.type='error'
 			results=osm_list("error")
 			results.append(result)
 		return results
+	
+	def xml_parse(self,map=None):
+		""" see parse (any format) """
+		return self.parse(map)
+	
+	def stream(self,map=None,cache=True):
+		""" generator : send the query (or use the cache) and yield osm_object results while the response is loading,
+			the complete response is then stored into data (and cached)
+		"""
+		if cache:
+			data=geocode_cache.get(self.key)
+			if data!=None:
+				self.data=data
+				self.cached=True
+				try:
+					for r in self.iterparse(io.BytesIO(data),map):
+						yield r
+				except Exception:
+					print("error can't parse %s : " % self.format,sys.exc_info())
+				return
+		if config.k_offline:
+			return
+		delay=0.0
+		host=urllib.parse.urlsplit(self.url).netloc
+		limiter.acquire(host)
+		try:
+			request=urllib.request.Request(self.url,None,{'User-Agent':self.user_agent})
+			response=urllib.request.urlopen(request)
+			reader=RecordReader(response)
+			for r in self.iterparse(reader,map):
+				yield r
+			reader.read()
+			response.close()
+			self.data=reader.getvalue()
+			if cache:
+				geocode_cache.put(self.key,self.data)
+		except urllib.error.HTTPError as e:
+			print("** HTTP Error:",e.code)
+			print("QUERY:",self.url)
+			if e.code in (429,503):		# too many requests : wait before the next one
+				try:
+					delay=float(e.headers.get('Retry-After',60))
+				except ValueError:
+					delay=60.0
+		except (urllib.error.URLError,socket.error,ET.ParseError,ValueError) as e:
+			print("** error can't load over internet : ",e)
+			print("QUERY:",self.url)
+		except Exception:		# incomplete response, unexpected result...
+			print("error can't parse %s : " % self.format,sys.exc_info())
+			print("QUERY:",self.url)
+		finally:
+			limiter.release(host,delay)
+
+def foldText(text):
+	""" words of a text for matching : normalized (see normalizeQuery), without accents and punctuation """
+	text=unicodedata.normalize("NFKD",normalizeQuery(text))
+	text="".join([c for c in text if not unicodedata.combining(c)])
+	return [w for w in re.split(r"\W+",text) if w]
+
+def trigrams(word):
+	""" set of 3 letters groups of a word (padded with spaces) """
+	w=" "+word+" "
+	return set([w[i:i+3] for i in range(len(w)-2)])
+
+class PlaceIndex():
+	""" offline search index of places (osm_object), thread-safe
+		words are searched by prefix (sorted words) then by trigrams (typo tolerant), 
+		all the query words must match, places are ranked by score then importance
+		sources : locations (locations.ini), previous results and the geocoding cache (see build)
+	"""
+	def __init__(self,threshold=0.5):
+		self.threshold=threshold	# minimum trigrams similarity (dice) for a word with a typo
+		self.places=[]			# osm_object
+		self.keys={}			# place key : index in places (no duplicates)
+		self.words={}			# word : set of places indexes
+		self.grams={}			# trigram : set of words
+		self.sorted=None		# sorted words (for prefix search), None if words changed
+		self.lock=threading.Lock()
+	
+	def placeKey(self,place):
+		""" unique key of a place : Nominatim id, else name and type """
+		if place.place_id>0:
+			return place.place_id
+		return (place.name,place.type)
+	
+	def add(self,place):
+		""" add a place (osm_object), return False if allready known """
+		if place.type=='error':
+			return False
+		with self.lock:
+			key=self.placeKey(place)
+			if key in self.keys:
+				return False
+			i=len(self.places)
+			self.places.append(place)
+			self.keys[key]=i
+			for w in set(foldText(place.name+" "+place.fullname)):
+				ids=self.words.get(w)
+				if ids==None:
+					ids=self.words[w]=set()
+					for g in trigrams(w):
+						self.grams.setdefault(g,set()).add(w)
+					self.sorted=None
+				ids.add(i)
+			return True
+	
+	def addResults(self,results):
+		""" add places (osm_object list), return the number of new ones """
+		n=0
+		for r in results:
+			if self.add(r):
+				n=n+1
+		return n
+	
+	def addLocations(self,locations):
+		""" add locations (see bigtilemap.LoadLocation), return the number of new ones """
+		places=[]
+		for (name,a,b,zoom,server) in locations.values():
+			r=osm_object()
+			r.name=r.fullname=name
+			r.familly="pmx"
+			r.type="location"
+			r.location=bigtilemap.Coordinate((a.lon+b.lon)/2,(a.lat+b.lat)/2)
+			r.box=bigtilemap.BoundingBox(a,b)
+			places.append(r)
+		return self.addResults(places)
+	
+	def addCache(self,cache):
+		""" add the places of the geocoding cache (GeocodeCache, old results too), return the number of new ones """
+		n=0
+		for (key,data) in cache.items():
+			q=query_url(())
+			q.format=key.rsplit("|",1)[-1]		# format is the last part of the key (see query_url)
+			q.data=data
+			n=n+self.addResults(q.parse())
+		return n
+	
+	def build(self,locations=None,results=None,cache=None):
+		""" add all sources (can be run by a thread) """
+		t=time.perf_counter()
+		if locations:
+			self.addLocations(locations)
+		if results:
+			self.addResults(results)
+		if cache:
+			self.addCache(cache)
+		if _debug: print("place index : %d place(s), %d word(s) in %.3f s" % (len(self.places),len(self.words),time.perf_counter()-t))
+	
+	def match(self,token):
+		""" return {place index : score} for a query word : 1 for a word, 0.9 for a prefix, less with typo (lock held) """
+		matches={}
+		i=bisect.bisect_left(self.sorted,token)
+		while i<len(self.sorted) and self.sorted[i].startswith(token):
+			w=self.sorted[i]
+			s=1.0 if w==token else 0.9
+			for p in self.words[w]:
+				if matches.get(p,0.0)<s:
+					matches[p]=s
+			i=i+1
+		if len(token)>=3:
+			grams=trigrams(token)
+			counts={}
+			for g in grams:
+				for w in self.grams.get(g,()):
+					counts[w]=counts.get(w,0)+1
+			for (w,c) in counts.items():
+				s=2.0*c/(len(grams)+len(w))		# dice similarity (a word has len(w) trigrams)
+				if s>=self.threshold:
+					s=0.8*s
+					for p in self.words[w]:
+						if matches.get(p,0.0)<s:
+							matches[p]=s
+		return matches
+	
+	def search(self,query,limit=20):
+		""" return the places (osm_object) matching the query, best first """
+		tokens=foldText(query)
+		if len(tokens)==0:
+			return []
+		with self.lock:
+			if self.sorted==None:
+				self.sorted=sorted(self.words)
+			scores=None
+			for t in tokens:
+				matches=self.match(t)
+				if scores==None:
+					scores=matches
+				else:
+					scores=dict([(p,scores[p]+s) for (p,s) in matches.items() if p in scores])
+				if len(scores)==0:
+					return []
+			ranked=sorted(scores.items(),key=lambda ps:(-ps[1],-self.places[ps[0]].importance))
+			return [self.places[p] for (p,s) in ranked[:limit]]
+	
+	def __len__(self):
+		return len(self.places)
+
+class ResultWriter():
+	""" write geocoding results into a file, incrementally : 
+			csv (one row per result, with a header) or json (one object per line)
+		offset : resume a previous file, truncated at offset (bytes), see Geocode
+	"""
+	fields=("line","query","status","lon","lat","name","fullname","familly","type","rank","importance","osm_type","osm_id","place_id")
+	
+	def __init__(self,filename,format=None,offset=None):
+		if format==None:
+			if os.path.splitext(filename)[1].lower() in (".json",".jsonl"):
+				format="json"
+			else:
+				format="csv"
+		self.format=format
+		if offset!=None and os.path.exists(filename):
+			self.file=open(filename,"r+",encoding="utf-8",newline="")
+			self.file.seek(offset)
+			self.file.truncate()
+		else:
+			self.file=open(filename,"w",encoding="utf-8",newline="")
+			offset=None
+		if self.format=="csv":
+			self.csv=csv.writer(self.file)
+			if offset==None:
+				self.csv.writerow(self.fields)
+	
+	def write(self,line,query,results,count=1):
+		""" write the first count results of a query (all if count is None), a single row if no result """
+		rows=[]
+		if results==None or len(results)==0 or results[0].type=='error':
+			status="none" if results!=None and len(results)==0 else "error"
+			rows.append((line,query,status)+("",)*(len(self.fields)-3))
+		else:
+			for r in results.list[:count]:
+				rows.append((line,query,"ok",r.location.longitude,r.location.latitude,r.name,r.fullname,r.familly,r.type,r.rank,r.importance,r.osm_type,r.id,r.place_id))
+		for row in rows:
+			if self.format=="csv":
+				self.csv.writerow(row)
+			else:
+				self.file.write(json.dumps(dict(zip(self.fields,row)),ensure_ascii=False)+"\n")
+	
+	def tell(self):
+		""" write pending data, return the file size (bytes) """
+		self.file.flush()
+		return self.file.tell()
+	
+	def close(self):
+		self.file.close()
+
+def Geocode(filename,output,format=None,lang=None,resume=False):
+	""" batch geocoding : each line of the input file is a query, the best result is written into output (see ResultWriter)
+		the input is streamed (config.k_geocode_window lines ahead of the output), 
+		cached and duplicated queries are resolved at once, other ones are requested by a pool of threads
+		(config.k_nominatim_thread) limited per host (see HostLimiter)
+		results are written in the input order, progress is saved into output+".resume" to resume later :
+		queries refused (too many requests) or not sent (network) are requeued (config.k_geocode_retry times), 
+		the progress stops before the first line that still failed, so a resume retries it
+	"""
+	checkpoint=output+".resume"
+	state={'input':os.path.abspath(filename),'next':0,'offset':None,'queries':0,'cached':0,'duplicates':0,'requests':0,'errors':0}
+	if resume:
+		try:
+			with open(checkpoint,"r") as f:
+				saved=json.load(f)
+			if saved['input']!=state['input']:
+				print("** %s is not a resume file for %s" % (checkpoint,filename))
+				return
+			state=saved
+			print("resume %s at line %d" % (filename,state['next']+1))
+		except (IOError,ValueError,KeyError) as e:
+			print("no resume file (%s), start from the beginning" % e)
+	
+	def saveState():
+		if len(frozen)==0:
+			state['offset']=writer.tell()
+		with open(checkpoint+".tmp","w") as f:
+			json.dump(frozen or state,f)
+		os.replace(checkpoint+".tmp",checkpoint)
+	
+	def failed(res):
+		return res==None or (len(res)>0 and res[0].type=='error')
+	
+	def show():
+		print("geocoding : %d line(s), %d queries : %d cached, %d duplicate(s), %d request(s), %d error(s)" % (state['next'],state['queries'],state['cached'],state['duplicates'],state['requests'],state['errors']))
+	
+	def worker():
+		""" request the queries (not cached, see main loop), one result per query (None if failed) """
+		for q in iter(work.get,None):
+			res=None
+			try:
+				if q.download(cache=False)==0:
+					res=q.parse()
+					if not failed(res):
+						geocode_cache.put(q.key,q.data)
+				elif q.retry and q.tries<=config.k_geocode_retry:	# requeued : the host limiter waits before the next request
+					work.put(q)
+					q=None
+			except Exception:		# one result per query, whatever happens
+				print("** geocoding error :",sys.exc_info()[1])
+			finally:
+				if q:
+					results.put((q.key,res))
+	
+	writer=ResultWriter(output,format,state['offset'])
+	work=queue.Queue()
+	results=queue.Queue()
+	threads=[]
+	for i in range(max(1,config.k_nominatim_thread)):
+		t=threading.Thread(target=worker)
+		t.daemon=True
+		t.start()
+		threads.append(t)
+	frozen={}			# checkpoint at the first failed line (see saveState)
+	memo=collections.OrderedDict()		# query key : results (recent ones, for duplicates)
+	pending={}			# query key : [(line,query)] waiting for a request
+	ready={}			# line : (query,results) waiting for previous lines to be written
+	infile=open(filename,"r",encoding="utf-8")
+	lines=itertools.islice(enumerate(infile),state['next'],None)
+	read=state['next']
+	line=state['next']		# next line to write
+	eof=False
+	clock=time.perf_counter()
+	try:
+		while True:
+			# read ahead : resolve cached and duplicated queries, request other ones
+			while not eof and read<line+config.k_geocode_window:
+				try:
+					(i,text)=next(lines)
+				except StopIteration:
+					eof=True
+					break
+				read=i+1
+				text=text.strip()
+				if len(text)==0:
+					ready[i]=None
+					continue
+				state['queries']=state['queries']+1
+				q=query_url(text.split(),lang)
+				if q.key in memo:
+					memo.move_to_end(q.key)
+					ready[i]=(text,memo[q.key])
+					state['duplicates']=state['duplicates']+1
+				elif q.key in pending:
+					pending[q.key].append((i,text))
+					state['duplicates']=state['duplicates']+1
+				else:
+					q.data=geocode_cache.get(q.key)
+					if q.data!=None:
+						ready[i]=(text,q.parse())
+						memo[q.key]=ready[i][1]
+						state['cached']=state['cached']+1
+					else:
+						pending[q.key]=[(i,text)]
+						work.put(q)
+						state['requests']=state['requests']+1
+				while len(memo)>config.k_geocode_window:
+					memo.popitem(last=False)
+			# write results in the input order
+			while line in ready:
+				r=ready.pop(line)
+				if r:
+					if failed(r[1]) and len(frozen)==0:		# the checkpoint stops here
+						state['offset']=writer.tell()
+						frozen.update(state)
+					writer.write(line+1,r[0],r[1])
+				line=line+1
+				state['next']=line
+			if eof and len(pending)==0:
+				break
+			if time.perf_counter()-clock>config.k_seed_checkpoint:
+				saveState()
+				show()
+				clock=time.perf_counter()
+			if len(pending)>0 and (eof or read>=line+config.k_geocode_window or not results.empty()):
+				(key,res)=results.get()
+				if failed(res):
+					state['errors']=state['errors']+1
+				else:
+					memo[key]=res
+				for (i,text) in pending.pop(key):
+					ready[i]=(text,res)
+	except KeyboardInterrupt:
+		print("geocoding interrupted, resume with --resume")
+	try:		# forget requests not started
+		while True:
+			work.get_nowait()
+	except queue.Empty:
+		pass
+	for t in threads:
+		work.put(None)
+	infile.close()
+	saveState()
+	writer.close()
+	show()
+	if frozen:
+		print("failed queries from line %d : retry them with --resume" % (frozen['next']+1))
 
 def usage():
 	print("%s %s" % (__file__,__version__))
 	print("------------------------------------------")
 	print("\t-h : help")
-	print("\t-p : return polygon if value is '1'")
+	print("\t-p : return polygon (geojson)")
 	print("\t-a : return full address if value is '1'")
 	print("\t-c : specify a country (fr, gb, de...)")
-	print("\t-i : input file with list of adresses")
+	print("\t-l : language of results (fr, en...)")
+	print("\t-i : input file with list of adresses (one per line)")
 	print("\t-o : output file for coordinates")
+	print("\t-f : output file format : %s (default from output file extension)" % ", ".join(output_formats))
+	print("\t-r : resume a previous batch (input file)")
 	print()
 	
 def main(argv):
 	""" Main :
 		handle command line arguments and launch appropriate processes
 	"""
-	global default_input,default_output,default_polygon,default_address,default_country
+	global default_input,default_output,default_output_format,default_polygon,default_address,default_country
 	
 	print('-------------------------------------------------')
 		
 	# extract and parse command line arguments to determine parameters and arguments
 	try:
-		opts,args=getopt.getopt(argv,"hpac:i:o:",["help","polygon","address","country=","input=","output="])
+		opts,args=getopt.getopt(argv,"hpac:l:i:o:f:r",["help","polygon","address","country=","lang=","input=","output=","format=","resume"])
 	except:
 		usage()
 		sys.exit(2)
+	lang=None
+	resume=False
 	for opt,arg in opts:	# parse arguments
 		if opt in ("-h","--help"):
 			usage()
 		elif opt in ("-c","--country"):
 			default_country=arg
+		elif opt in ("-l","--lang"):
+			lang=arg
 		elif opt in ("-p","--polygon"):
 			default_polygon="1"
 		elif opt in ("-a","--address"):
@@ -351,35 +1072,33 @@ def main(argv):
 			default_input=arg
 		elif opt in ("-o","--output"):
 			default_output=arg
-	result=""
-	results=[]
-	if default_input:	# if input file, take arguments from him
-		file=open(default_input,'r')
-		for line in file:
-			str=line.decode('UTF-8')
-			line=line.replace("\n","")
-			line=line.replace("\r","")
-			url=query_url(line.split())
-			if url.download()==0:
-				results=url.xml_parse()
-				if default_output:
-					result=result+url.ol_export()
-		file.close()
+		elif opt in ("-f","--format"):
+			if arg not in output_formats:
+				print("** unknown format %s (%s)" % (arg,", ".join(output_formats)))
+				sys.exit(2)
+			default_output_format=arg
+		elif opt in ("-r","--resume"):
+			resume=True
+	if default_input:	# if input file, geocode each line
+		if not default_output:
+			print("** an output file is required with an input file")
+			usage()
+			sys.exit(2)
+		Geocode(default_input,default_output,default_output_format,lang,resume)
 	else:				# otherwise take arguments from command line
 		if len(args)==0:
 			usage()
 			sys.exit(2)
-		url=query_url(args)
+		url=query_url(args,lang)
 		if url.download()==0:
-			results=url.xml_parse()
-			if default_output:
-				result=result+url.ol_export()
-	if default_output:	# store result in output text file (if needed)
-		f=open(default_output,"w")
-		f.write(result.encode('UTF-8'))
-		f.close()
-	else:
-		print(results)
+			results=url.parse()
+			if default_output:	# store results in output file (if needed)
+				writer=ResultWriter(default_output,default_output_format)
+				writer.write(1," ".join(args),results,None)
+				writer.close()
+			else:
+				print(results)
 
 if __name__ == '__main__' :
+	config.setup()
 	main(sys.argv[1:])
@@ -15,6 +15,11 @@ default_day_offset=86400
 default_tile_size=256				# most TMS used 256 pixels wide tiles
 max_tiles=300						# maximum tiles per request (to avoid bulk downloads)
 max_errors=0.1						# maximum error rate to build the image
+max_seed_tiles=20000				# maximum tiles per server for seeding (--seed), respect tile servers usage policy
+default_buffer=200					# corridor half width in meters along a track (--track)
+max_plan_memory=1024*1024*1024		# assembly memory above which the planner suggests streaming strips (--plan)
+default_tile_bytes=20*1024			# tile size estimation when no statistics are available (--plan)
+default_tile_seconds=0.3			# tile download time estimation when no statistics are available (--plan)
 mem_cache=50						# memory cache size (tiles) for faster rendering (pmx)
 
 test_loc0=(-1.15367,46.15582)
@@ -27,6 +32,22 @@ k_chrono=True						# measure duration on some action (debug)
 k_cache_delay=96.0*3600.0			# cache age : 96h (in seconds)
 k_cache_max_size=100*1024*1024		# cache max size : 100 MB (in Bytes)
 k_server_timeout=20					# server timeout in seconds
+k_pool_thread=8						# nb thread for the shared download pool (several servers at once)
+k_server_connections=2				# maximum simultaneous downloads per server (shared pool)
+k_server_rate=10.0					# maximum requests per second per server (shared pool), 0 is unlimited
+k_seed_chunk=64						# tiles per download chunk for seeding
+k_seed_checkpoint=5.0				# seconds between seed manifest saves
+k_catalog_poll=2.0					# minimum seconds between servers.ini/api_key.ini modification checks (pmx, on focus), 0 is disabled
+k_viewport_quality=80				# jpeg quality of the last map image (pmx, see viewport_image_file)
+k_config_flush=2.0					# seconds before writing changed settings (pmx database), 0 writes at once
+k_geocode_delay=30*24*3600.0		# geocoding cache age : 30 days (in seconds)
+k_geocode_max_size=10*1024*1024		# geocoding cache max size : 10 MB (in Bytes)
+k_nominatim_rate=1.0				# maximum Nominatim requests per second (usage policy : 1 per second)
+k_nominatim_connections=1			# maximum simultaneous Nominatim requests (usage policy : 1)
+k_nominatim_thread=2				# nb thread for batch geocoding
+k_geocode_window=256				# batch geocoding : input lines read ahead of the last written one
+k_geocode_retry=3					# batch geocoding : retries of a query refused (too many requests) or not sent (network)
+k_offline=False						# no Nominatim requests : search uses the cache and the local index only
 
 # config files
 _resourcesPath="resources"			# local path for ressources (error images, some icons...)
@@ -36,29 +57,41 @@ api_keys_file="api_key.ini"			# api key list (config file)
 tile_servers_file="servers.ini"		# TMS server liste (config file)
 locations_file="locations.ini"		# location list (config file)
 pmx_db_file="pmx.db"				# parameter database (sqlite) stored in _workingdir
+stats_file="stats.json"				# download statistics per server (json) stored in _workingdir
+catalog_file="servers.cache"		# tile servers snapshot (loaded faster than servers.ini) stored in _workingdir
+viewport_file="viewport.json"		# last map viewport (pmx) : position, tiles bounds and recent tiles, stored in _workingdir
+viewport_image_file="viewport.jpg"	# last map image (pmx) displayed at start until tiles are loaded
+geocode_file="geocode.db"			# Nominatim results cache (sqlite) stored in _workingdir
 
 # == handle local directory =======================================
-# create the data directory and set paths for internal data and user data
-# the default directory is the source code directory, user data are stored in user folder (subfolder "ndsreader")
+# set paths for internal data and user data (no side effect at import, see setup)
+# the default directory is the source code directory, user data are stored in user folder (subfolder "bigtilemap")
 
 import sys,os.path
 
-# define source directory (where the OS is currently, at the run time)
-prgdir=os.path.dirname(os.path.abspath(sys.argv[0]))
+# define source directory (where the source code is, independant of the running script)
+prgdir=os.path.dirname(os.path.abspath(__file__))
 
 # set working directory to user home directory (to store user data)
 wrkdir=os.path.join(os.path.expanduser("~"),_workingdir)
-if not os.path.exists(wrkdir):		# create dir if it does not exist
-	os.makedirs(wrkdir)
 
-# set OS default directory to source directory (for internal in/out files, make launch independant location for files))
-os.chdir(prgdir)
-
-print("default dir", prgdir)
-print("data dir", wrkdir)
+def setup():
+	""" create the data directory and set OS default directory to source directory 
+		(for internal in/out files, make launch independant location for files), called by the applications main
+	"""
+	if not os.path.exists(wrkdir):		# create dir if it does not exist
+		os.makedirs(wrkdir)
+	os.chdir(prgdir)
+	print("default dir", prgdir)
+	print("data dir", wrkdir)
 
 # == Create file paths =======================================
 dbPath=os.path.join(wrkdir,pmx_db_file)
+statsPath=os.path.join(wrkdir,stats_file)
+catalogPath=os.path.join(wrkdir,catalog_file)
+viewportPath=os.path.join(wrkdir,viewport_file)
+viewportImagePath=os.path.join(wrkdir,viewport_image_file)
+geocodePath=os.path.join(wrkdir,geocode_file)
 cachePath=os.path.join(wrkdir,_cachedir)
 api_keys_path=os.path.join(prgdir,api_keys_file)
 tile_servers_path=os.path.join(prgdir,tile_servers_file)
@@ -100,6 +100,11 @@ import config
 _debug_sql=False
 _chrono_map=False
 
+# constants
+k_suggestions=20		# local results displayed by the search dialog
+k_search_poll=50		# ms between checks of the remote search results
+k_prefetch=3			# first results whose map tiles are downloaded in advance
+
 # == Code ====================================================
 
 # trick to made utf-8 default encoder/decoder (python 2.x)
@@ -113,14 +118,14 @@ class AppConfig():
 	""" Handle default config (saved in SQLite database)
 		- save/load config into a SQLite database
 		- accessor for the App to the config
+		changes are kept in memory and written in a single transaction (from a timer thread) 
+		config.k_config_flush seconds after the first change, or on save/close
 	"""
 	def __init__(self,dbPath):
 		if _debug_sql: print("pmx database:",dbPath)
 		map_name=""
-		for s in bigtilemap.tile_servers:
-			if s.name==bigtilemap.config.default_server:
-				map_name=s.name
-				break
+		if bigtilemap.config.default_server in bigtilemap.registry:
+			map_name=bigtilemap.config.default_server
 		overlay=""
 		self.params={	'VERSION':('str_value','3'),
 						'MAP':('str_value',map_name),
@@ -134,131 +139,146 @@ class AppConfig():
 						'WIN_Y':('int_value',pmx_map.default_win_y),
 						'QUERY':('str_value',bigtilemap.config.default_query)}
 		self.results=[]
-		self.sql=sqlite3.connect(dbPath)
+		self.dirty=set()		# params changed, not yet written
+		self.timer=None
+		self.lock=threading.Lock()
+		self.sql=sqlite3.connect(dbPath,check_same_thread=False)		# used by the flush timer (with lock)
+		self.prepare()
+	
+	def prepare(self):
+		""" set the database journal (WAL) and create tables (once) """
+		with self.lock:
+			cursor=self.sql.cursor()
+			try:
+				cursor.execute("PRAGMA journal_mode=WAL;")
+				cursor.execute("PRAGMA synchronous=NORMAL;")
+			except sqlite3.Error as e:
+				print("pmx database journal :",e)
+			sql_cmd="CREATE TABLE IF NOT EXISTS params (id TEXT PRIMARY KEY,str_value TEXT,int_value INTEGER,real_value REAL);"
+			if _debug_sql: print(sql_cmd)
+			cursor.execute(sql_cmd)
+			sql_cmd="CREATE TABLE IF NOT EXISTS results (osm_id INTEGER,name TEXT,osm_type TEXT,type TEXT,place INTEGER,longitude REAL,latitude REAL,lon0 REAL,lon1 REAL,lat0 REAL,lat1 REAL);"
+			if _debug_sql: print(sql_cmd)
+			cursor.execute(sql_cmd)
+			self.sql.commit()
+			cursor.close()
 	
 	def get(self,id):
 		try:
 			(field,value)=self.params[id]
-		except:
+		except KeyError:
 			print("param:",id,"do not exist")
-			print(sys.exc_info())
 			value=None
 		return value
 	
 	def set(self,id,value):
-		try:
+		""" change a parameter : written later (see flush) """
+		if id not in self.params:
+			print("param:",id,"do not exist")
+			return
+		with self.lock:
 			(field,old)=self.params[id]
 			if (old!=value):
 				self.params[id]=(field,value)
-				self.save1Param(id,value)
-		except:
-			print("param:",id,"do not exist")
-			print(sys.exc_info())
+				self.dirty.add(id)
+				if self.timer==None and bigtilemap.config.k_config_flush>0:
+					self.timer=threading.Timer(bigtilemap.config.k_config_flush,self.flush)
+					self.timer.daemon=True
+					self.timer.start()
+		if bigtilemap.config.k_config_flush<=0:
+			self.flush()
 	
-	def load1Param(self,id,c=None):
-		""" load 1 parameter from database (sql cursor is optionnal) """
-		if not c:
-			c=self.sql.cursor()
-			close=True
-		else:
-			close=False
-		try:
-			(field,value)=self.params[id]
-			sql_cmd="SELECT %s FROM params WHERE id = ?;" % field
-			if _debug_sql: print(sql_cmd,"=",id)
-			c.execute(sql_cmd,(id,))
-			data=c.fetchone()
-			if _debug_sql: print("\tresult:",data)
-			if data==None or len(data)==0:
-				sql_cmd="INSERT INTO params (id,%s) VALUES (?,?);" % field
-				if _debug_sql: print(sql_cmd)
-				c.execute(sql_cmd,(id,str(value)))
-				self.sql.commit()
-			else:
-				value=data[0]
-				self.params[id]=(field,value)
-		except:
-			value=None
-			print("param:",id,"do not exist")
-			print(sys.exc_info())
-		if close :
-			c.close()
-		return value
-		
-	def save1Param(self,id,value,c=None):
-		""" save 1 parameter from database (sql cursor is optionnal) """
-		if not c:
-			c=self.sql.cursor()
-			close=True
-		else:
-			close=False
-		try:
-			(field,value)=self.params[id]
-			sql_cmd="UPDATE params SET %s=? WHERE id=?;" % field
-			if _debug_sql: print(sql_cmd)
-			c.execute(sql_cmd,(str(value),id))
-			self.sql.commit()
-			if close :
-				c.close()
-		except:
-			print("param:",id,"do not exist")
-			print(sys.exc_info())
+	def paramRow(self,id):
+		""" database row values (str_value,int_value,real_value,id) for a parameter """
+		(field,value)=self.params[id]
+		row=[None,None,None,id]
+		row[("str_value","int_value","real_value").index(field)]=value
+		return tuple(row)
+	
+	def flush(self):
+		""" write changed parameters in a single transaction """
+		with self.lock:
+			self.timer=None
+			if len(self.dirty)==0:
+				return
+			rows=[self.paramRow(id) for id in self.dirty]
+			self.dirty=set()
+			try:
+				with self.sql:
+					self.sql.executemany("UPDATE params SET str_value=?,int_value=?,real_value=? WHERE id=?;",rows)
+				if _debug_sql: print("params saved :",[r[3] for r in rows])
+			except sqlite3.Error as e:
+				print("pmx database, can't save params :",e)
+	
+	def save(self):
+		""" write pending changes now (on quit) """
+		with self.lock:
+			if self.timer:
+				self.timer.cancel()
+				self.timer=None
+		self.flush()
+	
+	def close(self):
+		self.save()
+		with self.lock:
+			self.sql.close()
 		
 	def loadParams(self):
-		""" load all parameters from local SQL database
+		""" load all parameters from local SQL database (one query), 
+			missing parameters are stored with their default value
 		"""
-		cursor=self.sql.cursor()
-		# create table if not allready done
-		sql_cmd="CREATE TABLE IF NOT EXISTS params (id TEXT PRIMARY KEY,str_value TEXT,int_value INTEGER,real_value REAL);"
-		if _debug_sql: print(sql_cmd)
-		cursor.execute(sql_cmd)
-		self.sql.commit()
-		# load params
-		for k in self.params.keys():
-			self.load1Param(k,cursor)
-		cursor.close()
+		with self.lock:
+			cursor=self.sql.cursor()
+			sql_cmd="SELECT id,str_value,int_value,real_value FROM params;"
+			if _debug_sql: print(sql_cmd)
+			cursor.execute(sql_cmd)
+			found=set()
+			for (id,str_value,int_value,real_value) in cursor.fetchall():
+				if id in self.params:
+					field=self.params[id][0]
+					value={"str_value":str_value,"int_value":int_value,"real_value":real_value}[field]
+					if value!=None:
+						self.params[id]=(field,value)
+						found.add(id)
+			missing=[id for id in self.params if id not in found]
+			if missing:
+				if _debug_sql: print("new params :",missing)
+				with self.sql:
+					self.sql.executemany("INSERT OR REPLACE INTO params (str_value,int_value,real_value,id) VALUES (?,?,?,?);",[self.paramRow(id) for id in missing])
+			cursor.close()
 		# check consistancy : mapname still valid
 		mapname=self.get("MAP")
-		for s in bigtilemap.tile_servers:
-			if s.name==mapname:
-				return
+		if mapname in bigtilemap.registry:
+			return
 		# if not mapname valid, select the default one, or the first one
-		mapname=""
-		for s in bigtilemap.tile_servers:
-			if s.name==bigtilemap.config.default_server:
-				mapname=s.name
-				break
-		if len(mapname)==0:
-			mapname=bigtilemap.tile_servers[0]
+		if bigtilemap.config.default_server in bigtilemap.registry:
+			mapname=bigtilemap.config.default_server
+		else:
+			mapname=bigtilemap.tile_servers[0].name
 		self.set('MAP',mapname)
 		
 	def saveParams(self):
 		""" Save all parameters to local SQL database
 		"""
-		cursor=self.sql.cursor()
-		for k in self.params.keys():
-			self.save1Param(k,cursor)
-		cursor.close()
+		with self.lock:
+			self.dirty=set(self.params.keys())
+		self.save()
 		
 	def loadResults(self):
 		cursor=self.sql.cursor()
-		# create table if not allready done
-		sql_cmd="CREATE TABLE IF NOT EXISTS results (osm_id INTEGER,name TEXT,osm_type TEXT,type TEXT,place INTEGER,longitude REAL,latitude REAL,lon0 REAL,lon1 REAL,lat0 REAL,lat1 REAL);"
-		if _debug_sql: print(sql_cmd)
-		cursor.execute(sql_cmd)
-		self.sql.commit()
-		# load
 		sql_cmd="SELECT osm_id,name,osm_type,type,place,longitude,latitude,lon0,lon1,lat0,lat1 FROM results;"
 		if _debug_sql: print(sql_cmd)
-		cursor.execute(sql_cmd)
+		with self.lock:
+			cursor.execute(sql_cmd)
+			rows=cursor.fetchall()
 		self.results=[]
-		for i in cursor.fetchall():
+		for i in rows:
 			r=bigtilemap_nominatim.osm_object()
 			r.id=int(i[0])
 			r.name=i[1]
 			r.osm_type=i[2]
 			r.type=i[3]
-			r.placeid=int(i[4])
+			r.place_id=int(i[4])
 			r.location=bigtilemap.Coordinate(float(i[5]),float(i[6]))
 			leftup=bigtilemap.Coordinate(float(i[7]),float(i[9]))
 			rightdown=bigtilemap.Coordinate(float(i[8]),float(i[10]))
@@ -267,14 +287,16 @@ class AppConfig():
 		cursor.close()
 		
 	def saveResults(self):
-		cursor=self.sql.cursor()
-		sql_cmd="DELETE FROM results;"
-		cursor.execute(sql_cmd)
+		""" replace the results in a single transaction """
 		sql_cmd="INSERT INTO results(osm_id,name,osm_type,type,place,longitude,latitude,lon0,lon1,lat0,lat1) VALUES(?,?,?,?,?,?,?,?,?,?,?);"
+		rows=[]
 		for r in self.results:
-			cursor.execute(sql_cmd,(r.id,r.name,r.osm_type,r.type,r.place_id,r.location.lon,r.location.lat,r.box.leftup.lon,r.box.rightdown.lon,r.box.leftup.lat,r.box.rightdown.lat))
-		self.sql.commit()
-		cursor.close()
+			box=r.box or bigtilemap.BoundingBox(r.location,r.location)		# point result
+			rows.append((r.id,r.name,r.osm_type,r.type,r.place_id,r.location.lon,r.location.lat,box.leftup.lon,box.rightdown.lon,box.leftup.lat,box.rightdown.lat))
+		with self.lock:
+			with self.sql:
+				self.sql.execute("DELETE FROM results;")
+				self.sql.executemany(sql_cmd,rows)
 		
 class main_gui(tkinter.Frame):
 	""" display the main window : map exploxer
@@ -310,17 +332,12 @@ class main_gui(tkinter.Frame):
 		self.root.title("%s %s" % (__application__,__version__))
 		# default map config (get last parameters)
 		self.currentMap=None
-		self.currentOverlay=None
-		map=self.config.get('MAP')
-		for s in bigtilemap.tile_servers:
-			if s.name==map:
-				self.currentMap=s
-				break
-		overlay=self.config.get('OVERLAY')
-		for s in bigtilemap.tile_servers:
-			if s.name==overlay:
-				self.currentOverlay=s
-				break
+		self.currentOverlays=[]
+		self.currentMap=bigtilemap.registry.get(self.config.get('MAP'))
+		for overlay in self.config.get('OVERLAY').split(","):		# overlays stack, comma separated
+			s=bigtilemap.registry.get(overlay.strip())
+			if s:
+				self.currentOverlays.append(s)
 		lon=self.config.get('LONGITUDE')
 		lat=self.config.get('LATITUDE')
 		dl=bigtilemap.Coordinate(lon,lat)
@@ -335,7 +352,7 @@ class main_gui(tkinter.Frame):
 		# create Tkinter variables
 		self.serverInfos=tkinter.StringVar()
 		self.serverRights=tkinter.StringVar()
-		self.setServerText(self.currentMap,self.currentOverlay)
+		self.setServerText(self.currentMap,self.currentOverlays)
 		self.statusInfos=tkinter.StringVar()
 		self.statusInfos.set(str(self.cache))
 		self.zoomInfos=tkinter.StringVar()
@@ -358,7 +375,7 @@ class main_gui(tkinter.Frame):
 		self.mList=tkinter.Listbox(self,width=28,height=20,relief=tkinter.RIDGE,yscrollcommand=self.mScroll.set,font=("Arial",11),exportselection=0)
 		self.oListLabel=tkinter.Label(self,text="Overlay",anchor=tkinter.W,font=("Arial",12,'bold'))
 		self.oScroll=tkinter.Scrollbar(self,orient=tkinter.VERTICAL)
-		self.oList=tkinter.Listbox(self,width=28,height=10,relief=tkinter.RIDGE,yscrollcommand=self.oScroll.set,font=("Arial",11),exportselection=0)
+		self.oList=tkinter.Listbox(self,width=28,height=10,relief=tkinter.RIDGE,yscrollcommand=self.oScroll.set,font=("Arial",11),exportselection=0,selectmode=tkinter.MULTIPLE)
 		self.dateTxt=tkinter.Label(self,textvariable=self.dateInfos,anchor=tkinter.W,justify=tkinter.CENTER,font=("Arial",10))
 		self.bDateAdd=tkinter.Button(self,text="+",width=1,command=self.doDateAdd)
 		self.bDateMin=tkinter.Button(self,text="-",width=1,command=self.doDateMin)
@@ -405,13 +422,54 @@ class main_gui(tkinter.Frame):
 		self.bSearch.grid(row=6,column=3,padx=2,pady=2)
 		# apply default config
 		self.map.setMapServer(self.currentMap)
-		self.map.setOverlayServer(self.currentOverlay)
+		self.map.setOverlays(self.currentOverlays)
 		self.map.setLocation(dl,dz)
 		self.map.setDate(time.localtime(time.time()-config.default_day_offset))
 		self.map.setShift(0)
+		self.map.loadViewport()		# previous map image and recent tiles, while loading
+		# local search index (places allready found), built in background
+		self.places=bigtilemap_nominatim.PlaceIndex()
+		task=threading.Thread(target=self.places.build,args=(bigtilemap.locations,self.config.results,bigtilemap_nominatim.geocode_cache))
+		task.daemon=True
+		task.start()
+		# watch the servers files : checked when pmx gets the focus back (no timer while idle)
+		bigtilemap.catalog.addListener(self.onCatalogChanged)
+		self.catalog_clock=time.perf_counter()
+		if config.k_catalog_poll>0:
+			self.winfo_toplevel().bind("<FocusIn>",self.checkCatalog,add="+")
+		
+	def checkCatalog(self,event=None):
+		""" reload servers.ini and api_key.ini if modified (see bigtilemap.Catalog.reload), 
+			on focus (the files are edited in another application), at most every k_catalog_poll seconds
+		"""
+		if time.perf_counter()-self.catalog_clock<config.k_catalog_poll:
+			return
+		self.catalog_clock=time.perf_counter()
+		bigtilemap.catalog.reload()
+	
+	def onCatalogChanged(self,added,changed,removed):
+		""" servers were reloaded : forget tiles of changed/removed servers, 
+			use the new servers for the current map and overlays, and reload the lists
+		"""
+		print("servers reloaded : %d added, %d changed, %d removed" % (len(added),len(changed),len(removed)))
+		registry=bigtilemap.registry
+		for name in changed+removed:
+			self.map.discardServer(name)
+		if self.currentMap:
+			self.currentMap=registry.get(self.currentMap.name)
+		if self.currentMap==None:
+			self.currentMap=registry.get(config.default_server,bigtilemap.tile_servers[0])
+		self.currentOverlays=[registry.get(s.name) for s in self.currentOverlays if s.name in registry]
+		self.mList.delete(0,tkinter.END)
+		self.oList.delete(0,tkinter.END)
+		self.loadList()
+		self.map.setMapServer(self.currentMap)
+		self.map.setOverlays(self.currentOverlays)
+		self.setServerText(self.currentMap,self.currentOverlays)
 		
 	def quit(self):
 		self.config.save()
+		bigtilemap.server_stats.save()
 		tkinter.Frame.quit(self)
 		
 	def loadList(self):
@@ -419,7 +477,7 @@ class main_gui(tkinter.Frame):
 		self.overlays=[None]
 		self.maps=[]
 		mIndex=-1
-		oIndex=-1
+		oIndex=[]
 		for s in bigtilemap.tile_servers:
 			title="%s (%d-%d)" % (s.name,s.min_zoom,s.max_zoom)
 			if s.handleDate:
@@ -431,10 +489,9 @@ class main_gui(tkinter.Frame):
 			if s.type=="overlay":
 				self.oList.insert(tkinter.END,title)
 				self.overlays.append(s)
-				if self.currentOverlay:
-					if s.name==self.currentOverlay.name:
-						oIndex=len(self.overlays)-1
-						if pmx_map._debug_gui: print("default overlay:",oIndex,s.name)
+				if s in self.currentOverlays:
+					oIndex.append(len(self.overlays)-1)
+					if pmx_map._debug_gui: print("default overlay:",oIndex[-1],s.name)
 			else:
 				self.mList.insert(tkinter.END,title)
 				self.maps.append(s)
@@ -444,8 +501,10 @@ class main_gui(tkinter.Frame):
 						if pmx_map._debug_gui: print("default map:",mIndex,s.name)
 		self.mList.selection_set(mIndex)
 		self.mList.see(mIndex)
-		self.oList.selection_set(oIndex)
-		self.oList.see(oIndex)
+		for i in oIndex:
+			self.oList.selection_set(i)
+		if oIndex:
+			self.oList.see(oIndex[0])
 	
 	def on_map_select(self,event):
 		sel=event.widget.curselection()
@@ -459,21 +518,23 @@ class main_gui(tkinter.Frame):
 			self.currentMap=None
 		if pmx_map._debug_gui: print("\tmap:",self.currentMap)
 		self.map.setMapServer(self.currentMap)
-		self.setServerText(self.currentMap,self.currentOverlay)
+		self.setServerText(self.currentMap,self.currentOverlays)
 	
 	def on_overlay_select(self,event):
-		sel=event.widget.curselection()
-		if sel:
-			id=int(sel[0])
-			if pmx_map._debug_gui: print("select:",id)
-			self.currentOverlay=self.overlays[id]
-		else:
-			id=-1
-			if pmx_map._debug_gui: print("noselect:")
-			self.currentOverlay=None
-		if pmx_map._debug_gui: print("\tmap:",self.currentOverlay)
-		self.map.setOverlayServer(self.currentOverlay)
-		self.setServerText(self.currentMap,self.currentOverlay)
+		sel=[int(i) for i in event.widget.curselection()]
+		if pmx_map._debug_gui: print("select:",sel)
+		if 0 in sel:		# "None" clear the overlays stack
+			event.widget.selection_clear(0,tkinter.END)
+			sel=[]
+		# keep the stacking order of the previous selection, new overlays go on top
+		overlays=[s for s in self.currentOverlays if self.overlays.index(s) in sel]
+		for id in sel:
+			if self.overlays[id] not in overlays:
+				overlays.append(self.overlays[id])
+		self.currentOverlays=overlays
+		if pmx_map._debug_gui: print("\tmap:",self.currentOverlays)
+		self.map.setOverlays(self.currentOverlays)
+		self.setServerText(self.currentMap,self.currentOverlays)
 	
 	def doZoomIn(self):
 		self.map.setZoom(self.map.zoom+1)
@@ -499,10 +560,9 @@ class main_gui(tkinter.Frame):
 		if self.map.handleTimeShift:
 			shift=self.map.getShift()
 			s=None
-			if self.map.mapServer.handleTimeShift:
-				s=self.map.mapServer.timeshift_string
-			if self.map.overlayServer.handleTimeShift:
-				s=self.map.overlayServer.timeshift_string
+			server=self.map.getTimeShiftServer()
+			if server:
+				s=server.timeshift_string
 			if s==None: print("error: no map ahndling timeshift")
 			else:
 				shift=shift+step
@@ -520,7 +580,7 @@ class main_gui(tkinter.Frame):
 		d=ExportDialog(self.root,self.map,title="Export current Map")
 	
 	def doSearch(self):
-		d=SearchDialog(self.root,self.map,title="Search",query=self.config.get('QUERY'),results=self.config.results)
+		d=SearchDialog(self.root,self.map,title="Search",query=self.config.get('QUERY'),results=self.config.results,index=self.places)
 		if d.location:
 			if d.zoom>0:
 				self.map.setLocation(d.location,d.zoom)
@@ -544,11 +604,9 @@ class main_gui(tkinter.Frame):
 				if self.map.handleTimeShift:
 					shift=self.map.getShift()
 					str="-"
-					if shift<len(self.map.mapServer.timeshift_string):
-						str=self.map.mapServer.timeshift_string[shift]
-					if self.map.overlayServer:
-						if shift<len(self.map.overlayServer.timeshift_string):
-							str=self.map.overlayServer.timeshift_string[shift]
+					server=self.map.getTimeShiftServer()
+					if server and shift<len(server.timeshift_string):
+						str=server.timeshift_string[shift]
 					txt="timeshift:%s" % str
 		self.dateInfos.set(txt)
 	
@@ -558,11 +616,11 @@ class main_gui(tkinter.Frame):
 			self.clock=time.perf_counter()+2.0
 		self.statusInfos.set("Status: "+self.cacheStrSize+status)
 		
-	def setServerText(self,server=None,overlay=None):
+	def setServerText(self,server=None,overlays=None):
 		if not(server):
 			server=self.currentMap
-		if not(overlay):
-			overlay=self.currentOverlay
+		if overlays==None:
+			overlays=self.currentOverlays
 		if server:
 			try:
 				infoStr="%s (zoom:%d-%d)" % (server.name,server.min_zoom,server.max_zoom)
@@ -576,7 +634,7 @@ class main_gui(tkinter.Frame):
 			except:
 				print("error with currentMap:",server)
 				print(sys.exc_info())
-			if overlay:
+			for overlay in overlays:
 				try:
 					infoStr=infoStr+"\n----------------------"
 					infoStr=infoStr+"\n%s (zoom:%d-%d)" % (overlay.name,overlay.min_zoom,overlay.max_zoom)
@@ -612,6 +670,7 @@ class ExportDialog(tkinter.Toplevel):
 		self.filevar.set(self.filename)
 		self.parent=parent
 		self.result=None
+		self.job=None			# running export
 		body=tkinter.Frame(self)
 		self.initial_focus=self.body(body)
 		body.pack(padx=5,pady=5)
@@ -632,8 +691,8 @@ class ExportDialog(tkinter.Toplevel):
 		self.zoomVar=tkinter.IntVar()
 		self.zoomVar.set(self.zoommod)
 		licence="map:%s by %s\nmap: %s\ntile: %s" % (self.map.mapServer.name,self.map.mapServer.provider,self.map.mapServer.tile_copyright,self.map.mapServer.data_copyright)
-		if self.map.overlayServer:
-			licence=licence+"\n\noverlay:%s by %s\nmap: %s\ntile: %s" % (self.map.overlayServer.name,self.map.overlayServer.provider,self.map.overlayServer.tile_copyright,self.map.overlayServer.data_copyright)
+		for layer in self.map.overlays:
+			licence=licence+"\n\noverlay:%s by %s\nmap: %s\ntile: %s" % (layer.server.name,layer.server.provider,layer.server.tile_copyright,layer.server.data_copyright)
 		# buld dialog GUI
 		l=tkinter.Label(self,text="Image size")
 		l.pack(anchor=tkinter.W)
@@ -654,8 +713,12 @@ class ExportDialog(tkinter.Toplevel):
 		l.pack()
 		m=tkinter.Message(self,text=licence,font=("Arial",10),width=350)
 		m.pack()
+		self.progressVar=tkinter.StringVar()
+		l=tkinter.Label(self,textvariable=self.progressVar,font=("Arial",10))
+		l.pack()
 		b=tkinter.Button(self,text="OK",command=self.ok)
 		b.pack(side=tkinter.RIGHT,pady=10,padx=5)
+		self.bOk=b
 		b=tkinter.Button(self,text="Cancel",command=self.cancel)
 		b.pack(side=tkinter.RIGHT,pady=10,padx=5)
 		# bind action buttons
@@ -671,16 +734,39 @@ class ExportDialog(tkinter.Toplevel):
 		self.filevar.set(self.filename)
 		
 	def ok(self,event=None):
-		self.map.export(self.filename,self.zoommod)
+		if self.job or not self.filename:
+			return
 		if not self.validate():
 			self.initial_focus.focus_set()
 			return
-		self.withdraw()
-		self.update_idletasks()
-		self.apply()
-		self.cancel()
+		self.job=self.map.export(self.filename,self.zoommod,self.progress,self.finish)
+		if self.job:
+			self.bOk.configure(state=tkinter.DISABLED)
+		
+	def progress(self,job,n,total,size,eta):
+		""" display export progress (called by the map during export) """
+		if job.state=="loading":
+			txt="tiles: %d/%d, %.1f KB" % (n,total,size/1024.0)
+			if eta!=None:
+				txt=txt+", ETA: %d s" % int(eta+0.5)
+		else:
+			txt=job.state
+		self.progressVar.set(txt)
+		
+	def finish(self,filename):
+		""" end of export (called by the map) : close if done """
+		self.job=None
+		if filename:
+			self.withdraw()
+			self.update_idletasks()
+			self.apply()
+			self.cancel()
+		else:
+			self.bOk.configure(state=tkinter.NORMAL)
 		
 	def cancel(self,event=None):
+		if self.job:		# cancel the running export and close
+			self.map.cancelExport()
 		self.filename=None
 		self.parent.focus_set()
 		self.destroy()
@@ -695,7 +781,7 @@ class ExportDialog(tkinter.Toplevel):
 class SearchDialog(tkinter.Toplevel):
 	""" Handle dialog window to search geographic location
 	"""
-	def __init__(self,parent,map,title=None,query="",results=[]):
+	def __init__(self,parent,map,title=None,query="",results=[],index=None):
 		tkinter.Toplevel.__init__(self,parent)
 		self.transient(parent)
 		if title:
@@ -704,6 +790,10 @@ class SearchDialog(tkinter.Toplevel):
 		self.query=query
 		self.parent=parent
 		self.results=results
+		self.index=index		# local places (bigtilemap_nominatim.PlaceIndex) for instant suggestions
+		self.suggested=query	# query of the displayed suggestions
+		self.local=[]			# local results (displayed after the remote ones)
+		self.remote=None		# remote results (queue) of the running query
 		self.location=None
 		self.zoom=0
 		body=tkinter.Frame(self)
@@ -723,7 +813,7 @@ class SearchDialog(tkinter.Toplevel):
 		
 	def buttonbox(self):
 		# prepare options and data
-		m=tkinter.Message(self,text="Search location using Nominatim service",font=("Arial",12,"bold"),width=350)
+		m=tkinter.Message(self,text="Search location using Nominatim service (and places allready found)",font=("Arial",12,"bold"),width=350)
 		m.pack()
 		r=tkinter.Frame(self)
 		l=tkinter.Label(r,text="Query:")
@@ -751,6 +841,7 @@ class SearchDialog(tkinter.Toplevel):
 		self.rScroll.configure(command=self.rList.yview)
 		self.bind("<Return>",self.ok)
 		self.bind("<Escape>",self.cancel)
+		self.q.bind("<KeyRelease>",self.suggest)
 		#
 		self.q.delete(0,tkinter.END)
 		self.q.insert(0,self.query)
@@ -761,13 +852,78 @@ class SearchDialog(tkinter.Toplevel):
 		for r in self.results:
 			self.rList.insert(tkinter.END,"(%s) %s" % (r.type,r.name))
 	
+	def suggest(self,event=None):
+		""" instant local suggestions while typing (see bigtilemap_nominatim.PlaceIndex) """
+		query=self.q.get()
+		if self.index==None or self.remote or query==self.suggested:
+			return
+		self.suggested=query
+		self.local=self.index.search(query,k_suggestions)
+		self.results=list(self.local)
+		self.buildResultsList()
+		self.bOk.config(state=tkinter.DISABLED)
+	
 	def search(self,event=None):
+		""" search local places (instant), then query Nominatim in a thread, remote results are displayed first """
 		self.query=self.q.get()
-		q=bigtilemap_nominatim.query_url(self.query.split())
-		q.download()
-		self.results=q.xml_parse(self.map)
+		self.suggested=self.query
+		self.local=[]
+		if self.index:
+			self.local=self.index.search(self.query,k_suggestions)
+		self.results=list(self.local)
 		self.buildResultsList()
 		self.bOk.config(state=tkinter.DISABLED)
+		self.rListLabel.config(text="Result(s) : searching...")
+		q=bigtilemap_nominatim.query_url(self.query.split())
+		self.remote=queue.Queue()
+		task=threading.Thread(target=self.remoteSearch,args=(q,self.remote))
+		task.daemon=True
+		task.start()
+		self.after(k_search_poll,self.checkRemote,q,self.remote,[])
+	
+	def remoteSearch(self,q,remote):
+		""" run the Nominatim query (thread) : results are sent one by one, then None """
+		try:
+			for r in q.stream(self.map):
+				remote.put(r)
+		finally:		# always end the search (see checkRemote)
+			remote.put(None)
+	
+	def checkRemote(self,q,remote,found):
+		""" display the remote results received (polled), followed by the local results not found remotely """
+		if remote is not self.remote or not self.winfo_exists():		# another search, or closed
+			return
+		done=False
+		new=[]
+		while not remote.empty():
+			r=remote.get()
+			if r==None:
+				done=True
+			else:
+				new.append(r)
+		if len(new)>0:
+			found.extend(new)
+			self.results=list(found)
+			if self.index:
+				keys=set([self.index.placeKey(r) for r in found])
+				self.results=self.results+[r for r in self.local if self.index.placeKey(r) not in keys]
+			self.buildResultsList()
+			self.bOk.config(state=tkinter.DISABLED)
+		if done:
+			self.remote=None
+			if q.data==None:
+				self.rListLabel.config(text="Result(s) : Nominatim not available, local results")
+			else:
+				self.rListLabel.config(text="Result(s)")
+			if self.index:
+				self.index.addResults(found)
+			self.prefetch()
+		else:
+			self.after(k_search_poll,self.checkRemote,q,remote,found)
+	
+	def prefetch(self):
+		""" download in advance (low priority) the map of the first results, displayed at once if selected """
+		self.map.prefetch([(r.location,self.getZoom(r.box)) for r in self.results[:k_prefetch]])
 	
 	def on_result_select(self,event=None):
 		sel=event.widget.curselection()
@@ -818,9 +974,14 @@ def main(sargs):
 		w=tkinter.Tk()
 		i=main_gui(w,cfg)
 		w.mainloop()
+		i.map.saveViewport()
+		cfg.close()
+		bigtilemap.server_stats.save()
+		bigtilemap_nominatim.geocode_cache.close()
 	else:
 		print("error : no map servers defined")
 
 #this calls the 'main' function when this script is executed
 if __name__ == '__main__': 
+	config.setup()
 	main(sys.argv[1:])
@@ -16,7 +16,7 @@ _debug_offscreen=False
 _debug_export=False
 
 # == Standard Library =======================================
-import os,sys,time
+import os,sys,time,json
 import threading,queue
 import tkinter, tkinter.filedialog, tkinter.messagebox		# Tkinter (TK/TCL for Python) : Simple standard GUI (no-OS dependant)
 
@@ -30,18 +30,41 @@ import bigtilemap
 # == Constants & Globals ==============================================
 (default_win_x,default_win_y)=(800,600)
 (default_win_pos_x,default_win_pos_y)=(20,20)
-k_frame=20
+k_fallback=3				# zoom levels searched for temporary tiles while loading
+k_frame=20				# frame budget (ms) : redraws are coalesced within this delay
+k_prefetch_thread=2		# threads downloading tiles in advance (see TMapWidget.prefetch)
+
+# -- Tools ---------------------------
+
+def tkPaste(photo,img,coord):
+	""" copy a PIL image into a part of a tk photo image at coord (x,y),
+		only this sub-rectangle is transfered to tk (the photo is not reallocated)
+	"""
+	tmp=ImageTk.PhotoImage(img)
+	photo.tk.call(str(photo),"copy",str(tmp),"-to",int(coord[0]),int(coord[1]))
+
+def checkZoom(zoom,servers):
+	""" bound zoom to the zoom range shared by all servers (base map and overlays) """
+	(zmin,zmax)=(0,99)
+	for s in servers:
+		(szmin,szmax)=s.getZoom()
+		zmin=max(zmin,szmin)
+		zmax=min(zmax,szmax)
+	if zoom<zmin:
+		return zmin
+	if zoom>zmax:
+		return zmax
+	return zoom
 
 # -- Map Classes ---------------------
 
 class TMapWidget(tkinter.Canvas):
 	""" the map canvas : handle displaying the map in a tkinter canvas
-		used a tk's offscreen and rely on 2 bigtilemap objects for rendering map (base layout + overlay)
+		used a tk's offscreen and rely on a bigtilemap object for rendering map (base layout + overlay)
 		also handle the task queue for loading tiles.
-			mapOffscreen : the offscreen full image for map (larger than viewed, see bigtilemap.py)
+			mapOffscreen : the offscreen full image for map+overlay (larger than viewed, see bigtilemap.py)
 			mapServer : map server used for base layout
-			overlayOffscreen : the offscreen full image for overlay (larger than viewed, see bigyilemap.py)
-			overlayServer : map server used for overlay
+			overlays : overlays stack (bigtilemap.Layer list), composited per tile into mapOffscreen
 			tkOffscreen : the tk version of the offsceen image (mix map+overlay), to allow tkinter to handle draw in canvas
 			work_queue : tiles to download
 			result_queue : tiles downloaded and not displayed
@@ -53,19 +76,24 @@ class TMapWidget(tkinter.Canvas):
 		self.parent=window
 		self.item=None
 		self.tkOffscreen=None
+		self.tkSource=None		# offscreen image copied into tkOffscreen (to detect a new offscreen)
 		self.loadingImg=window.loadingImg
+		self.tkLoading=ImageTk.PhotoImage(self.loadingImg)
+		self.loadingItem=None
 		self.errorImg=window.errorImage
 		self.mapOffscreen=bigtilemap.BigTileMap()			# main map (base)
 		self.mapOffscreen.setErrorImage(self.errorImg)
+		self.mapOffscreen.setFallback(k_fallback)		# display scaled tiles while loading (smooth zoom)
 		self.mapServer=None
-		self.overlayOffscreen=bigtilemap.BigTileMap(overlay=True)		# overlmay ùmap (if any)
-		self.overlayOffscreen.setErrorImage(self.errorImg)
-		self.overlayServer=None
+		self.overlays=[]			# overlays stack (bigtilemap.Layer)
+		self.snapshot=None			# previous map image displayed at start (see loadViewport)
 		self.location=None			# the center of the map (geographic coordinates)
 		self.zoom=0					# zoom level
 		self.date=None
 		self.shift=0
 		self.cache=cache	# the cache handler
+		if self.cache:		# new tiles invalidate the ram caches
+			self.cache.addListener(self.mapOffscreen.invalidate)
 		self.loading=False		# display the loading logo
 		(self.xmin,self.ymin)=(0,0)		# size of the rendered map (offscreen) in pixels
 		(self.xmax,self.ymax)=(0,0)
@@ -88,10 +116,114 @@ class TMapWidget(tkinter.Canvas):
 		self.clock_task=False
 		self.fps_clock=0.0
 		self.fps=0
+		self.fps_rects=0		# sub-rectangles copied into tkOffscreen
+		self.fps_pixels=0		# pixels copied into tkOffscreen
 		if _debug_offscreen:
 			self.frame=0
-		self.after(0,self.idle)		# force idle to finish initializing
+		# event driven updates : loading threads notify new tiles, idle is only scheduled when required
+		self.idle_id=None			# scheduled idle (tk after id)
+		self.frame_clock=0.0		# last idle (to respect the k_frame budget)
+		self.notify_lock=threading.Lock()
+		self.notify_pending=set()	# notifications (tk virtual events) sent and not yet handled
+		try:	# notification from threads require a thread-enabled tcl, else poll while loading
+			self.polling=not(int(self.tk.eval("set tcl_platform(threaded)")))
+		except tkinter.TclError:
+			self.polling=True
+		self.bind("<<TilesLoaded>>",self.onTilesLoaded)
+		# background export (see export)
+		self.exportJob=None
+		self.exportFile=None
+		self.exportProgress=None
+		self.exportFinish=None
+		self.bind("<<ExportProgress>>",self.onExportProgress)
+		self.prefetchPool=None		# low priority downloads (see prefetch)
+		self.wakeup()		# force idle to finish initializing
 
+	def wakeup(self):
+		""" schedule an idle (if not allready done), coalesced within the frame budget (k_frame) """
+		if self.idle_id==None:
+			delay=k_frame-int(1000.0*(time.perf_counter()-self.frame_clock))
+			self.idle_id=self.after(max(delay,1),self.idle)
+	
+	def post(self,name):
+		""" send a virtual event to the tk loop from a thread (thread-safe)
+			only one notification per event is pending at a time
+		"""
+		with self.notify_lock:
+			if name in self.notify_pending:
+				return
+			self.notify_pending.add(name)
+		try:
+			self.event_generate(name,when="tail")
+		except (RuntimeError,tkinter.TclError):		# tk main loop not running (closing)
+			pass
+	
+	def handled(self,name):
+		""" a posted event is handled (in tk loop) : allow a new one """
+		with self.notify_lock:
+			self.notify_pending.discard(name)
+	
+	def notify(self):
+		""" called by loading threads when a tile is loaded : wake up the tk loop """
+		self.post("<<TilesLoaded>>")
+	
+	def onTilesLoaded(self,event=None):
+		""" handle notification from loading threads (in tk loop) """
+		self.handled("<<TilesLoaded>>")
+		self.wakeup()
+	
+	def notifyExport(self):
+		""" called by export threads for each tile (and at the end of rendering) """
+		self.post("<<ExportProgress>>")
+	
+	def onExportProgress(self,event=None):
+		""" handle export progress (in tk loop) : report progress, render when all tiles are loaded """
+		self.handled("<<ExportProgress>>")
+		job=self.exportJob
+		if job==None:
+			return
+		if job.state=="loading" and job.ready():
+			job.state="rendering"
+			task=threading.Thread(target=self.renderExport,args=(job,self.exportFile))
+			task.start()
+		if self.exportProgress:
+			self.exportProgress(job,*job.getProgress())
+		if job.state in ("done","cancelled","error"):
+			if _debug_chrono:
+				(n,total,size,eta)=job.getProgress()
+				clk=time.perf_counter()-job.clock
+				print("export %s: %d/%d image(s), %d bytes in %.1f s" % (job.state,n,total,size,clk))
+			if _debug_export:
+				print("export:",self.exportFile,job.state)
+			finish=self.exportFinish
+			self.exportJob=None
+			self.exportProgress=None
+			self.exportFinish=None
+			if finish:
+				if job.state=="done":
+					finish(self.exportFile)
+				else:
+					finish(None)
+		elif self.polling:		# no notification from threads
+			self.after(k_frame*5,self.onExportProgress)
+	
+	def renderExport(self,job,filename):
+		""" export thread : assemble the big image and save it """
+		try:
+			img=job.render()
+			if not job.cancel_event.is_set():		# cancelled while rendering : no file
+				img.save(filename)
+				if job.cancel_event.is_set():
+					os.remove(filename)
+			if job.cancel_event.is_set():
+				job.state="cancelled"
+			else:
+				job.state="done"
+		except (IOError,ValueError,KeyError) as e:
+			print("export error:",filename,e)
+			job.state="error"
+		self.notifyExport()
+	
 	def onClicDown(self,event):
 		""" Handle clic : first clic active drag motion """
 		event.widget.bind ("<Motion>", self.onClicDrag)
@@ -114,10 +246,11 @@ class TMapWidget(tkinter.Canvas):
 			print("move (pixels) : ",(mx,my))
 			print("move (tiles) : ",(mtx,mty))
 		# adjust (new) location according to drag, and memorize
-		self.location.convertFromTile((x-mtx,y-mty),self.zoom)
+		self.location=bigtilemap.Coordinate.fromTile((x-mtx,y-mty),self.zoom)
 		self.parent.config.set('LONGITUDE',self.location.longitude)
 		self.parent.config.set('LATITUDE',self.location.latitude)
 		self.refresh=True
+		self.wakeup()
 	
 	def onClicDrag(self,event):
 		""" handle drag (clic maintain and mouse moved) : 
@@ -150,9 +283,7 @@ class TMapWidget(tkinter.Canvas):
 			print("tiles : ",(x,y),(int(x),int(y)))
 			print("move (pixels) : ",(mx,my))
 			print("move (tiles) : ",(mtx,mty))
-		loc=self.location
-		loc.convertFromTile((x+mtx,y+mty),self.zoom)
-		self.setLocation(loc)
+		self.setLocation(bigtilemap.Coordinate.fromTile((x+mtx,y+mty),self.zoom))
 		self.setZoom(self.zoom+1)
 	
 	def onResize(self,event):
@@ -162,6 +293,7 @@ class TMapWidget(tkinter.Canvas):
 		self.xdtile=int((0.5*self.winfo_width()/self.mapServer.render_size_x)+1.0)
 		self.ydtile=int((0.5*self.winfo_height()/self.mapServer.render_size_y)+1.0)
 		self.refresh=True
+		self.wakeup()
 		# memorize new default window size
 		self.parent.config.set('WIN_X',self.winfo_width()-6)
 		self.parent.config.set('WIN_Y',self.winfo_height()-6)
@@ -178,6 +310,35 @@ class TMapWidget(tkinter.Canvas):
 		""" return the offscreen size """
 		return self.mapOffscreen.getSize()
 		
+	def getServers(self):
+		""" return the servers used by the map : base map then overlays """
+		servers=[]
+		if self.mapServer:
+			servers.append(self.mapServer)
+		for l in self.overlays:
+			servers.append(l.server)
+		return servers
+	
+	def getTimeShiftServer(self):
+		""" return the (last) server handling timeshift, None if no one """
+		server=None
+		for s in self.getServers():
+			if s.handleTimeShift:
+				server=s
+		return server
+	
+	def updateHandles(self):
+		""" update date/hour/timeshift handling according to map and overlays """
+		self.handleDate=False
+		self.handleHour=False
+		self.handleTimeShift=False
+		for s in self.getServers():
+			self.handleDate=self.handleDate or s.handleDate
+			self.handleHour=self.handleHour or s.handleHour
+			self.handleTimeShift=self.handleTimeShift or s.handleTimeShift
+		if self.handleTimeShift and _debug_gui: 
+			print("Timeshift")
+		
 	def setMapServer(self,map_server):
 		""" define a new map server and store default (+update zoom if necessary) """
 		if map_server:
@@ -185,77 +346,142 @@ class TMapWidget(tkinter.Canvas):
 				self.mapServer=map_server
 				mapname=self.mapServer.name
 				self.parent.config.set('MAP',mapname)
-				# update zoom/date/timeshift widget according to map and overlay
-				self.handleTimeShift=False
-				self.handleDate=False
-				self.handleHour=False
+				# update zoom/date/timeshift widget according to map and overlays
 				self.shift=0
 				self.setZoom(self.zoom)
-				if self.mapServer.handleDate:
-					self.handleDate=True
-				else:
-					if self.overlayServer:
-						if self.overlayServer.handleDate:
-							self.handleDate=True
-				if self.mapServer.handleHour:
-					self.handleHour=True
-				else:
-					if self.overlayServer:
-						if self.overlayServer.handleHour:
-							self.handleHour=True
-				if self.mapServer.handleTimeShift:
-					self.handleTimeShift=True
-				else:
-					if self.overlayServer:
-						if self.overlayServer.handleTimeShift:
-							self.handleTimeShift=True
-				if self.handleTimeShift and _debug_gui: 
-					print("Timeshift")
+				self.updateHandles()
 				# refresh GUI according to new server
 				self.parent.setDateText()
 				self.onResize(None)
 				self.refresh=True
-		
-	def setOverlayServer(self,overlay_server):
-		""" define a new overlay server for the map from its name and store default (+update zoom) """
-		if self.overlayServer!=overlay_server:
-			self.overlayServer=overlay_server
-			# store new setting nto config
-			if self.overlayServer:
-				mapname=self.overlayServer.name
-			else:
-				mapname=""
-			self.parent.config.set('OVERLAY',mapname)
+				self.wakeup()
+	
+	def discardServer(self,name):
+		""" forget tiles of a server in memory (the server was changed or removed) """
+		self.mapOffscreen.tile_cache.discardServer(name)
+		self.refresh=True
+	
+	def isLoading(self):
+		""" True while tiles of the map are waiting to be downloaded or downloading 
+			(a tile is done after its download, see LoadImagesFromURL)
+		"""
+		return self.work_queue.unfinished_tasks>0
+	
+	def prefetch(self,places):
+		""" download in advance (low priority) the tiles of the map (and overlays) displayed at other places, 
+			places is a list of (location,zoom), zoom is the current one if 0 (see setLocation),
+			previous prefetches not yet started are cancelled
+		"""
+		if self.mapServer==None:
+			return
+		if self.prefetchPool==None:
+			self.prefetchPool=bigtilemap.FetchPool(k_prefetch_thread,self.errorImg,self.isLoading)
+			self.prefetchPool.start()
+		self.prefetchPool.clear()
+		while not self.prefetchPool.finished.empty():		# finished jobs are not used
+			self.prefetchPool.finished.get()
+		servers=self.getServers()
+		n=0
+		for (location,zoom) in places:
+			zoom=checkZoom(zoom or self.zoom,servers)
+			(x,y)=location.convert2Tile(zoom)
+			n_tiles=2**zoom
+			tiles=[]
+			for tx in range(max(0,int(x)-self.xdtile),min(n_tiles-1,int(x)+self.xdtile)+1):
+				for ty in range(max(0,int(y)-self.ydtile),min(n_tiles-1,int(y)+self.ydtile)+1):
+					tiles.append((tx,ty))
+			for s in servers:
+				if self.cache:
+					tlist=[t for t in tiles if not self.cache.incache(self.cache.buildpath(s.getCacheFName(t,zoom,self.date,self.shift)))]
+				else:
+					tlist=tiles
+				self.prefetchPool.add(bigtilemap.FetchJob(s,tlist,zoom,self.date,self.shift,self.cache))
+				n=n+len(tlist)
+		if _debug_gui:
+			print("prefetch : %d tile(s) for %d place(s)" % (n,len(places)))
+	
+	def getViewportKey(self):
+		""" what the offscreen shows (except its position) : servers, zoom and date (if used) """
+		date=""
+		if self.date and (self.handleDate or self.handleHour):
+			date=time.strftime("%Y-%m-%d %H",self.date)
+		return {'server':self.mapServer.name,'overlays':[l.server.name for l in self.overlays],'zoom':self.zoom,'date':date,'shift':self.shift}
+	
+	def saveViewport(self):
+		""" save the last composed offscreen (jpeg) with its tiles bounds, 
+			and the recently used tiles (ram cache), to be reused at next start (see loadViewport)
+		"""
+		img=self.mapOffscreen.getImg()
+		if img==None or self.mapServer==None:
+			return
+		viewport=self.getViewportKey()
+		viewport['tiles']=[self.mapOffscreen.x0,self.mapOffscreen.y0,self.mapOffscreen.x1,self.mapOffscreen.y1]
+		viewport['recent']=self.mapOffscreen.tile_cache.keys()
+		try:
+			img.convert("RGB").save(config.viewportImagePath,"JPEG",quality=config.k_viewport_quality)
+			with open(config.viewportPath+".tmp","w") as f:
+				json.dump(viewport,f)
+			os.replace(config.viewportPath+".tmp",config.viewportPath)
+		except (IOError,OSError,ValueError) as e:
+			print("error saving viewport :",e)
+	
+	def loadViewport(self):
+		""" load the previous map image (displayed at first paint if it's still the same map, see paintViewport)
+			and pre-warm the ram cache with the recently used tiles (background thread)
+		"""
+		try:
+			with open(config.viewportPath,"r") as f:
+				viewport=json.load(f)
+			img=Image.open(config.viewportImagePath)
+			img.load()
+		except (IOError,OSError,ValueError) as e:
+			if _debug_gui:
+				print("no viewport :",e)
+			return
+		viewport['image']=img
+		self.snapshot=viewport
+		recent=viewport.get('recent',[])
+		if len(recent)>0:
+			threading.Thread(target=self.mapOffscreen.prewarm,args=(recent[-self.mapOffscreen.tile_cache.size:],),daemon=True).start()
+		self.wakeup()
+	
+	def paintViewport(self):
+		""" paint the previous map image into the offscreen (once), if the map is the same """
+		snapshot=self.snapshot
+		self.snapshot=None
+		key=self.getViewportKey()
+		for k in key.keys():
+			if snapshot.get(k)!=key[k]:
+				if _debug_gui:
+					print("viewport changed (%s), not displayed" % k)
+				return
+		(x0,y0,x1,y1)=snapshot['tiles']
+		if x1<self.xmin or x0>self.xmax or y1<self.ymin or y0>self.ymax:
+			return
+		self.mapOffscreen.paintSnapshot(snapshot['image'],(x0,y0))
+	
+	def setOverlays(self,layers):
+		""" define the overlays stack (list of bigtilemap.Layer, or TileServer for default opacity and blend)
+			the first overlay is drawn first, store default (+update zoom)
+		"""
+		layers=[l if isinstance(l,bigtilemap.Layer) else bigtilemap.Layer(l) for l in layers if l]
+		if self.overlays!=layers:
+			self.overlays=layers
+			# store new setting into config
+			self.parent.config.set('OVERLAY',",".join([l.server.name for l in self.overlays]))
 			# update zoom/date and timeshift if required
 			self.setZoom(self.zoom)
-			if self.overlayServer and self.overlayServer.handleDate:
-				self.handleDate=True
-			else:
-				if self.mapServer.handleDate:
-					self.handleDate=True
-				else:
-					self.handleDate=False
-			if self.overlayServer and self.overlayServer.handleHour:
-				self.handleHour=True
-			else:
-				if self.mapServer.handleHour:
-					self.handleHour=True
-				else:
-					self.handleHour=False
-			if self.overlayServer and self.overlayServer.handleTimeShift:
-				self.handleTimeShift=True
-			else:
-				if self.mapServer.handleTimeShift:
-					self.handleTimeShift=True
-				else:
-					self.handleTimeShift=False
+			self.updateHandles()
 			self.shift=0
-			if self.handleTimeShift and _debug_gui: 
-				print("Timeshift (overlay)")
-			# refresh GUI according to new overlay
+			# refresh GUI according to new overlays
 			self.parent.setDateText()
 			self.onResize(None)
 			self.refresh=True
+			self.wakeup()
+		
+	def setOverlayServer(self,overlay_server):
+		""" define a single overlay server for the map (or None) """
+		self.setOverlays([overlay_server])
 	
 	def setLocation(self,location,zoom=None):
 		""" define a new location (with optional zoom) for the map and store default 
@@ -268,27 +494,17 @@ class TMapWidget(tkinter.Canvas):
 			self.parent.config.set('LONGITUDE',self.location.longitude)
 			self.parent.config.set('LATITUDE',self.location.latitude)
 			self.refresh=True
+			self.wakeup()
 		
 	def setZoom(self,zoom):
 		""" define a new zoom for the map and store default, check for zoom boundary """
-		(zmmin,zmmax)=self.mapServer.getZoom()
-		if self.overlayServer:
-			(zomin,zomax)=self.overlayServer.getZoom()
-			zmin=max(zmmin,zomin)
-			zmax=min(zmmax,zomax)
-		else:
-			(zmin,zmax)=(zmmin,zmmax)
-		if zoom<zmin:
-			z=zmin
-		elif zoom>zmax:
-			z=zmax
-		else:
-			z=zoom
+		z=checkZoom(zoom,self.getServers())
 		if z!=self.zoom:	# set new zoom and update config
 			self.zoom=z
 			self.parent.setZoomText("z=%d" % self.zoom)
 			self.parent.config.set('ZOOM',self.zoom)
 			self.refresh=True
+			self.wakeup()
 	
 	def setDate(self,date=None):
 		""" setDate : define a date (for mapserver using date : handleDate) """
@@ -296,16 +512,17 @@ class TMapWidget(tkinter.Canvas):
 			self.date=date
 			self.parent.setDateText()
 			self.refresh=True
+			self.wakeup()
 	
 	def setShift(self,shift):
 		""" setShift : define a timeshift (for mapserver using timeshift : handleTimeShift) """
 		if shift!=self.shift:
 			self.shift=shift
-			self.mapServer.timeshift=shift
-			if self.overlayServer:
-				self.overlayServer.timeshift=shift
+			for s in self.getServers():
+				s.timeshift=shift
 			self.parent.setDateText()
 			self.refresh=True
+			self.wakeup()
 	
 	def getDate(self):
 		""" return the data (string format) linked with the map (for map using date) or the current date of others"""
@@ -322,7 +539,11 @@ class TMapWidget(tkinter.Canvas):
 			return 0
 
 	def idle(self):
-		""" Handle updates : called when idle by tk GUI (and after __init__) """
+		""" Handle updates : scheduled by wakeup (refresh requested or tiles loaded)
+			nothing is scheduled when no work is pending
+		"""
+		self.idle_id=None
+		self.frame_clock=time.perf_counter()
 		status=" / work: %d, result: %d" % (self.work_queue.qsize(),self.result_queue.qsize())
 		self.parent.setStatus(status)
 		old_status=self.loading
@@ -345,8 +566,12 @@ class TMapWidget(tkinter.Canvas):
 					self.clock=0
 					if self.fps_clock>0.0:
 						print("fps: %.2f fps" % (self.fps/self.fps_clock))
+					if self.fps>0:
+						print("frame: %.2f ms, %.1f rect(s), %d pixels" % (1000.0*self.fps_clock/self.fps,1.0*self.fps_rects/self.fps,self.fps_pixels/self.fps))
 					self.fps=0
 					self.fps_clock=0.0
+					self.fps_rects=0
+					self.fps_pixels=0
 		else:
 			self.loading=False
 		if self.loading!=old_status:	# update loading status
@@ -357,7 +582,11 @@ class TMapWidget(tkinter.Canvas):
 			self.updateMap()
 			if _debug_idle: 
 				print("update")
-		self.after(k_frame,self.idle)
+		if self.loading:
+			if self.polling:	# no notification from threads
+				self.wakeup()
+			elif self.work_queue.empty() and self.result_queue.empty():	# last tiles : one more frame to hide loading
+				self.wakeup()
 		
 	def refreshOffscreen(self):
 		""" refresh the map : create offscren and launch tiles loading (asynchronous)
@@ -374,7 +603,6 @@ class TMapWidget(tkinter.Canvas):
 		self.ymax=int(y)+self.ydtile
 		# update offscreen maps sizes
 		self.mapOffscreen.setSize((self.xmin,self.ymin),(self.xmax,self.ymax))
-		self.overlayOffscreen.setSize((self.xmin,self.ymin),(self.xmax,self.ymax))
 		# compute offset to match center of the map (location) with the center of the area displayed
 		sz=self.getWidgetSize()
 		#sz=(self.winfo_width(),self.winfo_height())
@@ -391,24 +619,23 @@ class TMapWidget(tkinter.Canvas):
 			self.clock=time.perf_counter()
 			self.clock_task=True
 			s=(self.xmax-self.xmin+1)*(self.ymax-self.ymin+1)
-			if self.overlayServer:
-				s=s*2
+			s=s*(1+len(self.overlays))
 			self.clock_nb=self.clock_nb+s
 		# fill the task queue with tiles to retrieve
 		for x in range(self.xmin,self.xmax+1):
 			for y in range(self.ymin,self.ymax+1) :
 				self.work_queue.put((x,y,self.zoom,self.mapServer,self.date,self.shift,self.cache))
-		if self.overlayServer:
+		for layer in self.overlays:
 			for x in range(self.xmin,self.xmax+1):
 				for y in range(self.ymin,self.ymax+1) :
-					self.work_queue.put((x,y,self.zoom,self.overlayServer,self.date,self.shift,self.cache))
+					self.work_queue.put((x,y,self.zoom,layer.server,self.date,self.shift,self.cache))
 		# launch the task queue (to retrieve tiles)
 		if (config.k_nb_thread>1):		# for asyncrhonous : launch process to handle the queues
 			for i in range(config.k_nb_thread):
-				task=bigtilemap.LoadImagesFromURL(self.work_queue,self.result_queue,self.errorImg)
+				task=bigtilemap.LoadImagesFromURL(self.work_queue,self.result_queue,self.errorImg,self.notify,failed=self.mapOffscreen.fail)
 				task.start()
 		else:	# for synchronous : run a single task until queue is empty
-			task=bigtilemap.LoadImagesFromURL(self.work_queue,self.result_queue,self.errorImg)
+			task=bigtilemap.LoadImagesFromURL(self.work_queue,self.result_queue,self.errorImg,failed=self.mapOffscreen.fail)
 			task.run()
 		self.refresh=False
 		
@@ -425,41 +652,72 @@ class TMapWidget(tkinter.Canvas):
 		# create the offscreen and assemble into it
 		if _debug_chrono: 
 			self.fps_clock=self.fps_clock-time.perf_counter()
+		map_img=None
 		if self.mapServer:
-			self.mapOffscreen.setServer(self.mapServer,self.zoom,self.date)
+			self.mapOffscreen.setServer(self.mapServer,self.zoom,self.date,self.shift,self.overlays)
 			self.mapOffscreen.setSize((self.xmin,self.ymin),(self.xmax,self.ymax))
-			self.mapOffscreen.build()
+			if self.snapshot:		# first paint : the previous map image, refined as tiles are loaded
+				self.paintViewport()
+			self.mapOffscreen.build()		# map+overlay composited per tile
 			map_img=self.mapOffscreen.getImg()
-			if self.overlayServer:
-				self.overlayOffscreen.setServer(self.overlayServer,self.zoom,self.date)
-				self.overlayOffscreen.setSize((self.xmin,self.ymin),(self.xmax,self.ymax))
-				self.overlayOffscreen.build()
-				if _debug_offscreen:
-					map_img.save("debug_%05d_base_map.%s" % (self.frame,self.mapServer.extension))
-				layer=self.overlayOffscreen.getImg()
-				map_img.paste(layer,mask=layer)
-				if _debug_offscreen:
-					layer.save("debug_%05d_layer.%s" % (self.frame,self.overlayServer.extension))
-					map_img.save("debug_%05d_final_map.%s" % (self.frame,self.mapServer.extension))
-					self.frame=self.frame+1
-			# loading indicator
+			dirty=self.mapOffscreen.dirty
+			# copy map+overlay into the TK image : one TK image per offscreen size, 
+			# copy all for a new offscreen, else only changed tiles
+			if self.tkOffscreen==None or (self.tkOffscreen.width(),self.tkOffscreen.height())!=map_img.size:
+				self.tkOffscreen=ImageTk.PhotoImage(map_img)
+				self.tkSource=map_img
+				if _debug_chrono:
+					self.fps_rects=self.fps_rects+1
+					self.fps_pixels=self.fps_pixels+map_img.size[0]*map_img.size[1]
+			elif self.tkSource is not map_img:
+				self.tkOffscreen.paste(map_img)
+				self.tkSource=map_img
+				if _debug_chrono:
+					self.fps_rects=self.fps_rects+1
+					self.fps_pixels=self.fps_pixels+map_img.size[0]*map_img.size[1]
+			else:
+				if len(dirty)>self.mapOffscreen.wx*self.mapOffscreen.wy/2:	# many tiles : one single copy is faster
+					dirty=[(0,0)+map_img.size]
+				for box in dirty:
+					tkPaste(self.tkOffscreen,map_img.crop(box),box)
+					if _debug_chrono:
+						self.fps_rects=self.fps_rects+1
+						self.fps_pixels=self.fps_pixels+(box[2]-box[0])*(box[3]-box[1])
+			if _debug_offscreen:
+				map_img.save("debug_%05d_final_map.png" % self.frame)
+				self.frame=self.frame+1
+			# canvas items are created once, then only moved
+			if self.item==None:
+				self.item=self.create_image(-self.offsetx,-self.offsety,image=self.tkOffscreen,anchor=tkinter.NW)
+			else:
+				self.itemconfigure(self.item,image=self.tkOffscreen)
+				self.coords(self.item,-self.offsetx,-self.offsety)
+			# loading indicator (above the map, centered into the widget)
+			(x,y)=(self.winfo_width()/2,self.winfo_height()/2)
+			if self.loadingItem==None:
+				self.loadingItem=self.create_image(x,y,image=self.tkLoading,anchor=tkinter.CENTER)
+			else:
+				self.coords(self.loadingItem,x,y)
+				self.tag_raise(self.loadingItem)
 			if indicator and self.loading:
-				(iw,ih)=self.loadingImg.size
-				(x,y)=((self.winfo_width()-iw)/2+self.offsetx,(self.winfo_height()-ih)/2+self.offsety)
-				map_img.paste(self.loadingImg,(int(x),int(y)),mask=self.loadingImg)
-			# create TK image and copy map+overlay into it
-			self.tkOffscreen=ImageTk.PhotoImage(map_img)
-			self.delete(self.item)
-			self.item=self.create_image(-self.offsetx,-self.offsety,image=self.tkOffscreen,anchor=tkinter.NW)
+				self.itemconfigure(self.loadingItem,state=tkinter.NORMAL)
+			else:
+				self.itemconfigure(self.loadingItem,state=tkinter.HIDDEN)
 		if _debug_chrono: 
 			self.fps_clock=self.fps_clock+time.perf_counter()
 			self.fps=self.fps+1
 		return map_img
 		
-	def export(self,filename="test.png",zoommod=0):
-		""" do the rendering processing without user intercation 
-			in order to build a big image and export it to a PNG file
+	def export(self,filename="test.png",zoommod=0,progress=None,finish=None):
+		""" export the map into a PNG file as a background job (the tk loop is not blocked),
+			tiles are loaded by threads, then the big image is rendered and saved
+			progress : called (in tk loop) with (job,tiles done,tiles total,bytes downloaded,eta in seconds)
+			finish : called (in tk loop) at the end with the filename (None if cancelled or error)
+			return the job (a TMapSimple) or None if an export is allready running
 		"""
+		if self.exportJob:
+			print("export allready running")
+			return None
 		z=self.zoom
 		if _debug_export:
 			print("zoom:",z,"zmod:",zoommod)
@@ -472,44 +730,43 @@ class TMapWidget(tkinter.Canvas):
 			print("zoom:",z,"size:",s)
 		mapExport=TMapSimple(self.parent,self.winfo_width()*s,self.winfo_height()*s,self.cache)
 		mapExport.setMapServer(self.mapServer)
-		mapExport.setOverlayServer(self.overlayServer)
+		mapExport.setOverlays(self.overlays)
 		mapExport.setLocation(self.location,z)
 		mapExport.setDate(self.getDate())
 		mapExport.setShift(self.getShift())
-		mapExport.mapOffscreen._debug_build=True
-		if _debug_chrono:
-			img=mapExport.work_queue.qsize()
-			clk=t=time.perf_counter()
-		mapExport.update()
-		while not(mapExport.ready()):
-			pass
-		if _debug_chrono:
-			clk=time.perf_counter()-clk
-			if clk==0.0:
-				print("no timing, %d image(s)" % img)
-			else:
-				print("%d image(s) in %.1f : %.2f fps" % (img,clk,1.0*img/clk))
-		img=mapExport.render()
-		img.save(filename)
-		if _debug_export:
-			print("export:",filename)
+		mapExport.mapOffscreen._debug_build=_debug_export
+		self.exportJob=mapExport
+		self.exportFile=filename
+		self.exportProgress=progress
+		self.exportFinish=finish
+		mapExport.update(self.notifyExport)
+		self.onExportProgress()		# first progress (and polling if required)
+		return mapExport
+	
+	def cancelExport(self):
+		""" cancel the running export (if any), finish is called with None """
+		if self.exportJob:
+			self.exportJob.cancel()
+			if self.exportJob.state!="cancelled":	# allready rendering : end without callbacks
+				self.exportProgress=None
+				self.exportFinish=None
+			self.onExportProgress()
 
 class TMapSimple():
 	"""	TMapSimple
 		a simpliest version of TMapWidget without widget part
 		full offscreen for exporting a file
+		state : loading (tiles), rendering, done, cancelled or error
 	"""
 	def __init__(self,window,width=default_win_x,height=default_win_y,cache=None):
 		self.parent=window
 		self.mapOffscreen=bigtilemap.BigTileMap()
-		self.overlayOffscreen=bigtilemap.BigTileMap(overlay=True)
 		self.errorImg=window.errorImage
 		self.mapOffscreen.setErrorImage(self.errorImg)
-		self.overlayOffscreen.setErrorImage(self.errorImg)
 		self.width=width
 		self.height=height
 		self.mapServer=None
-		self.overlayServer=None
+		self.overlays=[]
 		self.zoom=0
 		self.location=None
 		(self.xmin,self.ymin)=(0,0)
@@ -523,51 +780,54 @@ class TMapSimple():
 		self.work_queue=queue.Queue()
 		self.result_queue=queue.Queue()
 		self._debug_queue=False
+		# progress (updated by loading threads)
+		self.state="loading"
+		self.jobs=0
+		self.total=0
+		self.loaded=0
+		self.loaded_bytes=0
+		self.errors=0
+		self.clock=time.perf_counter()
+		self.progress_lock=threading.Lock()
+		self.cancel_event=threading.Event()
+		
+	def getServers(self):
+		""" return the servers used by the map : base map then overlays """
+		servers=[]
+		if self.mapServer:
+			servers.append(self.mapServer)
+		for l in self.overlays:
+			servers.append(l.server)
+		return servers
+	
+	def updateHandles(self):
+		""" update date/timeshift handling according to map and overlays """
+		self.handleDate=False
+		self.handleTimeShift=False
+		for s in self.getServers():
+			self.handleDate=self.handleDate or s.handleDate
+			self.handleTimeShift=self.handleTimeShift or s.handleTimeShift
 		
 	def setMapServer(self,map_server):
 		""" define a new map server and store default (+update zoom) """
 		if self.mapServer!=map_server:
 			self.mapServer=map_server
 			self.setZoom(self.zoom)		# update zoom
-			# update date/timeshift widget according to map and overlay
-			if self.mapServer.handleDate:
-				self.handleDate=True
-			else:
-				if self.overlayServer:
-					if self.overlayServer.handleDate:
-						self.handleDate=True
-				else:
-					self.handleDate=False
-			if self.mapServer.handleTimeShift:
-				self.handleTimeShift=True
-			else:
-				if self.overlayServer:
-					if self.overlayServer.handleTimeShift:
-						self.handleTimeShift=True
-				else:
-					self.handleTimeShift=False
+			self.updateHandles()
 			self.shift=0
-		
-	def setOverlayServer(self,overlay_server):
-		""" define a new overlay server for the map from its name and store default (+update zoom) """
-		if self.overlayServer!=overlay_server:
-			self.overlayServer=overlay_server
+	
+	def setOverlays(self,layers):
+		""" define the overlays stack (list of bigtilemap.Layer, or TileServer) (+update zoom) """
+		layers=[l if isinstance(l,bigtilemap.Layer) else bigtilemap.Layer(l) for l in layers if l]
+		if self.overlays!=layers:
+			self.overlays=layers
 			self.setZoom(self.zoom)
-			if self.overlayServer and self.overlayServer.handleDate:
-				self.handleDate=True
-			else:
-				if self.mapServer.handleDate:
-					self.handleDate=True
-				else:
-					self.handleDate=False
-			if self.overlayServer and self.overlayServer.handleTimeShift:
-				self.handleTimeShift=True
-			else:
-				if self.mapServer.handleTimeShift:
-					self.handleTimeShift=True
-				else:
-					self.handleTimeShift=False
+			self.updateHandles()
 			self.shift=0
+		
+	def setOverlayServer(self,overlay_server):
+		""" define a single overlay server for the map (or None) """
+		self.setOverlays([overlay_server])
 	
 	def setLocation(self,location,zoom=None):
 		""" define a new location (with optional zoom) for the map and store default """
@@ -578,19 +838,7 @@ class TMapSimple():
 		
 	def setZoom(self,zoom):
 		""" define a new zoom for the map and store default """
-		(zmmin,zmmax)=self.mapServer.getZoom()
-		if self.overlayServer:
-			(zomin,zomax)=self.overlayServer.getZoom()
-			zmin=max(zmmin,zomin)
-			zmax=min(zmmax,zomax)
-		else:
-			(zmin,zmax)=(zmmin,zmmax)
-		if zoom<zmin:
-			z=zmin
-		if zoom>zmax:
-			z=zmax
-		else:
-			z=zoom
+		z=checkZoom(zoom,self.getServers())
 		if z!=self.zoom:
 			self.zoom=z
 	
@@ -601,11 +849,11 @@ class TMapSimple():
 	def setShift(self,shift):
 		if shift!=self.shift:
 			self.shift=shift
-			self.mapServer.timeshift=shift
-			if self.overlayServer:
-				self.overlayServer.timeshift=shift
+			for s in self.getServers():
+				s.timeshift=shift
 			
-	def update(self):
+	def update(self,notify=None):
+		""" enqueue tiles and launch loading threads, notify is called (from threads) for each tile """
 		(x,y)=self.location.convert2Tile(self.zoom)
 		(self.xdtile,self.ydtile)=(int((0.5*self.width/self.mapServer.size_x)+0.5),int((0.5*self.height/self.mapServer.size_y)+0.5))
 		(self.xmin,self.ymin)=(int(x)-self.xdtile,int(y)-self.ydtile)
@@ -616,23 +864,47 @@ class TMapSimple():
 			for y in range(self.ymin,self.ymax+1) :
 				self.work_queue.put((x,y,self.zoom,self.mapServer,self.date,self.shift,self.cache))
 				self.jobs=self.jobs+1
-		if self.overlayServer:
+		for layer in self.overlays:
 			for x in range(self.xmin,self.xmax+1):
 				for y in range(self.ymin,self.ymax+1) :
-					self.work_queue.put((x,y,self.zoom,self.overlayServer,self.date,self.shift,self.cache))
+					self.work_queue.put((x,y,self.zoom,layer.server,self.date,self.shift,self.cache))
 					self.jobs=self.jobs+1
+		self.total=self.jobs
+		self.clock=time.perf_counter()
 		if self._debug_queue:
 			print("%d tiles" % self.jobs)
 			print("launching : work: %d, result: %d" % (self.work_queue.qsize(),self.result_queue.qsize()))
 		# launch the task queue (to retrieve tiles)
 		if (config.k_nb_thread>1):		# for asyncrhonous : launch process to handle the queues
 			for i in range(config.k_nb_thread):
-				task=bigtilemap.LoadImagesFromURL(self.work_queue,self.result_queue,self.errorImg)
+				task=bigtilemap.LoadImagesFromURL(self.work_queue,self.result_queue,self.errorImg,notify,self.onProgress,self.cancel_event)
 				task.start()
 		else:	# for synchronous : run a single task until queue is empty
-			task=bigtilemap.LoadImagesFromURL(self.work_queue,self.result_queue,self.errorImg)
+			task=bigtilemap.LoadImagesFromURL(self.work_queue,self.result_queue,self.errorImg,notify,self.onProgress,self.cancel_event)
 			task.run()
 	
+	def onProgress(self,error,size):
+		""" called by loading threads for each tile """
+		with self.progress_lock:
+			self.loaded=self.loaded+1
+			self.loaded_bytes=self.loaded_bytes+size
+			self.errors=self.errors+error
+	
+	def getProgress(self):
+		""" return (tiles done,tiles total,bytes downloaded,eta in seconds or None) """
+		with self.progress_lock:
+			(n,size)=(self.loaded,self.loaded_bytes)
+		eta=None
+		if n>0 and self.state=="loading":
+			eta=(time.perf_counter()-self.clock)*(self.total-n)/n
+		return (n,self.total,size,eta)
+	
+	def cancel(self):
+		""" cancel the export : threads drop the remaining tiles, a rendered image is not saved """
+		self.cancel_event.set()
+		if self.state=="loading":
+			self.state="cancelled"
+	
 	def ready(self):
 		while not(self.result_queue.empty()):
 			self.jobs=self.jobs-1
@@ -646,15 +918,9 @@ class TMapSimple():
 	def render(self):
 		map_img=None
 		if self.mapServer:
-			self.mapOffscreen.setServer(self.mapServer,self.zoom,self.date)
+			self.mapOffscreen.setServer(self.mapServer,self.zoom,self.date,self.shift,self.overlays)
 			self.mapOffscreen.setSize((self.xmin,self.ymin),(self.xmax,self.ymax))
 			self.mapOffscreen.build()
 			map_img=self.mapOffscreen.getImg()
-			if self.overlayServer:
-				self.overlayOffscreen.setServer(self.overlayServer,self.zoom,self.date)
-				self.overlayOffscreen.setSize((self.xmin,self.ymin),(self.xmax,self.ymax))
-				self.overlayOffscreen.build()
-				layer=self.overlayOffscreen.getImg()
-				map_img.paste(layer,mask=layer)
 		return map_img
 	